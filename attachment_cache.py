@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_CACHE_DIR = os.environ.get("ATTACHMENT_CACHE_DIR", ".attachment_cache")
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get("ATTACHMENT_CACHE_MAX_MB", "500")) * 1024 * 1024
+
+
+class AttachmentCache:
+    """
+    On-disk cache of downloaded attachments, so a rerun or a retried upload
+    doesn't download the same bytes again.
+
+    Files are stored once per SHA-256 of their content under blobs/, and an
+    SQLite index maps (message ID, part ID) to a blob. Part IDs are used rather
+    than attachment IDs because Gmail hands out a new attachmentId on every
+    fetch. When the blobs outgrow max_bytes the least recently used ones are
+    evicted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " message_id TEXT NOT NULL,"
+                " part_id TEXT NOT NULL,"
+                " sha256 TEXT NOT NULL,"
+                " PRIMARY KEY (message_id, part_id))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " sha256 TEXT PRIMARY KEY,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.cache_dir, "blobs", sha256)
+
+    def get(self, message_id, part_id):
+        """Return the cached bytes of an attachment, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256 FROM entries WHERE message_id = ? AND part_id = ?", (message_id, part_id)).fetchone()
+            data = None
+            if row is not None:
+                try:
+                    with open(self._blob_path(row[0]), 'rb') as f:
+                        data = f.read()
+                except OSError:
+                    data = None
+                if data is not None and hashlib.sha256(data).hexdigest() != row[0]:
+                    # Corrupted on disk, never hand that to an upload
+                    data = None
+                if data is None:
+                    self._drop_blob(row[0])
+                else:
+                    with self._conn:
+                        self._conn.execute(
+                            "UPDATE blobs SET last_access = ? WHERE sha256 = ?", (time.time(), row[0]))
+
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(data)
+            return data
+
+    def put(self, message_id, part_id, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha256)
+        with self._lock:
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (sha256, len(data), time.time()))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (message_id, part_id, sha256))
+            self._evict()
+
+    def _drop_blob(self, sha256):
+        with self._conn:
+            self._conn.execute("DELETE FROM entries WHERE sha256 = ?", (sha256,))
+            self._conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        try:
+            os.remove(self._blob_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for sha256, size in self._conn.execute(
+                "SELECT sha256, size FROM blobs ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._drop_blob(sha256)
+            total -= size
+            self.evictions += 1
+
+    def reset_stats(self):
+        self.hits = self.misses = self.bytes_saved = self.evictions = 0
+
+    def report(self):
+        return (f"Attachment cache: {self.hits} hits, {self.misses} misses, "
+                f"{self.bytes_saved / 1024:.1f} KB not downloaded again, {self.evictions} evicted")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,71 @@
+"""
+Benchmark for the Rabbit/Khateer check done on every general-branch xlsx.
+
+Compares the old approach (openpyxl full load, then read D10) with the
+streaming xlsx_reader.read_cell used by determine_khateer_or_rabbit.
+
+    python bench_client_sniff.py                 # synthetic POs of several sizes
+    python bench_client_sniff.py po1.xlsx ...    # real files
+"""
+import io
+import sys
+import time
+import openpyxl
+from xlsx_reader import read_cell
+
+
+def full_load_d10(xlsx_bytes):
+    wb = openpyxl.load_workbook(io.BytesIO(xlsx_bytes), data_only=True)
+    value = wb.active["D10"].value
+    return str(value) if value is not None else None
+
+
+def make_po(rows, supplier="Khateer Trading"):
+    """A workbook shaped like a Rabbit/Khateer PO: a header block, then line items."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws["A1"] = "Purchase Order"
+    ws["D10"] = supplier
+    ws.append([])
+    ws.append(["No.", "SKU", "Supplier SKU", "Barcode", "Product", "Qty", "Unit\nCost",
+               "Disc.\nAmt.", "Amt.\nExcl.\nVAT", "VAT\n%", "VAT\nAmt.", "Amt.\nIncl.\nVAT"])
+    for i in range(rows):
+        ws.append([i + 1, 920000 + i, f"S{i}", f"2283957{i:06d}", f"Product {i % 500}",
+                   (i % 40) + 1, 12.5, 0, 12.5, 14, 1.75, 14.25])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def timed(fn, data, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(data)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(paths):
+    if paths:
+        cases = []
+        for path in paths:
+            with open(path, "rb") as f:
+                cases.append((path, f.read()))
+    else:
+        cases = [(f"synthetic {rows} rows", make_po(rows)) for rows in (100, 2_000, 20_000)]
+
+    print(f"{'workbook':<28} {'size':>9} {'full load':>11} {'streaming':>11} {'speedup':>8}")
+    for name, data in cases:
+        repeat = 3 if len(data) > 1_000_000 else 5
+        full_time, full_value = timed(full_load_d10, data, repeat)
+        fast_time, fast_value = timed(lambda d: read_cell(d, "D10"), data, repeat)
+        if full_value != fast_value:
+            print(f"  MISMATCH for {name}: full load {full_value!r}, streaming {fast_value!r}")
+        print(f"{name:<28} {len(data) / 1024:>7.0f}KB {full_time * 1000:>9.1f}ms "
+              f"{fast_time * 1000:>9.2f}ms {full_time / fast_time:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+import io
+import os
+import re
+import csv
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import openpyxl
+from branches import default_resolver
+from line_items import is_total_row
+from xlsx_reader import read_rows, XlsxFormatError
+
+DEFAULT_SPLIT_WORKERS = int(os.environ.get("SPLIT_WORKERS", str(os.cpu_count() or 1)))
+# Folder, next to a bundle in Storage, of the per-branch files split out of it
+BRANCH_FOLDER = "branches"
+# Below this many rows writing in-process is quicker than shipping rows to a worker
+MIN_PARALLEL_ROWS = 2000
+SPLIT_EXTENSIONS = (".xlsx", ".csv")
+
+_enabled = False
+_workers = DEFAULT_SPLIT_WORKERS
+_pool = None
+_pool_lock = threading.Lock()
+# Storage object names are kept to ASCII letters and digits, like the base64 bundle names
+_UNSAFE = re.compile(r"[^A-Za-z0-9]+")
+
+
+class BranchSplitError(Exception):
+    """The file has no column of recognisable store codes."""
+
+
+def configure(enabled=None, workers=None):
+    global _enabled, _workers
+    if enabled is not None:
+        _enabled = enabled
+    if workers is not None:
+        _workers = max(workers, 1)
+
+def enabled():
+    return _enabled
+
+def _get_pool():
+    # spawn rather than fork: the fetcher forks from a process full of worker threads
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def group_rows(rows, resolver=None):
+    """
+    Split rows into (preamble, {Branch: [rows]}, rows without a branch) in one pass.
+
+    The branch column is the first cell that resolves to a store, and every
+    later row is filed under the store in that column. A row with the column
+    empty belongs to the store above it, which is how merged cells and
+    "code on the first line only" exports come out. A total row ends the
+    store above it and is left out, so the sheet's footer is not filed under
+    the last store. Everything above the first store row (title, PO number,
+    header) is the preamble and is repeated at the top of every branch's file.
+    """
+    resolver = resolver or default_resolver()
+    preamble = []
+    groups = {}
+    unresolved = []
+    column = None
+    current = None
+    for row in rows:
+        if column is None:
+            for position, value in enumerate(row):
+                if isinstance(value, str) and resolver.resolve(value) is not None:
+                    column = position
+                    break
+            else:
+                preamble.append(row)
+                continue
+        value = row[column] if column < len(row) else None
+        has_code = value is not None and str(value).strip()
+        store = resolver.resolve(str(value)) if has_code else None
+        if store is None and is_total_row(row):
+            current = None
+            continue
+        if has_code:
+            current = store
+        elif not any(cell is not None and cell != "" for cell in row):
+            continue
+        if current is None:
+            # An unknown store, or a line under one; never file it under another store
+            unresolved.append(row)
+        else:
+            groups.setdefault(current, []).append(row)
+    if column is None:
+        raise BranchSplitError("no store codes found")
+    return preamble, groups, unresolved
+
+
+def _write_xlsx(title, rows):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title[:31])
+    for row in rows:
+        ws.append(row)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+def _write_csv(title, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    # utf-8-sig so Excel shows the Arabic product names properly
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def _branch_filename(branch, filename):
+    name = _UNSAFE.sub("_", branch.english or branch.code).strip("_") or "branch"
+    return name + os.path.splitext(filename)[1].lower()
+
+
+def object_names(bundle_name, outputs):
+    """
+    Storage names of split_bundle_files() outputs, in a folder next to the
+    bundle: "<bundle>/branches/01_Nasr_City.xlsx". The number keeps the files
+    of one store apart when an email has several sheets to split.
+    """
+    folder = f"{os.path.splitext(bundle_name)[0]}/{BRANCH_FOLDER}"
+    return [f"{folder}/{position:02d}_{name}" for position, (name, _, _) in enumerate(outputs, 1)]
+
+
+def split_file(data, filename, resolver=None):
+    """
+    Per-branch copies of a multi-store .xlsx or .csv PO.
+
+    The file is read once and grouped in memory. Then each branch's file is
+    written, in the worker processes when there are enough rows to make that
+    worthwhile. Returns ([(branch filename, bytes, Branch)], number of rows left
+    out because their store code is unknown).
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".xlsx":
+        try:
+            rows = read_rows(data, numbers=True)
+        except XlsxFormatError as e:
+            raise BranchSplitError(f"{filename}: {e}") from e
+        write = _write_xlsx
+    elif extension == ".csv":
+        rows = list(csv.reader(io.StringIO(data.decode("utf-8-sig", errors="replace"), newline="")))
+        write = _write_csv
+    else:
+        raise BranchSplitError(f"{filename}: only .xlsx and .csv files can be split")
+
+    preamble, groups, unresolved = group_rows(rows, resolver)
+    jobs = [(branch, preamble + branch_rows)
+            for branch, branch_rows in sorted(groups.items(), key=lambda item: item[0].code)]
+    if _workers > 1 and len(jobs) > 1 and sum(len(job[1]) for job in jobs) >= MIN_PARALLEL_ROWS:
+        pool = _get_pool()
+        futures = [pool.submit(write, branch.code, job_rows) for branch, job_rows in jobs]
+        outputs = [future.result() for future in futures]
+    else:
+        outputs = [write(branch.code, job_rows) for branch, job_rows in jobs]
+    return ([(_branch_filename(branch, filename), output, branch) for (branch, _), output in zip(jobs, outputs)],
+            len(unresolved))
+
+
+def split_bundle_files(files, log):
+    """
+    Per-branch files, as split_file() returns them, for every splittable file
+    of a bundle, given as [(filename, bytes)]. Files inside attached zips are
+    split too. Files that can't be split are logged and left out.
+    """
+    members = []
+    for filename, data in files:
+        if filename.lower().endswith(".zip"):
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                    inner = [(info.filename.rsplit("/", 1)[-1], zf.read(info)) for info in zf.infolist()
+                             if info.filename.lower().endswith(SPLIT_EXTENSIONS)]
+            except zipfile.BadZipFile as e:
+                log(f"  Can't split {filename}: {e}")
+                continue
+            members.extend(split_bundle_files(inner, log))
+            continue
+        if not filename.lower().endswith(SPLIT_EXTENSIONS):
+            continue
+        try:
+            outputs, unresolved = split_file(data, filename)
+        except BranchSplitError as e:
+            log(f"  Can't split {filename} by branch: {e}")
+            continue
+        note = f", {unresolved} rows with an unknown store code left out" if unresolved else ""
+        log(f"  Split {filename} into {len(outputs)} branch files{note}")
+        members.extend(outputs)
+    return members
+
@@ -0,0 +1,180 @@
+import re
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from catalog import CONFIG_PATH, read_tables
+
+BRANCH_TABLES = ("branches_dict", "branches_translation_tlbt", "special_codes")
+# Distinct codes seen in one PO are few; this only bounds memory for junk input
+RESOLVE_CACHE_SIZE = 4096
+
+_SPACES = re.compile(r"\s+")
+_UNDERSCORE = re.compile(r"\s*_\s*")
+_END = object()
+
+
+@dataclass(frozen=True)
+class Branch:
+    code: str
+    arabic: str
+    english: Optional[str]
+
+
+def normalize_code(code):
+    """
+    Comparison key of a store code: case-folded, runs of spaces collapsed and
+    spaces around underscores dropped, so 'EG_Shrouk_ Mgawra (2)_DS_51' and
+    'eg_shrouk_mgawra (2)_ds_51' are the same code.
+    """
+    if code is None:
+        return ""
+    return _UNDERSCORE.sub("_", _SPACES.sub(" ", str(code).strip())).casefold()
+
+
+class _Trie:
+    """Character trie over normalized codes; each node is a dict, _END marks a stored key."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, value):
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_END] = value
+
+    def longest_prefix(self, key, boundary=None):
+        """
+        (length, value) of the longest stored key that `key` starts with, or
+        None. With `boundary`, a match only counts if it ends the key or is
+        followed by a character for which boundary(char) is true.
+        """
+        node = self.root
+        found = None
+        for length, char in enumerate(key):
+            if _END in node and (boundary is None or boundary(char)):
+                found = (length, node[_END])
+            node = node.get(char)
+            if node is None:
+                return found
+        if _END in node:
+            found = (len(key), node[_END])
+        return found
+
+    def values_under(self, prefix):
+        """Every value whose key starts with `prefix`."""
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        values = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for char, child in node.items():
+                if char is _END:
+                    values.append(child)
+                else:
+                    stack.append(child)
+        return values
+
+
+def _code_boundary(char):
+    # EG_Cairo_DS_1 must not match the start of EG_Cairo_DS_18
+    return not char.isalnum()
+
+def _common_prefix(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class BranchResolver:
+    """
+    Resolves Talabat store codes to branches with two tries over config.py's
+    branches_dict and special_codes.
+
+    A code is looked up, in order: exactly; as the longest full branch code it
+    starts with (so suffixes like ' - Nasr City' are ignored); and through the
+    longest special_codes prefix it starts with, choosing among the branches
+    under that prefix the one sharing the most characters with the code. Each
+    step walks the code once, and results are memoized, so resolving every
+    row of a multi-branch PO costs one dict lookup per repeated code.
+    """
+
+    def __init__(self, branches, translations, special_codes):
+        self._codes = _Trie()
+        self._prefixes = _Trie()
+        self._exact = {}
+        self.issues = []
+        for code, arabic in branches.items():
+            english = translations.get(arabic)
+            if english is None:
+                self.issues.append(f"{code!r} ({arabic}) has no English name")
+            branch = Branch(code, arabic, english)
+            key = normalize_code(code)
+            if key in self._exact:
+                self.issues.append(f"{code!r} and {self._exact[key].code!r} are the same code")
+            self._exact[key] = branch
+            self._codes.add(key, branch)
+            # Branch names work as codes too
+            self._exact.setdefault(normalize_code(arabic), branch)
+            if english:
+                self._exact.setdefault(normalize_code(english), branch)
+        for prefix in special_codes:
+            key = normalize_code(prefix)
+            if not self._codes.values_under(key):
+                self.issues.append(f"special code {prefix!r} matches no branch")
+            self._prefixes.add(key, key)
+        self.resolve = lru_cache(maxsize=RESOLVE_CACHE_SIZE)(self._resolve)
+
+    @classmethod
+    def from_config(cls, path=CONFIG_PATH):
+        tables = read_tables(path, BRANCH_TABLES)
+        return cls(dict(tables["branches_dict"]), dict(tables["branches_translation_tlbt"]),
+                   tables["special_codes"])
+
+    def _resolve(self, code):
+        """The Branch for a store code, or None if it can't be told apart."""
+        key = normalize_code(code)
+        if not key:
+            return None
+        branch = self._exact.get(key)
+        if branch is not None:
+            return branch
+        match = self._codes.longest_prefix(key, _code_boundary)
+        if match is not None:
+            return match[1]
+        match = self._prefixes.longest_prefix(key)
+        if match is None:
+            return None
+        candidates = self._codes.values_under(match[1])
+        scored = sorted(((_common_prefix(key, normalize_code(c.code)), c.code, c) for c in candidates),
+                        key=lambda entry: entry[:2], reverse=True)
+        if len(scored) > 1 and scored[0][0] == scored[1][0]:
+            return None
+        return scored[0][2] if scored else None
+
+    def resolve_many(self, codes):
+        """resolve() over a whole column of codes."""
+        return list(map(self.resolve, codes))
+
+
+_default_resolver = None
+_default_lock = threading.Lock()
+
+def default_resolver():
+    """The resolver built from config.py, built on first use and shared afterwards."""
+    global _default_resolver
+    with _default_lock:
+        if _default_resolver is None:
+            _default_resolver = BranchResolver.from_config()
+        return _default_resolver
+
+def resolve_branch(code):
+    return default_resolver().resolve(code)
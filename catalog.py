@@ -0,0 +1,250 @@
+import os
+import re
+import ast
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.py")
+# The lookup tables in config.py the catalog is compiled from
+CATALOG_TABLES = ("barcode_to_product", "translation_dict", "categories_dict", "columns")
+NO_CATEGORY = -1
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class CatalogError(ValueError):
+    """The lookup tables contradict each other (raised by build_catalog(strict=True))."""
+
+
+@dataclass(frozen=True)
+class CatalogIssue:
+    table: str
+    key: object
+    kind: str  # "duplicate", "conflict", "empty_key" or "uncategorised"
+    message: str
+
+
+def normalize_name(value):
+    """Product names compare with surrounding and repeated whitespace ignored."""
+    if value is None:
+        return None
+    name = _WHITESPACE.sub(" ", str(value)).strip()
+    return name or None
+
+def normalize_barcode(value):
+    """Barcodes as digit strings; spreadsheets often hand them over as floats."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if value != value or not value.is_integer():
+            return None
+        value = int(value)
+    barcode = str(value).strip()
+    if barcode.endswith(".0"):
+        barcode = barcode[:-2]
+    return barcode or None
+
+def normalize_sku(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None
+    if number != number or not number.is_integer():
+        return None
+    return int(number)
+
+
+def read_tables(path=CONFIG_PATH, names=CATALOG_TABLES):
+    """
+    The literal tables in config.py, without importing it.
+
+    Dicts come back as lists of (key, value) pairs in source order, so keys
+    written twice are still visible; evaluating the literal would silently
+    keep only the last one.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    tables = {}
+    for node in tree.body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name) and node.targets[0].id in names):
+            continue
+        if isinstance(node.value, ast.Dict):
+            tables[node.targets[0].id] = [(ast.literal_eval(key), ast.literal_eval(value))
+                                          for key, value in zip(node.value.keys, node.value.values)]
+        else:
+            tables[node.targets[0].id] = ast.literal_eval(node.value)
+    missing = [name for name in names if name not in tables]
+    if missing:
+        raise CatalogError(f"{path} has no literal table named {', '.join(missing)}")
+    return tables
+
+
+@dataclass(frozen=True)
+class Catalog:
+    """
+    Product lookups compiled from the config tables.
+
+    Every distinct product name gets a small integer ID. Barcodes, SKUs and
+    names all map straight to that ID, and the ID indexes into `names` and
+    `product_category`, so mapping a line item is a couple of dict and tuple
+    lookups instead of scans over the category lists.
+    """
+    names: Tuple[str, ...]
+    categories: Tuple[str, ...]
+    product_category: Tuple[int, ...]
+    by_barcode: Mapping[str, int]
+    by_sku: Mapping[int, int]
+    by_name: Mapping[str, int]
+    columns: Tuple[str, ...]
+    issues: Tuple[CatalogIssue, ...] = ()
+
+    def __len__(self):
+        return len(self.names)
+
+    def product_id(self, barcode=None, sku=None, name=None):
+        """The product matching the barcode, else the SKU, else the name, or None."""
+        barcode = normalize_barcode(barcode)
+        if barcode is not None and barcode in self.by_barcode:
+            return self.by_barcode[barcode]
+        sku = normalize_sku(sku)
+        if sku is not None and sku in self.by_sku:
+            return self.by_sku[sku]
+        name = normalize_name(name)
+        if name is not None:
+            return self.by_name.get(name)
+        return None
+
+    def category(self, product_id):
+        index = self.product_category[product_id]
+        return None if index == NO_CATEGORY else self.categories[index]
+
+    def lookup(self, barcode=None, sku=None, name=None):
+        """(product ID, canonical name, category) of a line item, or None if it isn't in the catalog."""
+        product_id = self.product_id(barcode, sku, name)
+        if product_id is None:
+            return None
+        return product_id, self.names[product_id], self.category(product_id)
+
+
+class _Builder:
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.product_category = []
+        self.issues = []
+
+    def issue(self, table, key, kind, message):
+        self.issues.append(CatalogIssue(table, key, kind, message))
+
+    def product(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.product_category.append(NO_CATEGORY)
+        return self.ids[name]
+
+    def index(self, table, pairs, normalize_key):
+        """key -> product ID; when a key repeats, the last value wins, as it does in Python."""
+        index = {}
+        for raw_key, raw_name in pairs:
+            key = normalize_key(raw_key)
+            name = normalize_name(raw_name)
+            if key is None:
+                self.issue(table, raw_key, "empty_key", f"{raw_name!r} has an empty key and can't be looked up by it")
+                if name is not None:
+                    self.product(name)
+                continue
+            product_id = self.product(name)
+            if key in index:
+                previous = self.names[index[key]]
+                if previous == name:
+                    self.issue(table, key, "duplicate", f"{key!r} is listed twice")
+                else:
+                    self.issue(table, key, "conflict", f"{key!r} is both {previous!r} and {name!r}")
+            index[key] = product_id
+        return MappingProxyType(index)
+
+
+def build_catalog(tables, strict=False):
+    """
+    Compile read_tables() output into a Catalog.
+
+    Anything odd in the tables is kept in `catalog.issues`. With `strict`,
+    conflicts (one key or product pointing at two different things) raise
+    CatalogError instead.
+    """
+    builder = _Builder()
+    categories = []
+    for category, products in tables["categories_dict"]:
+        if category in categories:
+            builder.issue("categories_dict", category, "duplicate", f"category {category!r} is listed twice")
+        else:
+            categories.append(category)
+        category_index = categories.index(category)
+        for raw_name in products:
+            name = normalize_name(raw_name)
+            if name is None:
+                continue
+            product_id = builder.product(name)
+            current = builder.product_category[product_id]
+            if current == category_index:
+                builder.issue("categories_dict", name, "duplicate", f"{name!r} is listed twice in {category!r}")
+            elif current != NO_CATEGORY:
+                builder.issue("categories_dict", name, "conflict",
+                              f"{name!r} is in both {categories[current]!r} and {category!r}")
+            else:
+                builder.product_category[product_id] = category_index
+
+    by_barcode = builder.index("barcode_to_product", tables["barcode_to_product"], normalize_barcode)
+    by_sku = builder.index("translation_dict", tables["translation_dict"], normalize_sku)
+
+    for product_id, name in enumerate(builder.names):
+        if builder.product_category[product_id] == NO_CATEGORY:
+            builder.issue("categories_dict", name, "uncategorised", f"{name!r} is not in any category")
+
+    columns = tuple(tables["columns"])
+    for column in sorted(set(c for c in columns if columns.count(c) > 1)):
+        builder.issue("columns", column, "duplicate", f"column {column!r} is listed twice")
+
+    conflicts = [issue for issue in builder.issues if issue.kind == "conflict"]
+    if strict and conflicts:
+        raise CatalogError("; ".join(issue.message for issue in conflicts))
+
+    return Catalog(
+        names=tuple(builder.names),
+        categories=tuple(categories),
+        product_category=tuple(builder.product_category),
+        by_barcode=by_barcode,
+        by_sku=by_sku,
+        by_name=MappingProxyType(dict(builder.ids)),
+        columns=columns,
+        issues=tuple(builder.issues),
+    )
+
+
+_default_catalog = None
+_default_lock = threading.Lock()
+
+def default_catalog():
+    """The catalog compiled from config.py, built on first use and shared afterwards."""
+    global _default_catalog
+    with _default_lock:
+        if _default_catalog is None:
+            _default_catalog = build_catalog(read_tables())
+        return _default_catalog
+
+def catalog_report(catalog: Optional[Catalog] = None):
+    catalog = catalog or default_catalog()
+    lines = [f"Catalog: {len(catalog)} products in {len(catalog.categories)} categories, "
+             f"{len(catalog.by_barcode)} barcodes, {len(catalog.by_sku)} SKUs"]
+    lines += [f"  {issue.table}: {issue.message}" for issue in catalog.issues]
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    print(catalog_report())
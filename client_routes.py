@@ -0,0 +1,248 @@
+import re
+import base64
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+from typing import Callable, Optional, Tuple
+
+# Attachment types accepted by the bundling (Rabbit / Khateer / Talabat) route
+BUNDLE_EXTENSIONS = ('.pdf', '.xls', '.xlsx', '.csv', '.zip')
+
+
+def extract_order_date_from_subject(subject):
+    match = re.search(r"\[(\d{4}-\d{2}-\d{2})\]", subject)
+    if match:
+        return datetime.strptime(match.group(1), "%Y-%m-%d").date()
+    return None
+
+def get_next_delivery_date():
+    tomorrow = datetime.today() + timedelta(days=1)
+    if tomorrow.weekday() == 4:
+        return (tomorrow + timedelta(days=1)).strftime("%Y-%m-%d")
+    return tomorrow.strftime("%Y-%m-%d")
+
+def safe_xlsx_filename(filename: str) -> str:
+    encoded = base64.urlsafe_b64encode(filename.encode()).decode()
+    return f"{encoded}.xlsx"
+
+
+# --- Order detail extractors ---
+# Each takes (subject, snippet, log) and returns the purchase_orders fields it can
+# work out; anything missing falls back to default_order_details().
+
+def default_order_details(subject, snippet, log):
+    return {
+        "order_date": datetime.today().strftime("%Y-%m-%d"),
+        "delivery_date": get_next_delivery_date(),
+        "city": None,
+        "po_number": None,
+    }
+
+_BREADFAST_DATE = re.compile(r"(\d{1,2}/\d{1,2}/\d{4})")
+_BREADFAST_CITY = re.compile(r"\((.*?)\)")
+
+def breadfast_order_details(subject, snippet, log):
+    details = {}
+    date_match = _BREADFAST_DATE.search(subject)
+    if date_match:
+        try:
+            details["delivery_date"] = datetime.strptime(date_match.group(1), "%d/%m/%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            details["delivery_date"] = datetime.strptime(date_match.group(1), "%m/%d/%Y").strftime("%Y-%m-%d")
+
+    subject_lower = subject.lower()
+    if "alex" in subject_lower:
+        details["city"] = "Alexandria"
+    elif "mansoura" in subject_lower or "mansora" in subject_lower:
+        details["city"] = "Mansoura"
+    else:
+        city_match = _BREADFAST_CITY.search(subject)
+        if city_match:
+            details["city"] = city_match.group(1).strip().capitalize()
+    return details
+
+_GOODSMART_DELIVERY = re.compile(r"Expected Delivery Date:\s*(\d{1,2}/\d{1,2}/\d{4})")
+_GOODSMART_PO = re.compile(r"PO No\s*(\d+)")
+
+def goodsmart_order_details(subject, snippet, log):
+    details = {}
+    delivery_match = _GOODSMART_DELIVERY.search(snippet)
+    if delivery_match:
+        details["delivery_date"] = datetime.strptime(delivery_match.group(1), "%d/%m/%Y").strftime("%Y-%m-%d")
+    po_match = _GOODSMART_PO.search(snippet)
+    if po_match:
+        details["po_number"] = po_match.group(1)
+    return details
+
+# PO number sits in the body between 'مدينه نصر' and 'حدايق الاهرام'
+_HALAN_PO = re.compile(r"مدينه نصر(.*?)حدايق الاهرام")
+
+def halan_order_details(subject, snippet, log):
+    details = {}
+    # Next delivery is the nearest Saturday or Wednesday
+    today = datetime.today()
+    weekday = today.weekday()  # Monday = 0, Sunday = 6
+    if weekday in [5, 6, 0, 1]:  # Saturday, Sunday, Monday, Tuesday
+        days_until_wed = (2 - weekday) % 7 or 7
+        details["delivery_date"] = (today + timedelta(days=days_until_wed)).strftime("%Y-%m-%d")
+    else:  # Wednesday, Thursday, Friday
+        days_until_sat = (5 - weekday) % 7 or 7
+        details["delivery_date"] = (today + timedelta(days=days_until_sat)).strftime("%Y-%m-%d")
+
+    match = _HALAN_PO.search(snippet.replace("\n", " "))
+    if match:
+        details["po_number"] = match.group(1).strip()
+    return details
+
+def talabat_order_details(subject, snippet, log):
+    order_date = extract_order_date_from_subject(subject)
+    if not order_date:
+        log("No valid date in subject, using today's date instead.")
+        order_date = datetime.today()
+    return {
+        "order_date": order_date.strftime("%Y-%m-%d"),
+        "delivery_date": (order_date + timedelta(days=2)).strftime("%Y-%m-%d"),
+    }
+
+
+@dataclass(frozen=True)
+class ClientRule:
+    """
+    How to recognise one client's purchase order emails and what to upload from them.
+
+    A message matches when its sender address is in `senders` or its subject
+    matches one of `subject_patterns` (case-insensitive regexes). The Gmail
+    search asks for mail from `senders` or with one of the `search_subjects`
+    phrases in its subject (see gmail_query). With `bundle`, all accepted
+    attachments are zipped into one upload; otherwise each file is uploaded on
+    its own, renamed by `rename` if given. With `split_branches`, multi-store
+    sheets in a bundle are also uploaded as one file (and row) per branch
+    when the fetcher runs with --split-branches (see branch_split).
+    Attachments larger than `max_size` bytes are skipped before they are
+    downloaded. `client` None means the client is worked out from the
+    attachments (Rabbit / Khateer).
+    """
+    client: Optional[str]
+    label: str
+    senders: Tuple[str, ...] = ()
+    subject_patterns: Tuple[str, ...] = ()
+    search_subjects: Tuple[str, ...] = ()
+    extensions: Tuple[str, ...] = BUNDLE_EXTENSIONS
+    order_details: Callable = default_order_details
+    bundle: bool = False
+    rename: Optional[Callable] = None
+    max_size: Optional[int] = None
+    split_branches: bool = False
+
+    def details(self, subject, snippet, log):
+        details = default_order_details(subject, snippet, log)
+        details.update(self.order_details(subject, snippet, log))
+        return details
+
+    def accepts(self, attachment):
+        """Whether an AttachmentPart is worth downloading for this client. Returns (ok, reason)."""
+        if not attachment.filename.lower().endswith(self.extensions):
+            return False, "not a " + "/".join(self.extensions) + " file"
+        if self.max_size is not None and attachment.size > self.max_size:
+            return False, f"{attachment.size / 1024:.0f} KB is over the {self.max_size / 1024:.0f} KB limit"
+        return True, None
+
+
+# In priority order: when a sender matches one rule and the subject an earlier one, the earlier one wins
+CLIENT_RULES = [
+    ClientRule(
+        client="Breadfast",
+        label="BreadFast PDF",
+        senders=("abdelhamid.oraby@breadfast.com",),
+        subject_patterns=(r"^khodar po - delivery date",),
+        search_subjects=("Khodar PO - Delivery Date",),
+        extensions=(".pdf",),
+        order_details=breadfast_order_details,
+    ),
+    ClientRule(
+        client="GoodsMart",
+        label="GoodsMart file",
+        senders=("amir.maher@goodsmartegypt.com",),
+        subject_patterns=(r"khodar\.com po - goodsmart",),
+        search_subjects=("Khodar.com PO - Goodsmart",),
+        extensions=(".xlsx",),
+        order_details=goodsmart_order_details,
+    ),
+    ClientRule(
+        client="Halan",
+        label="Halan file",
+        senders=("Mohamed.OthmanAli@halan.com", "Ahmed.AdelEid@halan.com"),
+        subject_patterns=(re.escape("طلبيه الخضار شركة خضار دوت كوم -حالا"),),
+        extensions=(".xlsx",),
+        order_details=halan_order_details,
+        rename=safe_xlsx_filename,
+    ),
+    ClientRule(
+        client="Talabat",
+        label="Talabat bundle",
+        senders=("sherif.hossam@talabat.com",),
+        subject_patterns=(r"^tmart purchase orders",),
+        search_subjects=("TMart Purchase Orders",),
+        order_details=talabat_order_details,
+        bundle=True,
+        split_branches=True,
+    ),
+    # Rabbit and Khateer share a mailbox; the xlsx says which one it is
+    ClientRule(
+        client=None,
+        label="Rabbit/Khateer bundle",
+        senders=("rabbit.purchasing@rabbitmart.com",),
+        search_subjects=("Rabbit PO - Khodar trading and marketing",),
+        bundle=True,
+    ),
+]
+
+# Anything else the search turns up is handled like Rabbit / Khateer
+DEFAULT_RULE = ClientRule(client=None, label="bundle", bundle=True)
+
+# Never processed, even when they forward a matching email
+EXCLUDED_SENDERS = ("osama@khodar.com",)
+
+
+def with_max_size(rules, max_size):
+    """The rules with `max_size` applied to those that don't set a tighter limit."""
+    return [
+        rule if rule.max_size is not None and rule.max_size <= max_size else replace(rule, max_size=max_size)
+        for rule in rules
+    ]
+
+
+class ClientRouter:
+    """
+    Picks the ClientRule for a message.
+
+    Rules are compiled once: sender addresses go into a dict, so a known sender
+    is found with one lookup, and each rule's subject patterns are joined into
+    a single precompiled regex. Only rules ranked before the sender's rule
+    need their subject checked.
+    """
+
+    def __init__(self, rules=CLIENT_RULES, default=DEFAULT_RULE):
+        self.rules = list(rules)
+        self.default = default
+        self._by_sender = {}
+        for rank, rule in enumerate(self.rules):
+            for sender in rule.senders:
+                self._by_sender.setdefault(sender.lower(), rank)
+        self._subject_res = [
+            re.compile("|".join(f"(?:{p})" for p in rule.subject_patterns), re.IGNORECASE)
+            if rule.subject_patterns else None
+            for rule in self.rules
+        ]
+
+    def route(self, subject, sender):
+        address = parseaddr(sender)[1].lower()
+        best = self._by_sender.get(address, len(self.rules))
+        for rank in range(best):
+            pattern = self._subject_res[rank]
+            if pattern is not None and pattern.search(subject):
+                return self.rules[rank]
+        return self.rules[best] if best < len(self.rules) else self.default
+
+
+DEFAULT_ROUTER = ClientRouter()
@@ -517,7 +517,7 @@ special_codes = {
 
 
 import os
-import requests
+import supabase_http
 import io
 from datetime import datetime
 from typing import Optional
@@ -565,7 +565,7 @@ def upload_order_and_metadata(
     object_name = f"{int(order_date.replace('-', ''))}-{filename}"
     storage_url = f"{SUPABASE_URL}/storage/v1/object/{STORAGE_BUCKET}/{object_name}"
 
-    upload_response = requests.post(
+    upload_response = supabase_http.post(
         storage_url,
         headers={
             "apikey": API_KEY,
@@ -592,7 +592,7 @@ def upload_order_and_metadata(
         "po_number": po_number
     }]
 
-    insert_response = requests.post(
+    insert_response = supabase_http.post(
         f"{SUPABASE_URL}/rest/v1/{TABLE_NAME}",
         headers={
             "apikey": API_KEY,
@@ -1,11 +1,15 @@
 import os
 import json
 import re
+import threading
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 import requests
+import supabase_http
+import resumable_upload
+from ledger import content_hash
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
@@ -43,8 +47,8 @@ def safe_json_load(file_path):
         print(f"\n❌ Error reading {file_path}: {e}")
         raise
 
-def authenticate_gmail():
-    """Authenticate with Gmail API using token.json and credentials.json"""
+def get_gmail_credentials():
+    """Load, refresh or create Gmail credentials from token.json and credentials.json"""
     creds = None
     
     # Check if token.json exists
@@ -74,39 +78,66 @@ def authenticate_gmail():
             token.write(creds.to_json())
     
     print("✅ Gmail authentication successful")
-    return build('gmail', 'v1', credentials=creds)
+    return creds
 
-def upload_order_and_metadata(file_bytes, filename, client, order_type, 
-                              order_date, delivery_date, status, city=None, po_number=None):
-    """Upload file and metadata to Supabase"""
-    
+def build_gmail_service(creds):
+    """Build a Gmail API client. Clients are not thread-safe, so build one per thread."""
+    return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+
+def authenticate_gmail():
+    """Authenticate with Gmail API using token.json and credentials.json"""
+    return build_gmail_service(get_gmail_credentials())
+
+def _supabase_settings():
     SUPABASE_URL = os.environ.get('SUPABASE_URL')
     SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
     
     if not SUPABASE_URL or not SUPABASE_KEY:
         raise Exception("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
     
-    # Upload file to storage
+    return SUPABASE_URL, SUPABASE_KEY
+
+def upload_order_file(file_bytes, filename):
+    """
+    Upload a file to the orders storage bucket. file_bytes may also be a file object, which is streamed.
+    Files above the resumable threshold are sent in chunks that survive a dropped connection.
+    
+    An existing object is never overwritten: another order stored under the same name keeps its file
+    and the upload fails. Only an object with exactly these bytes (from an attempt that timed out after
+    storing it, or an earlier run) counts as this upload.
+    """
+    SUPABASE_URL, SUPABASE_KEY = _supabase_settings()
+    
+    if resumable_upload.should_resume(file_bytes):
+        resumable_upload.upload(SUPABASE_URL, SUPABASE_KEY, "orders", filename, file_bytes)
+        return
+    
     storage_url = f"{SUPABASE_URL}/storage/v1/object/orders/{filename}"
     headers = {
         "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/octet-stream"
+        "Content-Type": "application/octet-stream",
+        "x-upsert": "false"
     }
     
-    response = requests.post(storage_url, headers=headers, data=file_bytes)
+    body = file_bytes
+    if not isinstance(body, (bytes, bytearray)):
+        start = file_bytes.tell()
+        body = supabase_http.StreamBody(body)
+    # Sending the file again after a timeout can't overwrite anything, at worst it meets our own copy
+    response = supabase_http.post(storage_url, headers=headers, data=body, idempotent=True)
     
     if response.status_code not in [200, 201]:
+        if supabase_http.already_exists(response.status_code, response.text):
+            if body is not file_bytes:
+                file_bytes.seek(start)
+            stored = supabase_http.stored_object_hash(storage_url, {"Authorization": f"Bearer {SUPABASE_KEY}"})
+            if stored == content_hash(file_bytes):
+                return
         raise Exception(f"Storage upload failed: {response.text}")
-    
-    # Insert metadata into database
-    db_url = f"{SUPABASE_URL}/rest/v1/purchase_orders"
-    headers = {
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "apikey": SUPABASE_KEY,
-        "Content-Type": "application/json",
-        "Prefer": "return=representation"
-    }
-    
+
+def build_order_metadata(filename, client, order_type, order_date, delivery_date, status,
+                         city=None, po_number=None):
+    """Row for the purchase_orders table describing an uploaded file"""
     metadata = {
         "file_path": filename,
         "client": client,
@@ -121,9 +152,130 @@ def upload_order_and_metadata(file_bytes, filename, client, order_type,
     if po_number:
         metadata["po_number"] = po_number
     
-    db_response = requests.post(db_url, headers=headers, json=metadata)
+    return metadata
+
+def _stored_order_metadata(db_url, headers, rows):
+    """For each row, the same row already in purchase_orders, or None."""
+    response = supabase_http.request("GET", db_url, headers=headers, params=supabase_http.lookup_params(rows))
+    if response.status_code != 200:
+        raise Exception(f"Database lookup failed: {response.text}")
+    return supabase_http.match_stored(rows, response.json())
+
+def insert_order_metadata(rows):
+    """
+    Insert purchase_orders rows in one request. Returns the inserted rows, in the same order.
     
-    if db_response.status_code not in [200, 201]:
-        raise Exception(f"Database insert failed: {db_response.text}")
+    An insert that may have gone through (read timeout, 500/502/504) is not simply sent
+    again: the rows that were stored are looked up first and only the rest are inserted
+    once more, so a retry never duplicates a row. InsertRejected means none were stored.
+    """
+    SUPABASE_URL, SUPABASE_KEY = _supabase_settings()
     
-    return db_response.json()
+    db_url = f"{SUPABASE_URL}/rest/v1/purchase_orders"
+    headers = {
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "apikey": SUPABASE_KEY,
+        "Content-Type": "application/json",
+        "Prefer": supabase_http.INSERT_PREFER
+    }
+    
+    stored = [None] * len(rows)
+    for attempt in (1, 2):
+        missing = [row for row, found in zip(rows, stored) if found is None]
+        try:
+            db_response = supabase_http.post(db_url, headers=headers, params=supabase_http.insert_params(missing),
+                                             json=missing)
+        except requests.RequestException as e:
+            if supabase_http.never_sent(e):
+                raise
+            failure = e
+        else:
+            if db_response.status_code in [200, 201]:
+                inserted = db_response.json()
+                if len(inserted) != len(missing):
+                    raise Exception(f"expected {len(missing)} rows back, got {len(inserted)}")
+                inserted = iter(inserted)
+                return [found if found is not None else next(inserted) for found in stored]
+            if db_response.status_code not in supabase_http.OUTCOME_UNKNOWN_STATUSES:
+                if attempt == 1:
+                    raise supabase_http.InsertRejected(f"Database insert failed: {db_response.text}")
+                raise Exception(f"Database insert failed: {db_response.text}")
+            failure = db_response.text
+        
+        # Unknown whether the rows were stored; find out before sending them again
+        found_now = iter(_stored_order_metadata(db_url, headers, missing))
+        stored = [found if found is not None else next(found_now) for found in stored]
+        if all(found is not None for found in stored):
+            return stored
+    
+    raise Exception(f"Database insert failed: {failure}")
+
+def upload_order_and_metadata(file_bytes, filename, client, order_type, 
+                              order_date, delivery_date, status, city=None, po_number=None):
+    """Upload file and metadata to Supabase"""
+    upload_order_file(file_bytes, filename)
+    metadata = build_order_metadata(filename, client, order_type, order_date, delivery_date,
+                                    status, city=city, po_number=po_number)
+    return insert_order_metadata([metadata])
+
+class MetadataWriter:
+    """
+    Buffers purchase_orders rows and inserts them in batches instead of one request per file.
+
+    Each row is added with a callback(inserted_row, error) that runs when its batch
+    is flushed. If a batch is rejected, its rows are retried one by one so a single
+    bad row doesn't take the others down with it. A batch that failed any other way
+    may be partly stored, so its rows all fail instead of being sent again.
+    """
+    
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.batches = 0
+        self.rows_inserted = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+    
+    def add(self, row, callback):
+        with self._lock:
+            self._buffer.append((row, callback))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+    
+    def _count(self, batches=0, rows=0):
+        with self._lock:
+            self.batches += batches
+            self.rows_inserted += rows
+    
+    def flush(self):
+        with self._lock:
+            pending, self._buffer = self._buffer, []
+        if not pending:
+            return
+        
+        self._count(batches=1)
+        try:
+            inserted = insert_order_metadata([row for row, _ in pending])
+        except supabase_http.InsertRejected as e:
+            print(f"Batch insert of {len(pending)} rows failed ({e}), inserting them one by one")
+            inserted = None
+        except Exception as e:
+            print(f"Batch insert of {len(pending)} rows failed: {e}")
+            for _, callback in pending:
+                callback(None, e)
+            return
+        
+        if inserted is not None:
+            self._count(rows=len(inserted))
+            for (_, callback), result in zip(pending, inserted):
+                callback(result, None)
+            return
+        
+        for row, callback in pending:
+            try:
+                result = insert_order_metadata([row])[0]
+            except Exception as e:
+                callback(None, e)
+            else:
+                self._count(rows=1)
+                callback(result, None)
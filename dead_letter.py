@@ -0,0 +1,98 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+DEFAULT_DEAD_LETTER_FILE = os.environ.get("DEAD_LETTER_FILE", "dead_letter.jsonl")
+# Runs an email is tried in before it stays in the file without being retried
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("DEAD_LETTER_MAX_ATTEMPTS", "5"))
+
+
+class DeadLetterQueue:
+    """
+    Emails that still failed after every retry, kept for the next run.
+
+    The file holds one JSON object per line. The next run drains it before
+    searching, so a failed order is retried even after it has dropped out of
+    the search window or the History API has moved past it. Only the emails
+    that fail again are written back when the run saves the queue, unless
+    the run stopped before it got through them.
+
+    Each entry counts the runs that tried the email. Once it has failed
+    `max_attempts` times it is no longer retried, so an email that can
+    never go through doesn't cost every run (or every --watch cycle) a try;
+    it stays in the file for someone to look at.
+    """
+
+    def __init__(self, path=DEFAULT_DEAD_LETTER_FILE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._failed = {}
+        self._drained = {}
+        self._given_up = {}
+        self._lock = threading.Lock()
+
+    def drain(self):
+        """Message IDs left over from earlier runs that are still to be retried, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        msg_ids = []
+        given_up = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    msg_id = entry["message_id"]
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"Ignoring bad dead-letter entry {self.path}:{line_number}: {e}")
+                    continue
+                if entry.get("attempts", 1) >= self.max_attempts:
+                    with self._lock:
+                        self._given_up[msg_id] = entry
+                    given_up += 1
+                    continue
+                if msg_id not in msg_ids:
+                    msg_ids.append(msg_id)
+                with self._lock:
+                    self._drained[msg_id] = entry
+        if given_up:
+            print(f"Not retrying {given_up} emails of {self.path} that failed {self.max_attempts} times")
+        return msg_ids
+
+    def add(self, message_id, error):
+        with self._lock:
+            earlier = self._drained.get(message_id) or self._given_up.get(message_id) or {"attempts": 0}
+            self._failed[message_id] = {
+                "message_id": message_id,
+                "error": str(error),
+                "failed_at": datetime.utcnow().isoformat(),
+                "attempts": earlier.get("attempts", 1) + 1,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._failed)
+
+    def save(self, keep_drained=False):
+        """
+        Replace the file with the emails that failed in this run and those
+        no longer retried, and return how many it holds. With keep_drained
+        (the run stopped early) the emails drain() read are kept as well,
+        since some may not have been tried; those that did go through are
+        skipped cheaply next time thanks to the ledger.
+        """
+        with self._lock:
+            entries = dict(self._given_up)
+            if keep_drained:
+                entries.update(self._drained)
+            entries.update(self._failed)
+            entries = list(entries.values())
+        # Write to a temp file first so a crash never loses the entries still waiting
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        return len(entries)
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict
+from branch_split import BranchSplitError, group_rows
+from line_items import LineItemError, items_from_rows, read_grid
+
+DEFAULT_DEMAND_FILE = os.environ.get("DEMAND_DB", "demand.sqlite3")
+DEMAND_EXTENSIONS = (".xlsx", ".csv")
+
+_KEY_MATCH = " WHERE delivery_date = ? AND category = ? AND product = ? AND client = ? AND branch = ?"
+
+
+def _product_key(catalog_product, product, barcode, sku):
+    """Catalog name when the item is in the catalog, else whatever the PO calls it."""
+    if catalog_product is not None:
+        return catalog_product
+    if product is not None:
+        return product
+    if barcode is not None:
+        return f"barcode {barcode}"
+    if sku is not None:
+        return f"SKU {sku}"
+    return None
+
+
+def aggregate(items, delivery_date, client, branch=""):
+    """
+    {(delivery_date, category, product, client, branch): [qty, lines]} for one
+    LineItems table; "" stands for an unknown category, client or branch.
+    """
+    totals = defaultdict(lambda: [0.0, 0])
+    columns = items.columns
+    for qty, category, catalog_product, product, barcode, sku in zip(
+            columns["qty"], columns["category"], columns["catalog_product"], columns["product"],
+            columns["barcode"], columns["sku"]):
+        name = _product_key(catalog_product, product, barcode, sku)
+        if qty is None or name is None:
+            continue
+        total = totals[(delivery_date, category or "", name, client or "", branch or "")]
+        total[0] += qty
+        total[1] += 1
+    return totals
+
+
+class DemandStore:
+    """
+    How much of each product is due per delivery date, by category, client
+    and branch, kept up to date as POs come in.
+
+    `demand` holds the running totals and is what gets queried. Each PO's own
+    contribution is kept in `demand_sources` under a source key (message and
+    part ID). Recording a PO subtracts whatever that source added before and
+    adds the new totals, all in one transaction. So a PO that is processed
+    again, or replaced by a corrected file under the same key, never counts
+    twice, and nothing is ever recomputed from all files.
+    """
+
+    def __init__(self, path=DEFAULT_DEMAND_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            # WITHOUT ROWID: the rows live in the primary key's b-tree, which starts
+            # with delivery_date, so a day's picking list is one contiguous range
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS demand ("
+                " delivery_date TEXT NOT NULL,"
+                " category TEXT NOT NULL,"
+                " product TEXT NOT NULL,"
+                " client TEXT NOT NULL,"
+                " branch TEXT NOT NULL,"
+                " qty REAL NOT NULL,"
+                " lines INTEGER NOT NULL,"
+                " PRIMARY KEY (delivery_date, category, product, client, branch)) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS demand_sources ("
+                " source TEXT NOT NULL,"
+                " delivery_date TEXT NOT NULL,"
+                " category TEXT NOT NULL,"
+                " product TEXT NOT NULL,"
+                " client TEXT NOT NULL,"
+                " branch TEXT NOT NULL,"
+                " qty REAL NOT NULL,"
+                " lines INTEGER NOT NULL,"
+                " PRIMARY KEY (source, delivery_date, category, product, client, branch)) WITHOUT ROWID"
+            )
+
+    def record(self, source, totals):
+        """Replace what `source` contributes with `totals` (as built by aggregate())."""
+        new_rows = [key + (qty, lines) for key, (qty, lines) in totals.items()]
+        with self._lock, self._conn:
+            old_rows = self._conn.execute(
+                "SELECT delivery_date, category, product, client, branch, qty, lines"
+                " FROM demand_sources WHERE source = ?", (source,)).fetchall()
+            self._conn.executemany(
+                "UPDATE demand SET qty = qty - ?, lines = lines - ?" + _KEY_MATCH,
+                [(row[5], row[6]) + tuple(row[:5]) for row in old_rows])
+            self._conn.executemany(
+                "DELETE FROM demand" + _KEY_MATCH + " AND lines <= 0", [tuple(row[:5]) for row in old_rows])
+            self._conn.execute("DELETE FROM demand_sources WHERE source = ?", (source,))
+            self._conn.executemany(
+                "INSERT INTO demand_sources VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(source,) + row for row in new_rows])
+            self._conn.executemany(
+                "INSERT INTO demand VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (delivery_date, category, product, client, branch)"
+                " DO UPDATE SET qty = qty + excluded.qty, lines = lines + excluded.lines",
+                new_rows)
+        return sum(lines for _, lines in totals.values())
+
+    def record_file(self, source, data, filename, client, delivery_date, branch="", split_branches=False):
+        """
+        Parse one .xlsx/.csv PO and record its line items. With `split_branches`
+        the rows are attributed to the store on each row (see branch_split)
+        rather than to `branch`, when the sheet has store codes. Returns the
+        number of line items recorded.
+        """
+        rows = read_grid(data, filename)
+        totals = defaultdict(lambda: [0.0, 0])
+        parts = None
+        if split_branches:
+            try:
+                preamble, groups, _ = group_rows(rows)
+            except BranchSplitError:
+                pass  # a single-store sheet; counted under `branch` below
+            else:
+                parts = [(store.english or store.code, items_from_rows(preamble + store_rows, filename))
+                         for store, store_rows in groups.items()]
+        if parts is None:
+            parts = [(branch, items_from_rows(rows, filename))]
+        for part_branch, items in parts:
+            for key, (qty, lines) in aggregate(items, delivery_date, client, part_branch).items():
+                totals[key][0] += qty
+                totals[key][1] += lines
+        return self.record(source, totals)
+
+    def record_attachments(self, msg_id, files, client, metadata, split_branches, log):
+        """
+        record_file() for every spreadsheet of an email, given as
+        [(part_id, filename, bytes)]. Files without a line-item table are
+        logged and skipped, and so is any other failure to record one (a
+        damaged file, a locked database): they never stop the upload.
+        """
+        for part_id, filename, data in files:
+            if not filename.lower().endswith(DEMAND_EXTENSIONS):
+                continue
+            try:
+                lines = self.record_file(f"{msg_id}/{part_id}", data, filename, client,
+                                         metadata["delivery_date"], metadata.get("city") or "",
+                                         split_branches)
+            except LineItemError as e:
+                log(f"  No demand recorded for {filename}: {e}")
+            except Exception as e:
+                log(f"  No demand recorded for {filename}: {type(e).__name__}: {e}")
+            else:
+                log(f"  Recorded {lines} line items of {filename} for {metadata['delivery_date']}")
+
+    def demand_for(self, delivery_date, client=None, category=None, branch=None):
+        """Rows of `demand` for one delivery date, optionally narrowed down, sorted for picking."""
+        query = "SELECT category, product, client, branch, qty, lines FROM demand WHERE delivery_date = ?"
+        params = [delivery_date]
+        for column, value in (("client", client), ("category", category), ("branch", branch)):
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+        with self._lock:
+            return self._conn.execute(query + " ORDER BY category, product, client, branch", params).fetchall()
+
+    def picking_list(self, delivery_date):
+        """(category, product, total qty) for one delivery date, all clients and branches together."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT category, product, SUM(qty) FROM demand WHERE delivery_date = ?"
+                " GROUP BY category, product ORDER BY category, product", (delivery_date,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Show the demand recorded for a delivery date")
+    parser.add_argument("delivery_date", help="YYYY-MM-DD")
+    parser.add_argument("--db", default=DEFAULT_DEMAND_FILE, help="demand SQLite file")
+    parser.add_argument("--by-client", action="store_true",
+                        help="one line per client and branch instead of totals per product")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    store = DemandStore(args.db)
+    if args.by_client:
+        for category, product, client, branch, qty, lines in store.demand_for(args.delivery_date):
+            print(f"{category or '-'}\t{product}\t{client or '-'}\t{branch or '-'}\t{qty:g}")
+    else:
+        for category, product, qty in store.picking_list(args.delivery_date):
+            print(f"{category or '-'}\t{product}\t{qty:g}")
+    store.close()
@@ -1,58 +1,134 @@
-import re
 import base64
 import zipfile
 import io
-from datetime import datetime, timedelta
-from config_fixed import authenticate_gmail, upload_order_and_metadata
+import os
+import tempfile
+import argparse
+import threading
+import json
+import asyncio
+from dataclasses import dataclass
+from collections import deque
+from itertools import islice, chain
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from config_fixed import (get_gmail_credentials, build_gmail_service, upload_order_and_metadata,
+                          upload_order_file, build_order_metadata, MetadataWriter)
+from gmail_batch import MAX_BATCH_SIZE, batch_get_messages, batch_get_attachments, execute
+import gmail_batch
+from gmail_sync import (DEFAULT_CHECKPOINT_FILE, HistoryExpired, load_checkpoint, save_checkpoint,
+                        current_history_id, list_added_message_ids)
+from ledger import DEFAULT_LEDGER_FILE, BUNDLE_PART, ProcessedLedger, content_hash
+from dead_letter import DEFAULT_DEAD_LETTER_FILE, DeadLetterQueue
+from request_scheduler import DEFAULT_MAX_ATTEMPTS
+import supabase_http
+from supabase_async import (DEFAULT_CONCURRENCY as DEFAULT_SUPABASE_CONCURRENCY, AsyncSupabaseClient,
+                            AsyncMetadataWriter)
+import resumable_upload
+import branch_split
+from demand import DemandStore
+from zip_bundle import DEFAULT_DEFLATE_LEVEL, write_member, compression_report
+from zip_bundle import configure as zip_bundle_configure, reset_stats as zip_bundle_reset_stats
+from attachment_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES, AttachmentCache
+from client_routes import CLIENT_RULES, DEFAULT_ROUTER, EXCLUDED_SENDERS, ClientRouter, with_max_size
+from mime_parts import iter_attachments, has_attachment
+from gmail_query import build_query, shard_queries, search_senders, search_subjects
+from watch_daemon import (DEFAULT_POLL_INTERVAL, DEFAULT_SAFETY_INTERVAL, PollingSource, PubSubSource,
+                          run_daemon)
 import openpyxl
+from xlsx_reader import read_cell, XlsxFormatError
 
-def search_recent_emails(service):
-    after_ts = int((datetime.utcnow() - timedelta(hours=4)).timestamp())
-
-    parts = [
-        f"after:{after_ts}",
-        "label:inbox has:attachment",
-        "-from:me",
-        "-from:osama@khodar.com",
-        '(' + ' OR '.join([
-            'subject:"TMart Purchase Orders"',
-            'subject:"Rabbit PO - Khodar trading and marketing"',
-            'subject:"Khodar PO - Delivery Date"',
-            'subject:"Khodar.com PO - Goodsmart"',
-            'from:sherif.hossam@talabat.com',
-            'from:rabbit.purchasing@rabbitmart.com',
-            'from:abdelhamid.oraby@breadfast.com',
-            'from:amir.maher@goodsmartegypt.com'
-        ]) + ')',
-        'OR from:Mohamed.OthmanAli@halan.com',
-        'OR from:Ahmed.AdelEid@halan.com'
-    ]
-
-    # join with a single space so there are no accidental run-together tokens
-    query = " ".join(parts)
-    print("Gmail query:", query)   # debug: see what actually gets sent
-    results = service.users().messages().list(userId='me', q=query).execute()
-    return results.get('messages', [])
-
-
-def extract_order_date_from_subject(subject):
-    match = re.search(r"\[(\d{4}-\d{2}-\d{2})\]", subject)
-    if match:
-        return datetime.strptime(match.group(1), "%Y-%m-%d").date()
-    return None
-
-def get_next_delivery_date():
-    tomorrow = datetime.today() + timedelta(days=1)
-    if tomorrow.weekday() == 4:
-        return (tomorrow + timedelta(days=1)).strftime("%Y-%m-%d")
-    return tomorrow.strftime("%Y-%m-%d")
+DEFAULT_MAX_WORKERS = int(os.environ.get("FETCH_MAX_WORKERS", "4"))
+DEFAULT_SEARCH_HOURS = 4
+# messages.list returns at most 500 IDs per page
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# All that routing and the search filter need from a format='metadata' fetch
+METADATA_HEADERS = ['Subject', 'From']
+DEFAULT_METADATA_BATCH_SIZE = 50
+# Zip bundles larger than this are spooled to disk instead of kept in memory
+ZIP_SPOOL_MAX_BYTES = int(os.environ.get("ZIP_SPOOL_MAX_MB", "16")) * 1024 * 1024
+
+_thread_state = threading.local()
+_download_stats = {"inline": 0, "downloaded": 0}
+_download_stats_lock = threading.Lock()
+
+def list_message_ids(service, query, page_size=DEFAULT_PAGE_SIZE):
+    """Yield the IDs of the messages matching `query`, following nextPageToken page by page."""
+    page_token = None
+    while True:
+        results = execute(service.users().messages().list(
+            userId='me', q=query, maxResults=page_size, pageToken=page_token))
+        for message in results.get('messages', []):
+            yield message['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+def _list_shard(creds, query, page_size):
+    return list(list_message_ids(_thread_gmail_service(creds), query, page_size))
+
+def search_recent_emails(service, hours=DEFAULT_SEARCH_HOURS, page_size=DEFAULT_PAGE_SIZE,
+                         shard_creds=None, rules=CLIENT_RULES):
+    """
+    Yield the IDs of matching emails from the last `hours` hours.
+
+    Pages are requested lazily by following nextPageToken, so callers can start
+    processing the first page while later ones are still being listed. With
+    `shard_creds`, one smaller query per client rule is listed in parallel
+    instead, and the IDs are yielded shard by shard without duplicates.
+    """
+    after_ts = int((datetime.utcnow() - timedelta(hours=hours)).timestamp())
+    if shard_creds is None:
+        query = build_query(after_ts, rules)
+        print("Gmail query:", query)   # debug: see what actually gets sent
+        yield from list_message_ids(service, query, page_size)
+        return
+
+    queries = shard_queries(after_ts, rules)
+    for query in queries:
+        print("Gmail query shard:", query)
+    seen = set()
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        shards = [pool.submit(_list_shard, shard_creds, query, page_size) for query in queries]
+        # Shard order, not completion order, so the run is the same every time
+        for shard in shards:
+            for msg_id in shard.result():
+                if msg_id not in seen:
+                    seen.add(msg_id)
+                    yield msg_id
+
+
+def matches_search(msg_data, rules=CLIENT_RULES, headers_only=False):
+    """
+    Local equivalent of the search_recent_emails query, for messages found through the History API.
+    With `headers_only`, the attachment check is skipped so a format='metadata' message can be tested.
+    """
+    labels = msg_data.get("labelIds", [])
+    if "INBOX" not in labels or "SENT" in labels:
+        return False
+    payload = msg_data.get("payload", {})
+    headers = payload.get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "").lower()
+    sender = next((h["value"] for h in headers if h["name"] == "From"), "").lower()
+    if any(excluded.lower() in sender for excluded in EXCLUDED_SENDERS):
+        return False
+    if not headers_only and not has_attachment(payload):
+        return False
+    return (any(s.lower() in subject for s in search_subjects(rules))
+            or any(s.lower() in sender for s in search_senders(rules)))
 
 def determine_khateer_or_rabbit(xlsx_bytes):
     try:
-        in_memory_file = io.BytesIO(xlsx_bytes)
-        wb = openpyxl.load_workbook(in_memory_file, data_only=True)
-        ws = wb.active
-        value = str(ws["D10"].value).lower() if ws["D10"].value else ""
+        try:
+            # Streams just enough of the sheet XML to reach D10
+            value = read_cell(xlsx_bytes, "D10")
+        except XlsxFormatError:
+            in_memory_file = io.BytesIO(xlsx_bytes)
+            wb = openpyxl.load_workbook(in_memory_file, read_only=True, data_only=True)
+            value = wb.active["D10"].value
+            wb.close()
+        value = str(value).lower() if value else ""
         return "Khateer" if "khateer" in value else "Rabbit"
     except Exception as e:
         print("Failed to inspect D10 for client check:", e)
@@ -63,229 +139,907 @@ def safe_zip_filename(filename: str) -> str:
     encoded = base64.urlsafe_b64encode(filename.encode()).decode()
     return f"{encoded}.zip"
 
-def safe_xlsx_filename(filename: str) -> str:
-    encoded = base64.urlsafe_b64encode(filename.encode()).decode()
-    return f"{encoded}.xlsx"
+def _thread_gmail_service(creds):
+    # googleapiclient services share one httplib2 connection, which is not thread-safe
+    service = getattr(_thread_state, "service", None)
+    if service is None:
+        service = build_gmail_service(creds)
+        _thread_state.service = service
+    return service
 
-def fetch_and_upload_orders():
-    service = authenticate_gmail()
-    messages = search_recent_emails(service)
-    print(f"Found {len(messages)} matching emails")
+def attachment_parts(attachments, rule, log):
+    """The downloadable attachments the rule accepts; oversized ones are logged and skipped."""
+    wanted = []
+    for attachment in attachments:
+        if not attachment.downloadable:
+            continue
+        ok, reason = rule.accepts(attachment)
+        if ok:
+            wanted.append(attachment)
+        elif attachment.filename.lower().endswith(rule.extensions):
+            log(f"  Skipping {attachment.filename}: {reason}")
+    return wanted
 
-    for idx, msg in enumerate(messages, 1):
-        msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-        headers = msg_data.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-        sender = next((h["value"] for h in headers if h["name"] == "From"), "")
-        snippet = msg_data.get("snippet", "")
-
-        parts = msg_data["payload"].get("parts", [])
-        zip_buffer = io.BytesIO()
-        order_date = datetime.today().strftime("%Y-%m-%d")
-        delivery_date = get_next_delivery_date()
-        status = "Pending"
-        client = "Unknown"
-        city = None
-        po_number = None
-
-        # --- BreadFast ---
-        if subject.lower().startswith("khodar po - delivery date") or "abdelhamid.oraby@breadfast.com" in sender.lower():
-            client = "Breadfast"
-            order_date = datetime.today().strftime("%Y-%m-%d")
-
-            date_match = re.search(r"(\d{1,2}/\d{1,2}/\d{4})", subject)
-            if date_match:
-                try:
-                    delivery_date = datetime.strptime(date_match.group(1), "%d/%m/%Y").strftime("%Y-%m-%d")
-                except ValueError:
-                    delivery_date = datetime.strptime(date_match.group(1), "%m/%d/%Y").strftime("%Y-%m-%d")
-            else:
-                delivery_date = get_next_delivery_date()
+def download_attachments(service, msg_id, parts, log, cache=None):
+    """
+    Get the bytes of the given AttachmentParts, keyed by part ID.
 
-            subject_lower = subject.lower()
-            if "alex" in subject_lower:
-                city = "Alexandria"
-            elif "mansoura" in subject_lower or "mansora" in subject_lower:
-                city = "Mansoura"
-            else:
-                city_match = re.search(r"\((.*?)\)", subject)
-                if city_match:
-                    city = city_match.group(1).strip().capitalize()
-
-            for part in parts:
-                filename = part.get("filename")
-                body = part.get("body", {})
-                if filename and "attachmentId" in body and filename.lower().endswith(".pdf"):
-                    att_id = body["attachmentId"]
-                    attachment = service.users().messages().attachments().get(
-                        userId='me', messageId=msg['id'], id=att_id).execute()
-                    file_data = base64.urlsafe_b64decode(attachment['data'].encode("UTF-8"))
-
-                    try:
-                        upload_response = upload_order_and_metadata(
-                            file_bytes=file_data,
-                            filename=filename,
-                            client=client,
-                            order_type="Purchase Order",
-                            order_date=order_date,
-                            delivery_date=delivery_date,
-                            status=status,
-                            city=city,
-                            po_number=None
-                        )
-                        print(f"  Uploaded BreadFast PDF. Supabase ID: {upload_response[0].get('id')}")
-                    except Exception as e:
-                        print(f"  BreadFast Upload failed: {e}")
+    Bodies that came inline with the message are decoded on the spot and parts
+    found in the cache are read from disk; only the rest are downloaded, in as
+    few batch requests as possible.
+    """
+    files = {}
+    to_download = []
+    inline = 0
+    for part in parts:
+        if part.data is not None:
+            files[part.part_id] = part.inline_bytes()
+            inline += 1
             continue
+        data = cache.get(msg_id, part.part_id) if cache is not None else None
+        if data is None:
+            to_download.append(part)
+        else:
+            files[part.part_id] = data
+    with _download_stats_lock:
+        _download_stats["inline"] += inline
+        _download_stats["downloaded"] += len(to_download)
+    if not to_download:
+        return files
 
-        # --- GoodsMart ---
-        if "amir.maher@goodsmartegypt.com" in sender.lower() or "khodar.com po - goodsmart" in subject.lower():
-            client = "GoodsMart"
-            order_date = datetime.today().strftime("%Y-%m-%d")
-            status = "Pending"
-
-            # Extract delivery date
-            delivery_match = re.search(r"Expected Delivery Date:\s*(\d{1,2}/\d{1,2}/\d{4})", snippet)
-            if delivery_match:
-                delivery_date = datetime.strptime(delivery_match.group(1), "%d/%m/%Y").strftime("%Y-%m-%d")
-
-            # Extract PO Number
-            po_match = re.search(r"PO No\s*(\d+)", snippet)
-            if po_match:
-                po_number = po_match.group(1)
-
-            for part in parts:
-                filename = part.get("filename")
-                body = part.get("body", {})
-                if filename and "attachmentId" in body and filename.lower().endswith(".xlsx"):
-                    att_id = body["attachmentId"]
-                    attachment = service.users().messages().attachments().get(
-                        userId='me', messageId=msg['id'], id=att_id).execute()
-                    file_data = base64.urlsafe_b64decode(attachment['data'].encode("UTF-8"))
-
-                    try:
-                        upload_response = upload_order_and_metadata(
-                            file_bytes=file_data,
-                            filename=filename,
-                            client=client,
-                            order_type="Purchase Order",
-                            order_date=order_date,
-                            delivery_date=delivery_date,
-                            status=status,
-                            city=None,
-                            po_number=po_number
-                        )
-                        print(f"  Uploaded GoodsMart file. Supabase ID: {upload_response[0].get('id')}")
-                    except Exception as e:
-                        print(f"  GoodsMart upload failed: {e}")
-            continue
-        
-                # --- Halan ---
-        if "طلبيه الخضار شركة خضار دوت كوم -حالا" in subject or "Mohamed.OthmanAli@halan.com" in sender or 'Ahmed.AdelEid@halan.com' in sender:
-            client = "Halan"
-            order_date = datetime.today().strftime("%Y-%m-%d")
-            status = "Pending"
-
-            # Compute next delivery date (nearest Saturday or Wednesday)
-            today = datetime.today()
-            weekday = today.weekday()  # Monday = 0, Sunday = 6
-
-            if weekday in [5, 6, 0, 1]:  # Saturday, Sunday, Monday, Tuesday
-                days_until_wed = (2 - weekday) % 7 or 7
-                delivery_date = (today + timedelta(days=days_until_wed)).strftime("%Y-%m-%d")
-            else:  # Wednesday, Thursday, Friday
-                days_until_sat = (5 - weekday) % 7 or 7
-                delivery_date = (today + timedelta(days=days_until_sat)).strftime("%Y-%m-%d")
-
-
-            # Extract PO Number from body/snippet between 'مدينه نصر' and 'حدايق الاهرام'
-            po_number = None
-            body_text = snippet.replace("\n", " ")
-            match = re.search(r"مدينه نصر(.*?)حدايق الاهرام", body_text)
-            if match:
-                po_number = match.group(1).strip()
-
-            for part in parts:
-                filename = part.get("filename")
-                body = part.get("body", {})
-                if filename and "attachmentId" in body and filename.lower().endswith(".xlsx"):
-                    att_id = body["attachmentId"]
-                    attachment = service.users().messages().attachments().get(
-                        userId='me', messageId=msg['id'], id=att_id).execute()
-                    file_data = base64.urlsafe_b64decode(attachment['data'].encode("UTF-8"))
-                    filename = safe_xlsx_filename(filename)
-                    try:
-                        upload_response = upload_order_and_metadata(
-                            file_bytes=file_data,
-                            filename=filename,
-                            client=client,
-                            order_type="Purchase Order",
-                            order_date=order_date,
-                            delivery_date=delivery_date,
-                            status=status,
-                            city=None,
-                            po_number=po_number
-                        )
-                        print(f"  Uploaded Halan file. Supabase ID: {upload_response[0].get('id')}")
-                    except Exception as e:
-                        print(f"  Halan upload failed: {e}")
-            continue
-        
-
-        # --- General (Rabbit / Khateer / Talabat) ---
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for part in parts:
-                filename = part.get("filename")
-                body = part.get("body", {})
-                if filename and "attachmentId" in body:
-                    if not any(filename.lower().endswith(ext) for ext in ['.pdf', '.xls', '.xlsx', '.csv', '.zip']):
-                        continue
-                    att_id = body["attachmentId"]
-                    attachment = service.users().messages().attachments().get(
-                        userId='me', messageId=msg['id'], id=att_id).execute()
-                    file_data = base64.urlsafe_b64decode(attachment['data'].encode("UTF-8"))
-                    zipf.writestr(filename, file_data)
-
-                    if filename.lower().endswith(".xlsx") and client == "Unknown":
-                        client = determine_khateer_or_rabbit(file_data)
-
-        zip_buffer.seek(0)
-        zip_filename = f"{filename}.zip"
-        zip_filename = safe_zip_filename(filename)
-        zip_filename = client + zip_filename
-
-        if subject.lower().startswith("tmart purchase orders") or "sherif.hossam@talabat.com" in sender.lower():
-            match = extract_order_date_from_subject(subject)
-            if not match:
-                print(f"No valid date in subject for email {idx}, using today's date instead.")
-                match = datetime.today()
-            order_date = match.strftime("%Y-%m-%d")
-            delivery_date = (match + timedelta(days=2)).strftime("%Y-%m-%d")
-            client = "Talabat"
-
-        print(f"\nProcessing email {idx}")
-        print(f"  Subject: {subject}")
-        print(f"  From: {sender}")
-        print(f"  Order Date: {order_date}")
-        print(f"  Delivery Date: {delivery_date}")
-        print(f"  Client: {client}")
+    refs = [(part.attachment_id, part.size) for part in to_download]
+    downloaded, errors = batch_get_attachments(service, msg_id, refs)
+    for att_id, error in errors.items():
+        log(f"  Attachment download failed ({att_id}): {error}")
+    for part in to_download:
+        data = downloaded.get(part.attachment_id)
+        if data is not None:
+            files[part.part_id] = data
+            if cache is not None:
+                cache.put(msg_id, part.part_id, data)
+    return files
+
+def _reset_run_stats(cache):
+    """
+    Zero the counters behind the end-of-run reports. They live as long as the
+    process, so without this every --watch cycle would report running totals.
+    """
+    with _download_stats_lock:
+        for key in _download_stats:
+            _download_stats[key] = 0
+    zip_bundle_reset_stats()
+    resumable_upload.reset_stats()
+    gmail_batch.SCHEDULER.reset_stats()
+    supabase_http.SCHEDULER.reset_stats()
+    supabase_http.reset_connection_stats()
+    if cache is not None:
+        cache.reset_stats()
+
+def download_report():
+    with _download_stats_lock:
+        stats = dict(_download_stats)
+    return (f"Attachments: {stats['downloaded']} requested from Gmail, {stats['inline']} read from the "
+            f"message payload ({stats['inline']} attachments.get calls avoided)")
+
+def pending_parts(ledger, msg_id, parts):
+    """Drop the parts this message already uploaded in an earlier run."""
+    if ledger is None:
+        return parts
+    return [part for part in parts if not ledger.is_uploaded(msg_id, part.part_id)]
+
+class MessageProgress:
+    """
+    Marks an email done in the ledger once it finished processing and every
+    metadata row queued for it (see MetadataWriter) has been inserted. If any
+    of that failed, the email goes to the dead-letter queue instead.
+    """
+
+    def __init__(self, ledger, msg_id, dead_letter=None):
+        self.ledger = ledger
+        self.msg_id = msg_id
+        self.dead_letter = dead_letter
+        self.client = None
+        self.outstanding = 0
+        self.finished = False
+        self.failed = False
+        self.error = None
+        self._lock = threading.Lock()
+
+    def failure(self, error):
+        """Remember why the email failed, for the dead-letter entry."""
+        with self._lock:
+            self.error = error
+
+    def queued(self):
+        with self._lock:
+            self.outstanding += 1
 
+    def landed(self, error=None):
+        with self._lock:
+            self.outstanding -= 1
+            if error is not None:
+                self.failed = True
+                self.error = error
+            self._mark_if_done()
+
+    def finish(self, client, ok):
+        with self._lock:
+            self.client = client
+            self.finished = True
+            self.failed = self.failed or not ok
+            self._mark_if_done()
+
+    def _mark_if_done(self):
+        if not self.finished or self.outstanding:
+            return
+        if self.failed:
+            if self.dead_letter is not None:
+                self.dead_letter.add(self.msg_id, self.error or "not every attachment was uploaded")
+        elif self.ledger is not None:
+            self.ledger.mark_message_done(self.msg_id, self.client)
+
+def process_message(service, msg_id, idx, msg_data=None, ledger=None, cache=None, writer=None,
+                    router=DEFAULT_ROUTER, dead_letter=None, demand=None, insert_log=None):
+    """
+    Fetch one email, download its attachments and upload them. Returns the log lines.
+    Pass msg_data when the full message was already fetched (e.g. in a batch).
+    With a ledger, uploads are recorded and the message is marked done once all of them succeeded.
+    With a cache, attachments are read from and saved to it.
+    With a writer, purchase_orders rows are queued on it instead of inserted one by one,
+    and their outcome is kept in insert_log (an InsertLog) to be printed after the flush.
+    The router decides which client the email belongs to and how it is uploaded.
+    With a dead_letter queue, emails that fail are added to it for the next run.
+    With a demand store, the line items of spreadsheet attachments are added to it.
+    """
+    log_lines = []
+    progress = MessageProgress(ledger, msg_id, dead_letter)
+    try:
+        client, ok = _process_message(service, msg_id, idx, msg_data, ledger, cache, writer, progress,
+                                      log_lines.append, router, demand, insert_log)
+    except Exception as e:
+        progress.failure(e)
+        progress.finish(None, False)
+        raise
+    progress.finish(client, ok)
+    return log_lines
+
+@dataclass
+class PlannedUpload:
+    """One file (or bundle) of an email that is ready to go to Supabase."""
+    part_id: str
+    data: object
+    filename: str
+    done_message: str
+    failed_message: str
+    metadata: dict
+
+    def close(self):
+        # spooled zip bundles hold a temp file until they are uploaded
+        if hasattr(self.data, "close"):
+            self.data.close()
+
+def plan_message(service, msg_id, idx, msg_data, ledger, cache, router, log, demand=None):
+    """
+    Fetch (if needed), route and download one email, and build what has to be uploaded.
+    Returns (client, whether every download succeeded, [PlannedUpload]).
+    """
+    if msg_data is None:
+        msg_data = execute(service.users().messages().get(userId='me', id=msg_id, format='full'))
+    headers = msg_data.get("payload", {}).get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
+    sender = next((h["value"] for h in headers if h["name"] == "From"), "")
+    snippet = msg_data.get("snippet", "")
+
+    attachments = list(iter_attachments(msg_data["payload"]))
+    rule = router.route(subject, sender)
+    order = rule.details(subject, snippet, log)
+    metadata = dict(order, order_type="Purchase Order", status="Pending")
+
+    if rule.bundle:
+        return _plan_bundle(service, msg_id, idx, attachments, subject, sender, rule, metadata,
+                            ledger, cache, log, demand, _zip_date_time(msg_data))
+
+    wanted = pending_parts(ledger, msg_id, attachment_parts(attachments, rule, log))
+    files = download_attachments(service, msg_id, wanted, log, cache)
+    if demand is not None:
+        demand.record_attachments(msg_id, [(part.part_id, part.filename, files[part.part_id])
+                                           for part in wanted if part.part_id in files],
+                                  rule.client, metadata, rule.split_branches, log)
+    uploads = []
+    for part in wanted:
+        if part.part_id in files:
+            filename = rule.rename(part.filename) if rule.rename else part.filename
+            uploads.append(PlannedUpload(
+                part.part_id, files[part.part_id], filename,
+                f"Uploaded {rule.label}", f"{rule.client} upload failed",
+                dict(metadata, client=rule.client),
+            ))
+    return rule.client, len(files) == len(wanted), uploads
+
+class InsertLog:
+    """
+    Outcome of every purchase_orders row queued on a metadata writer.
+
+    The writer reports rows from whichever thread happens to flush a batch,
+    so the lines are collected here and printed in email order once the run's
+    rows are all in, like the rest of the output.
+    """
+
+    def __init__(self):
+        self._lines = []
+        self._lock = threading.Lock()
+
+    def add(self, idx, position, line):
+        with self._lock:
+            self._lines.append((idx, position, line))
+
+    def print(self):
+        with self._lock:
+            lines, self._lines = sorted(self._lines), []
+        for _, _, line in lines:
+            print(line)
+
+def _inserted_callback(msg_id, idx, position, item, digest, ledger, progress, insert_log):
+    """callback(row, error) for the purchase_orders row of upload number `position` of an email."""
+    def inserted(row, error):
+        if error is not None:
+            line = f"  Email {idx}: metadata insert for {item.filename} failed: {error}"
+        else:
+            line = f"  Email {idx}: {item.filename} -> Supabase ID: {row.get('id')}"
+            if ledger is not None:
+                ledger.record_upload(msg_id, item.part_id, digest, item.filename, row.get('id'))
+        if insert_log is None:
+            print(line)
+        else:
+            insert_log.add(idx, position, line)
+        progress.landed(error)
+    return inserted
+
+def _process_message(service, msg_id, idx, msg_data, ledger, cache, writer, progress, log, router,
+                     demand=None, insert_log=None):
+    """Returns (client, whether every download and upload succeeded)."""
+    client, ok, uploads = plan_message(service, msg_id, idx, msg_data, ledger, cache, router, log, demand)
+
+    for position, item in enumerate(uploads):
+        digest = content_hash(item.data)
         try:
-            upload_response = upload_order_and_metadata(
-                file_bytes=zip_buffer.read(),
-                filename=zip_filename,
-                client=client,
-                order_type="Purchase Order",
-                order_date=order_date,
-                delivery_date=delivery_date,
-                status=status,
-                city=city,
-                po_number=po_number
-            )
-            print(f"  Uploaded successfully. Supabase ID: {upload_response[0].get('id')}")
+            if writer is None:
+                upload_response = upload_order_and_metadata(file_bytes=item.data, filename=item.filename,
+                                                            **item.metadata)
+                log(f"  {item.done_message}. Supabase ID: {upload_response[0].get('id')}")
+                if ledger is not None:
+                    ledger.record_upload(msg_id, item.part_id, digest, item.filename, upload_response[0].get('id'))
+            else:
+                upload_order_file(item.data, item.filename)
+                log(f"  {item.done_message}, metadata queued")
+                progress.queued()
+                writer.add(build_order_metadata(item.filename, **item.metadata),
+                           _inserted_callback(msg_id, idx, position, item, digest, ledger, progress,
+                                              insert_log))
         except Exception as e:
-            print(f"  Upload failed: {e}")
+            log(f"  {item.failed_message}: {e}")
+            progress.failure(e)
+            ok = False
+        finally:
+            item.close()
+    return client, ok
 
-if __name__ == '__main__':
-    fetch_and_upload_orders()
+def _zip_date_time(msg_data):
+    """When Gmail received the message, as a zip member timestamp (None if unknown)."""
+    if "internalDate" not in msg_data:
+        return None
+    received = datetime.fromtimestamp(int(msg_data["internalDate"]) / 1000, timezone.utc)
+    return max(received.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+def _plan_bundle(service, msg_id, idx, attachments, subject, sender, rule, metadata, ledger, cache, log,
+                 demand=None, date_time=None):
+    """
+    Zip all accepted attachments of the email into one upload, plus one upload per store
+    when the rule splits branches. Returns (client, ok, [PlannedUpload]).
+    """
+    client = "Unknown"
+    splitting = rule.split_branches and branch_split.enabled()
+    bundle_done = ledger is not None and ledger.is_uploaded(msg_id, BUNDLE_PART)
+    if bundle_done and not splitting:
+        log(f"\nEmail {idx} was already uploaded as a bundle, skipping")
+        return rule.client or client, True, []
+    wanted = attachment_parts(attachments, rule, log)
+    files = download_attachments(service, msg_id, wanted, log, cache)
+    if len(files) < len(wanted):
+        # Don't upload an incomplete bundle, the next run will try the whole email again
+        log(f"\nSkipping email {idx}: not all attachments could be downloaded")
+        return rule.client or client, False, []
+
+    # The archive stays in memory while small and moves to a temp file on disk past
+    # ZIP_SPOOL_MAX_BYTES; it is then streamed to storage instead of copied into bytes.
+    # Kept aside before the loop below pops the attachments out of `files`
+    demand_files = []
+    if demand is not None:
+        demand_files = [(part.part_id, part.filename, files[part.part_id])
+                        for part in attachments if part.part_id in files]
+    branch_files = []
+    if splitting:
+        branch_files = branch_split.split_bundle_files(
+            [(part.filename, files[part.part_id]) for part in attachments if part.part_id in files], log)
+
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES)
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+        filename = ""
+        for part in attachments:
+            filename = part.filename
+            if part.part_id in files:
+                # pop so each attachment can be freed as soon as it is in the archive
+                file_data = files.pop(part.part_id)
+                write_member(zipf, filename, file_data, date_time)
+
+                if filename.lower().endswith(".xlsx") and client == "Unknown":
+                    client = determine_khateer_or_rabbit(file_data)
 
+    zip_buffer.seek(0)
+    # The stored name keeps the Rabbit/Khateer prefix even for Talabat bundles, and is
+    # built from the last file in the email whether or not it went into the bundle
+    zip_filename = client + safe_zip_filename(filename)
+    client = rule.client or client
+
+    log(f"\nProcessing email {idx}")
+    log(f"  Subject: {subject}")
+    log(f"  From: {sender}")
+    log(f"  Order Date: {metadata['order_date']}")
+    log(f"  Delivery Date: {metadata['delivery_date']}")
+    log(f"  Client: {client}")
+    if demand_files:
+        demand.record_attachments(msg_id, demand_files, client, metadata, rule.split_branches, log)
+
+    uploads = []
+    if bundle_done:
+        log("  Bundle already uploaded, uploading the missing branch files")
+        zip_buffer.close()
+    else:
+        uploads.append(PlannedUpload(BUNDLE_PART, zip_buffer, zip_filename, "Uploaded successfully",
+                                     "Upload failed", dict(metadata, client=client)))
+    # Each store's order is its own object and purchase_orders row, in a folder next to the bundle
+    for object_name, (_, branch_data, branch) in zip(branch_split.object_names(zip_filename, branch_files),
+                                                     branch_files):
+        part_id = f"{BUNDLE_PART}/{object_name.rsplit('/', 1)[1]}"
+        if ledger is not None and ledger.is_uploaded(msg_id, part_id):
+            continue
+        store = branch.english or branch.code
+        uploads.append(PlannedUpload(part_id, branch_data, object_name, f"Uploaded the {store} file",
+                                     f"{store} file upload failed", dict(metadata, client=client, city=store)))
+    return client, True, uploads
+
+def _process_message_logged(service, msg_id, idx, msg_data=None, **options):
+    """process_message, with a failure turned into a log line so one bad email doesn't stop the run."""
+    try:
+        return process_message(service, msg_id, idx, msg_data, **options)
+    except Exception as e:
+        return [f"\nProcessing email {idx} failed: {e}"]
+
+def _process_message_safely(creds, msg_id, idx, msg_data=None, **options):
+    return _process_message_logged(_thread_gmail_service(creds), msg_id, idx, msg_data, **options)
+
+def _print_log(log_lines):
+    if log_lines:
+        print("\n".join(log_lines))
+
+def _fetch_full(service, chunk, batch_size, keep, stats, dead_letter=None):
+    """Fetch full messages for one chunk. Returns [(msg_id, msg_data or None)], dropping what `keep` rejects."""
+    fetched, errors = batch_get_messages(service, chunk, batch_size=batch_size)
+    for msg_id, error in errors.items():
+        print(f"Batch fetch failed for message {msg_id}, retrying it on its own: {error}")
+    stats["full"] += len(fetched)
+    stats["full_bytes"] += sum(_json_size(msg) for msg in fetched.values())
+    jobs = []
+    for msg_id in chunk:
+        msg_data = fetched.get(msg_id)
+        if keep is not None:
+            if msg_data is None:
+                try:
+                    msg_data = execute(service.users().messages().get(userId='me', id=msg_id, format='full'))
+                except Exception as e:
+                    print(f"Skipping message {msg_id}: {e}")
+                    if dead_letter is not None:
+                        dead_letter.add(msg_id, e)
+                    continue
+            if not keep(msg_data):
+                continue
+        jobs.append((msg_id, msg_data))
+    return jobs
+
+def _needs_full_fetch(msg_id, metadata, keep, ledger, router):
+    """Phase one of a metadata-first fetch: can this message be dropped on its headers alone?"""
+    if metadata is None:
+        return True  # couldn't classify it, let the full fetch decide
+    if keep is not None and not keep(metadata, headers_only=True):
+        return False
+    if ledger is not None:
+        headers = metadata.get("payload", {}).get("headers", [])
+        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
+        sender = next((h["value"] for h in headers if h["name"] == "From"), "")
+        if router.route(subject, sender).bundle and ledger.is_uploaded(msg_id, BUNDLE_PART):
+            return False
+    return True
+
+def _json_size(msg_data):
+    # Rough size of the response body, enough to compare the two fetch modes
+    return len(json.dumps(msg_data))
+
+def _unique(msg_ids):
+    seen = set()
+    for msg_id in msg_ids:
+        if msg_id not in seen:
+            seen.add(msg_id)
+            yield msg_id
+
+def _prefetched_jobs(service, msg_ids, batch_size, keep=None, ledger=None, metadata_first=False,
+                     router=DEFAULT_ROUTER, stats=None, dead_letter=None):
+    """
+    Yield (msg_id, idx, msg_data), fetching full messages one batch request at a time.
+    When `keep` is given, only the messages it accepts are yielded and numbered.
+    Messages the ledger has marked done are dropped before anything is fetched.
+
+    With `metadata_first`, each chunk is first fetched with format='metadata'
+    (Subject and From only) and messages that can be ruled out on their headers
+    are dropped before the full payloads are requested.
+    """
+    if stats is None:
+        stats = {}
+    for key in ("metadata", "metadata_bytes", "dropped", "full", "full_bytes"):
+        stats.setdefault(key, 0)
+    msg_ids = iter(msg_ids)
+    idx = 0
+    while True:
+        chunk = list(islice(msg_ids, batch_size))
+        if not chunk:
+            break
+        if ledger is not None:
+            new_ids = [msg_id for msg_id in chunk if not ledger.is_message_done(msg_id)]
+            if len(new_ids) < len(chunk):
+                print(f"Skipping {len(chunk) - len(new_ids)} already processed emails")
+            chunk = new_ids
+            if not chunk:
+                continue
+        if metadata_first:
+            metadata, _ = batch_get_messages(service, chunk, fmt='metadata', batch_size=batch_size,
+                                             metadata_headers=METADATA_HEADERS)
+            stats["metadata"] += len(metadata)
+            stats["metadata_bytes"] += sum(_json_size(msg) for msg in metadata.values())
+            wanted = [msg_id for msg_id in chunk
+                      if _needs_full_fetch(msg_id, metadata.get(msg_id), keep, ledger, router)]
+            stats["dropped"] += len(chunk) - len(wanted)
+            chunk = wanted
+            if not chunk:
+                continue
+        for msg_id, msg_data in _fetch_full(service, chunk, batch_size, keep, stats, dead_letter):
+            idx += 1
+            yield msg_id, idx, msg_data
+
+def fetch_report(stats):
+    line = f"Message fetch: {stats['full']} full payloads ({stats['full_bytes'] / 1024:.1f} KB)"
+    if stats["metadata"]:
+        line += (f", {stats['metadata']} metadata-only ({stats['metadata_bytes'] / 1024:.1f} KB), "
+                 f"{stats['dropped']} dropped on headers alone")
+    return line
+
+def _incremental_message_ids(service, checkpoint_path, hours, page_size, shard_creds=None):
+    """
+    Work out what an incremental run has to process.
+
+    Returns (message IDs, historyId to checkpoint after the run, filter for the
+    messages or None). Uses the History API when the checkpoint is still valid,
+    otherwise falls back to the query-based scan.
+    """
+    start_history_id = load_checkpoint(checkpoint_path)
+    if start_history_id:
+        try:
+            msg_ids, latest_history_id = list_added_message_ids(service, start_history_id)
+            print(f"Incremental sync from historyId {start_history_id}: {len(msg_ids)} new inbox messages")
+            # History returns every new inbox message, not only the ones the search query would match
+            return msg_ids, latest_history_id, matches_search
+        except HistoryExpired as e:
+            print(f"{e}, falling back to a full scan")
+    else:
+        print("No sync checkpoint found, running a full scan")
+
+    # Read the history ID before scanning so mail arriving during the scan is picked up next run
+    latest_history_id = current_history_id(service)
+    msg_ids = search_recent_emails(service, hours=hours, page_size=page_size, shard_creds=shard_creds)
+    return msg_ids, latest_history_id, None
+
+def _message_jobs(service, creds, batch_size, hours, page_size, incremental, checkpoint_path, ledger,
+                  router, shard, metadata_first, dead_letter, fetch_stats):
+    """The (msg_id, idx, msg_data) jobs of a run and the historyId to checkpoint afterwards (or None)."""
+    shard_creds = creds if shard else None
+    latest_history_id = None
+    if incremental:
+        msg_ids, latest_history_id, keep = _incremental_message_ids(service, checkpoint_path, hours, page_size,
+                                                                    shard_creds)
+    else:
+        msg_ids = search_recent_emails(service, hours=hours, page_size=page_size, shard_creds=shard_creds)
+        keep = None
+    if dead_letter is not None:
+        retry_ids = dead_letter.drain()
+        if retry_ids:
+            print(f"Retrying {len(retry_ids)} emails from the dead-letter file first")
+            msg_ids = _unique(chain(retry_ids, msg_ids))
+    jobs = _prefetched_jobs(service, msg_ids, batch_size, keep, ledger, metadata_first, router, fetch_stats,
+                            dead_letter)
+    return jobs, latest_history_id
+
+def _finish_run(total, writer, cache, fetch_stats, dead_letter, latest_history_id, checkpoint_path,
+                supabase_report, completed=True, supabase_scheduler=True):
+    """
+    Print the run's reports and save the dead-letter file and the sync checkpoint.
+    A run that stopped early (completed False) keeps the dead-letter entries it
+    had not got through and leaves the checkpoint where it was, so the next run
+    looks at the same mail again. supabase_scheduler False leaves out
+    supabase_http's request counts, which the async engine's own report
+    (supabase_report) stands in for.
+    """
+    if not completed:
+        print("The run stopped early")
+    print(f"Processed {total} matching emails")
+    print(fetch_report(fetch_stats))
+    print(download_report())
+    if writer is not None:
+        print(f"Inserted {writer.rows_inserted} purchase_orders rows in {writer.batches} batch requests")
+    if cache is not None:
+        print(cache.report())
+    print(compression_report())
+    print(resumable_upload.resumable_report())
+    print(supabase_report)
+    print(gmail_batch.SCHEDULER.report())
+    if supabase_scheduler:
+        print(supabase_http.SCHEDULER.report())
+    if dead_letter is not None:
+        left = dead_letter.save(keep_drained=not completed)
+        print(f"{left} failed emails left in {dead_letter.path} for the next run")
+
+    if latest_history_id is not None and completed:
+        save_checkpoint(latest_history_id, checkpoint_path)
+        print(f"Saved sync checkpoint at historyId {latest_history_id}")
+
+def fetch_and_upload_orders(max_workers=DEFAULT_MAX_WORKERS, batch_size=MAX_BATCH_SIZE,
+                            hours=DEFAULT_SEARCH_HOURS, page_size=DEFAULT_PAGE_SIZE,
+                            incremental=False, checkpoint_path=DEFAULT_CHECKPOINT_FILE,
+                            ledger=None, cache=None, metadata_batch_size=DEFAULT_METADATA_BATCH_SIZE,
+                            router=DEFAULT_ROUTER, shard=False, metadata_first=False, dead_letter=None,
+                            creds=None, service=None, pool=None, demand=None):
+    # The watch daemon passes in the clients and worker threads it keeps between runs
+    creds = creds or get_gmail_credentials()
+    service = service or build_gmail_service(creds)
+    _reset_run_stats(cache)
+    fetch_stats = {}
+    jobs, latest_history_id = _message_jobs(service, creds, batch_size, hours, page_size, incremental,
+                                            checkpoint_path, ledger, router, shard, metadata_first,
+                                            dead_letter, fetch_stats)
+    writer = MetadataWriter(metadata_batch_size) if metadata_batch_size > 1 else None
+    insert_log = InsertLog()
+
+    total = 0
+    completed = False
+    try:
+        if max_workers <= 1:
+            for job in jobs:
+                _print_log(_process_message_logged(service, *job, ledger=ledger, cache=cache, writer=writer,
+                                                   router=router, dead_letter=dead_letter, demand=demand,
+                                                   insert_log=insert_log))
+                total += 1
+        else:
+            # The next page/batch of messages is listed and fetched while workers download
+            # and upload the previous one. Results are printed in submission order so the
+            # output reads the same as a sequential run, and at most a couple of batches
+            # are kept in flight so memory stays flat however large the backlog is.
+            max_in_flight = max(2 * batch_size, max_workers)
+            in_flight = deque()
+            owns_pool = pool is None
+            pool = pool or ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                for job in jobs:
+                    in_flight.append(pool.submit(_process_message_safely, creds, *job, ledger=ledger,
+                                                 cache=cache, writer=writer, router=router,
+                                                 dead_letter=dead_letter, demand=demand,
+                                                 insert_log=insert_log))
+                    total += 1
+                    while in_flight and (in_flight[0].done() or len(in_flight) > max_in_flight):
+                        _print_log(in_flight.popleft().result())
+                while in_flight:
+                    _print_log(in_flight.popleft().result())
+            finally:
+                # Let the emails already submitted finish queueing their rows before the flush below
+                if owns_pool:
+                    pool.shutdown()
+                else:
+                    wait(in_flight)
+        completed = True
+    finally:
+        # Even if listing or fetching failed (or the run was interrupted), the files already
+        # in Storage get their rows; otherwise the ledger never learns they were uploaded
+        try:
+            if writer is not None:
+                writer.flush()
+                insert_log.print()
+        finally:
+            _finish_run(total, writer, cache, fetch_stats, dead_letter, latest_history_id, checkpoint_path,
+                        supabase_http.connection_report(), completed)
+
+def watch_and_upload_orders(options, dead_letter_path, topic=None, subscription=None,
+                            poll_interval=DEFAULT_POLL_INTERVAL, safety_interval=DEFAULT_SAFETY_INTERVAL,
+                            source=None, stop_event=None):
+    """
+    Run fetch_and_upload_orders incrementally every time new mail arrives.
+
+    Credentials, the Gmail client, the worker threads (with their own Gmail
+    clients) and the Supabase session are created once and reused, so a new
+    order is uploaded seconds after Gmail reports it instead of waiting for
+    the next scheduled run. Notifications come from Gmail push through Pub/Sub
+    when a topic and subscription are given, from `source` if one is passed
+    (e.g. a watch_daemon.LocalQueueSource), and otherwise from polling.
+    """
+    creds = get_gmail_credentials()
+    service = build_gmail_service(creds)
+    if source is None:
+        if topic and subscription:
+            source = PubSubSource(service, topic, subscription)
+        else:
+            print(f"No Pub/Sub subscription given, checking for new mail every {poll_interval:g}s")
+            source = PollingSource(poll_interval)
+    options = dict(options, incremental=True, creds=creds, service=service)
+    options.pop("dead_letter", None)
+    max_workers = options.get("max_workers", DEFAULT_MAX_WORKERS)
+
+    def run_cycle():
+        # A fresh queue each time, so emails that went through since are not written back
+        fetch_and_upload_orders(dead_letter=DeadLetterQueue(dead_letter_path), **options)
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+        options["pool"] = pool if max_workers > 1 else None
+        run_daemon(source, run_cycle, safety_interval, stop_event)
+
+def _plan_in_thread(creds, msg_id, idx, msg_data, ledger, cache, router, log, demand):
+    return plan_message(_thread_gmail_service(creds), msg_id, idx, msg_data, ledger, cache, router, log,
+                        demand)
+
+async def _upload_async(loop, item, position, msg_id, idx, client, writer, ledger, progress, log, insert_log):
+    """Upload one PlannedUpload and its purchase_orders row. Returns True on success."""
+    try:
+        digest = await loop.run_in_executor(None, content_hash, item.data)
+        if resumable_upload.should_resume(item.data):
+            await loop.run_in_executor(None, resumable_upload.upload, client.url, client.key, "orders",
+                                       item.filename, item.data)
+        else:
+            await client.upload_file(item.data, item.filename)
+        row = build_order_metadata(item.filename, **item.metadata)
+        if writer is None:
+            inserted = (await client.insert_rows([row]))[0]
+            log(f"  {item.done_message}. Supabase ID: {inserted.get('id')}")
+            if ledger is not None:
+                ledger.record_upload(msg_id, item.part_id, digest, item.filename, inserted.get('id'))
+        else:
+            log(f"  {item.done_message}, metadata queued")
+            progress.queued()
+            callback = _inserted_callback(msg_id, idx, position, item, digest, ledger, progress, insert_log)
+
+            def row_done(future):
+                if future.cancelled():
+                    callback(None, Exception("metadata insert cancelled"))
+                    return
+                error = future.exception()
+                callback(None if error is not None else future.result(), error)
+
+            # Not awaited: the row may sit in the writer's buffer until the end-of-run flush
+            writer.add(row).add_done_callback(row_done)
+        return True
+    except Exception as e:
+        log(f"  {item.failed_message}: {e}")
+        progress.failure(e)
+        return False
+    finally:
+        item.close()
+
+async def _process_message_async(loop, gmail_pool, creds, msg_id, idx, msg_data, client, writer, ledger,
+                                 cache, router, dead_letter, demand=None, insert_log=None):
+    """
+    The asyncio version of process_message: the Gmail side (fetch, download,
+    zip) runs on the Gmail thread pool, the uploads on the event loop.
+    """
+    log_lines = []
+    progress = MessageProgress(ledger, msg_id, dead_letter)
+    try:
+        client_name, ok, uploads = await loop.run_in_executor(
+            gmail_pool, _plan_in_thread, creds, msg_id, idx, msg_data, ledger, cache, router, log_lines.append,
+            demand)
+    except Exception as e:
+        progress.failure(e)
+        progress.finish(None, False)
+        return log_lines + [f"\nProcessing email {idx} failed: {e}"]
+    results = await asyncio.gather(*(
+        _upload_async(loop, item, position, msg_id, idx, client, writer, ledger, progress, log_lines.append,
+                      insert_log)
+        for position, item in enumerate(uploads)))
+    progress.finish(client_name, ok and all(results))
+    return log_lines
+
+async def fetch_and_upload_orders_async(max_workers=DEFAULT_MAX_WORKERS, batch_size=MAX_BATCH_SIZE,
+                                        hours=DEFAULT_SEARCH_HOURS, page_size=DEFAULT_PAGE_SIZE,
+                                        incremental=False, checkpoint_path=DEFAULT_CHECKPOINT_FILE,
+                                        ledger=None, cache=None,
+                                        metadata_batch_size=DEFAULT_METADATA_BATCH_SIZE,
+                                        router=DEFAULT_ROUTER, shard=False, metadata_first=False,
+                                        dead_letter=None, supabase_concurrency=DEFAULT_SUPABASE_CONCURRENCY,
+                                        demand=None):
+    """
+    Same run as fetch_and_upload_orders, with Supabase traffic on asyncio.
+
+    Gmail calls stay on threads (googleapiclient is blocking): one thread lists
+    and batch-fetches messages, `max_workers` threads download and zip. Uploads
+    and inserts go through aiohttp with up to `supabase_concurrency` requests in
+    flight, so many emails can be uploading at once without a thread each.
+    """
+    loop = asyncio.get_running_loop()
+    creds = await loop.run_in_executor(None, get_gmail_credentials)
+    # The listing generator and its service are only ever touched from this one thread
+    list_pool = ThreadPoolExecutor(max_workers=1)
+    gmail_pool = ThreadPoolExecutor(max_workers=max_workers)
+    service = await loop.run_in_executor(list_pool, build_gmail_service, creds)
+    _reset_run_stats(cache)
+    fetch_stats = {}
+    jobs, latest_history_id = await loop.run_in_executor(
+        list_pool, _message_jobs, service, creds, batch_size, hours, page_size, incremental, checkpoint_path,
+        ledger, router, shard, metadata_first, dead_letter, fetch_stats)
+
+    total = 0
+    completed = False
+    async with AsyncSupabaseClient.from_env(concurrency=supabase_concurrency) as client:
+        writer = AsyncMetadataWriter(client, metadata_batch_size) if metadata_batch_size > 1 else None
+        insert_log = InsertLog()
+        # Printed in submission order like the threaded engine, with a bound on how
+        # many emails (and their attachments) are held in memory at once
+        max_in_flight = max(2 * batch_size, max_workers, supabase_concurrency)
+        in_flight = deque()
+        try:
+            while True:
+                job = await loop.run_in_executor(list_pool, next, jobs, None)
+                if job is None:
+                    break
+                in_flight.append(asyncio.ensure_future(_process_message_async(
+                    loop, gmail_pool, creds, *job, client, writer, ledger, cache, router, dead_letter,
+                    demand, insert_log)))
+                total += 1
+                while in_flight and (in_flight[0].done() or len(in_flight) > max_in_flight):
+                    _print_log(await in_flight.popleft())
+            while in_flight:
+                _print_log(await in_flight.popleft())
+            completed = True
+        finally:
+            # As in the threaded engine: rows of files already in Storage are inserted even
+            # when the run stops early
+            try:
+                if in_flight:
+                    await asyncio.gather(*in_flight, return_exceptions=True)
+                if writer is not None:
+                    await writer.flush()
+                    insert_log.print()
+                list_pool.shutdown()
+                gmail_pool.shutdown()
+            finally:
+                _finish_run(total, writer, cache, fetch_stats, dead_letter, latest_history_id, checkpoint_path,
+                            f"Supabase HTTP (aiohttp): {client.requests} requests, {client.retries} retries, "
+                            f"at most {supabase_concurrency} in flight", completed, supabase_scheduler=False)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch purchase order emails from Gmail and upload them to Supabase")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="number of emails processed concurrently (1 = sequential)")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help=f"Gmail calls per batch request (max {MAX_BATCH_SIZE})")
+    parser.add_argument("--hours", type=float, default=DEFAULT_SEARCH_HOURS,
+                        help="how far back to search, e.g. widen it after an outage")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f"message IDs per list page (max {MAX_PAGE_SIZE})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch mail added since the last run (Gmail History API)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_FILE,
+                        help="file holding the last synced historyId for --incremental")
+    parser.add_argument("--ledger", default=DEFAULT_LEDGER_FILE,
+                        help="SQLite file recording uploaded emails and attachments")
+    parser.add_argument("--force", action="store_true",
+                        help="reprocess emails even if the ledger says they were already uploaded")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="directory of the on-disk attachment cache")
+    parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024),
+                        help="size limit of the attachment cache; least recently used files are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="don't cache downloaded attachments")
+    parser.add_argument("--metadata-batch-size", type=int, default=DEFAULT_METADATA_BATCH_SIZE,
+                        help="purchase_orders rows inserted per request (1 = insert each file's row right away)")
+    parser.add_argument("--zip-level", type=int, default=DEFAULT_DEFLATE_LEVEL, choices=range(1, 10),
+                        metavar="1-9", help="deflate level for CSV/XLS members of zip bundles")
+    parser.add_argument("--pool-size", type=int, default=supabase_http.DEFAULT_POOL_SIZE,
+                        help="keep-alive connections kept open to Supabase (at least --workers)")
+    parser.add_argument("--shard-queries", action="store_true",
+                        help="list each client's emails with its own query, in parallel")
+    parser.add_argument("--metadata-first", action="store_true",
+                        help="check headers with format='metadata' before fetching full messages")
+    parser.add_argument("--max-attachment-mb", type=float, default=None,
+                        help="skip attachments larger than this instead of downloading them")
+    parser.add_argument("--dead-letter", default=DEFAULT_DEAD_LETTER_FILE,
+                        help="file of emails that failed after all retries; drained first on the next run")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="tries per Gmail or Supabase request before giving up")
+    parser.add_argument("--gmail-rate", type=float, default=gmail_batch.GMAIL_UNITS_PER_SECOND,
+                        help="Gmail quota units per second to stay under (0 = no limit)")
+    parser.add_argument("--resumable-threshold-mb", type=float,
+                        default=resumable_upload.DEFAULT_THRESHOLD / 1024 / 1024,
+                        help="upload files larger than this in resumable chunks (0 = never)")
+    parser.add_argument("--chunk-mb", type=float, default=resumable_upload.DEFAULT_CHUNK_SIZE / 1024 / 1024,
+                        help="chunk size of resumable uploads (Supabase expects 6)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="upload with asyncio/aiohttp instead of one thread per email")
+    parser.add_argument("--supabase-concurrency", type=int, default=DEFAULT_SUPABASE_CONCURRENCY,
+                        help="Supabase requests kept in flight by --async")
+    parser.add_argument("--split-branches", action="store_true",
+                        help="also upload one file per store of Talabat POs, each with its own purchase_orders "
+                             "row, next to the bundle (off unless given)")
+    parser.add_argument("--split-workers", type=int, default=branch_split.DEFAULT_SPLIT_WORKERS,
+                        help="processes writing the per-store files of --split-branches")
+    parser.add_argument("--demand-db", default=None,
+                        help="SQLite file to add the line items of spreadsheet POs to (daily demand per product)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and sync new mail as it arrives (implies --incremental)")
+    parser.add_argument("--pubsub-topic", default=os.environ.get("GMAIL_PUBSUB_TOPIC"),
+                        help="Pub/Sub topic Gmail publishes inbox changes to (projects/<p>/topics/<t>)")
+    parser.add_argument("--pubsub-subscription", default=os.environ.get("GMAIL_PUBSUB_SUBSCRIPTION"),
+                        help="pull subscription of --pubsub-topic; without both, --watch polls instead")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="seconds between syncs when --watch has no Pub/Sub subscription")
+    parser.add_argument("--safety-interval", type=float, default=DEFAULT_SAFETY_INTERVAL,
+                        help="longest --watch goes without a sync, in case a notification is lost")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    supabase_http.configure(pool_size=max(args.pool_size, args.workers), max_attempts=args.max_attempts)
+    gmail_batch.SCHEDULER.configure(rate=args.gmail_rate, max_attempts=args.max_attempts)
+    zip_bundle_configure(deflate_level=args.zip_level)
+    branch_split.configure(enabled=args.split_branches, workers=args.split_workers)
+    ledger = ProcessedLedger(args.ledger, force=args.force)
+    # Unfinished large uploads are remembered in the ledger and carried on by the next run
+    resumable_upload.configure(threshold=int(args.resumable_threshold_mb * 1024 * 1024),
+                               chunk_size=int(args.chunk_mb * 1024 * 1024), store=ledger)
+    cache = None if args.no_cache else AttachmentCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    dead_letter = DeadLetterQueue(args.dead_letter)
+    demand = DemandStore(args.demand_db) if args.demand_db else None
+    router = DEFAULT_ROUTER
+    if args.max_attachment_mb is not None:
+        router = ClientRouter(with_max_size(CLIENT_RULES, int(args.max_attachment_mb * 1024 * 1024)))
+    options = dict(
+        max_workers=args.workers,
+        batch_size=min(args.batch_size, MAX_BATCH_SIZE),
+        hours=args.hours,
+        page_size=min(args.page_size, MAX_PAGE_SIZE),
+        incremental=args.incremental,
+        checkpoint_path=args.checkpoint,
+        ledger=ledger,
+        cache=cache,
+        metadata_batch_size=args.metadata_batch_size,
+        shard=args.shard_queries,
+        metadata_first=args.metadata_first,
+        router=router,
+        dead_letter=dead_letter,
+        demand=demand,
+    )
+    if args.watch:
+        watch_and_upload_orders(options, args.dead_letter, topic=args.pubsub_topic,
+                                subscription=args.pubsub_subscription, poll_interval=args.poll_interval,
+                                safety_interval=args.safety_interval)
+    elif args.use_async:
+        asyncio.run(fetch_and_upload_orders_async(supabase_concurrency=args.supabase_concurrency, **options))
+    else:
+        fetch_and_upload_orders(**options)
+    ledger.close()
+    if cache is not None:
+        cache.close()
+    supabase_http.close_session()
+    branch_split.shutdown()
+    if demand is not None:
+        demand.close()
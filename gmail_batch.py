@@ -0,0 +1,163 @@
+import os
+import base64
+from googleapiclient.errors import HttpError
+from request_scheduler import RequestScheduler, parse_retry_after
+
+# Gmail accepts at most 100 calls per batch request
+MAX_BATCH_SIZE = 100
+# Attachment bodies all come back in one multipart response, so keep each batch small enough to hold in memory
+MAX_ATTACHMENT_BATCH_BYTES = 10 * 1024 * 1024
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Gmail's per-user limit is 250 quota units per second. messages.get, messages.list
+# and attachments.get cost 5 units each, history.list 2 and getProfile 1.
+GMAIL_UNITS_PER_SECOND = float(os.environ.get("GMAIL_UNITS_PER_SECOND", "250"))
+MESSAGE_UNITS = 5
+HISTORY_UNITS = 2
+PROFILE_UNITS = 1
+
+
+def _classify(error):
+    """(retryable, retry_after) for an error raised by a Gmail call."""
+    if isinstance(error, HttpError):
+        retry_after = parse_retry_after(error.resp.get("retry-after"))
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True, retry_after
+        # Quota errors come back as 403 with a rateLimitExceeded / userRateLimitExceeded reason
+        if error.resp.status == 403 and b"ateLimitExceeded" in (error.content or b""):
+            return True, retry_after
+        return False, None
+    # Transport errors (timeouts, broken multipart responses) are worth another try in a smaller batch
+    return True, None
+
+
+# Shared by every thread so the whole run stays under the per-user quota
+SCHEDULER = RequestScheduler("Gmail", _classify, rate=GMAIL_UNITS_PER_SECOND)
+
+
+def execute(request, cost=MESSAGE_UNITS):
+    """Execute a single Gmail request under the rate limit, retrying transient errors."""
+    return SCHEDULER.call(request.execute, cost)
+
+
+def _run_batch(service, keys, make_request, results, errors, cost):
+    """Run one batch request. Returns the keys that failed with a retryable error."""
+    failed = []
+
+    def callback(request_id, response, exception):
+        key = keys[int(request_id)]
+        if exception is None:
+            results[key] = response
+        elif _classify(exception)[0]:
+            failed.append(key)
+            errors[key] = exception
+        else:
+            errors[key] = exception
+
+    SCHEDULER.acquire(cost * len(keys), calls=len(keys))
+    if len(keys) == 1:
+        # A batch of one is just a slower single request
+        try:
+            callback("0", make_request(keys[0]).execute(), None)
+        except Exception as e:
+            callback("0", None, e)
+        return failed
+
+    batch = service.new_batch_http_request(callback=callback)
+    for i, key in enumerate(keys):
+        batch.add(make_request(key), request_id=str(i))
+    try:
+        batch.execute()
+    except Exception as e:
+        for key in keys:
+            if key not in results:
+                errors[key] = e
+        return [key for key in keys if key not in results]
+    return failed
+
+
+def execute_batched(service, keys, make_request, batch_size=MAX_BATCH_SIZE, cost=MESSAGE_UNITS):
+    """
+    Execute make_request(key) for every key through Gmail batch requests.
+
+    Items that fail with a retryable error (rate limit, 5xx, broken response)
+    are retried in rounds. Each round waits one backoff, then sends the
+    failed part of every sub-batch again, split in half. A key that has been
+    split down to a request of its own gets one try alone and no more, and
+    no key is tried more than the scheduler's max_attempts times, so an
+    outage costs a few backoffs rather than one per sub-batch. The last error
+    of every key that never succeeded is reported. Returns (results, errors)
+    keyed like `keys`.
+    """
+    results, errors = {}, {}
+    keys = list(keys)
+    # (keys, whether they were split out of a larger failed batch)
+    chunks = [(keys[i:i + batch_size], False) for i in range(0, len(keys), batch_size)]
+    attempt = 0
+    while chunks:
+        if attempt:
+            retry_after = max((_classify(errors[key])[1] or 0 for chunk, _ in chunks for key in chunk),
+                              default=0) or None
+            SCHEDULER.sleep_before_retry(attempt, retry_after)
+        attempt += 1
+        retry = []
+        for chunk, split in chunks:
+            failed = _run_batch(service, chunk, make_request, results, errors, cost)
+            if len(failed) > 1:
+                mid = len(failed) // 2
+                retry += [(failed[:mid], True), (failed[mid:], True)]
+            elif failed and (len(chunk) > 1 or not split):
+                retry.append((failed, len(chunk) > 1 or split))
+            elif failed:
+                SCHEDULER.gave_up(1)
+        if retry and attempt >= SCHEDULER.max_attempts:
+            SCHEDULER.gave_up(sum(len(chunk) for chunk, _ in retry))
+            break
+        chunks = retry
+    for key in results:
+        errors.pop(key, None)
+    return results, errors
+
+
+def batch_get_messages(service, msg_ids, fmt='full', batch_size=MAX_BATCH_SIZE, metadata_headers=None):
+    """
+    Fetch many messages with as few round trips as possible. Returns ({id: message}, {id: error}).
+    With fmt='metadata', `metadata_headers` limits the headers returned.
+    """
+    def make_request(msg_id):
+        if fmt == 'metadata' and metadata_headers:
+            return service.users().messages().get(userId='me', id=msg_id, format=fmt,
+                                                  metadataHeaders=metadata_headers)
+        return service.users().messages().get(userId='me', id=msg_id, format=fmt)
+    return execute_batched(service, msg_ids, make_request, batch_size)
+
+
+def batch_get_attachments(service, msg_id, attachments, max_batch_bytes=MAX_ATTACHMENT_BATCH_BYTES):
+    """
+    Download the attachments of one message, given as (attachment_id, size) pairs.
+
+    Attachments are grouped so each batch stays under max_batch_bytes; anything
+    larger than the limit gets a request of its own. Returns ({attachment_id: bytes}, {attachment_id: error}).
+    """
+    def make_request(att_id):
+        return service.users().messages().attachments().get(userId='me', messageId=msg_id, id=att_id)
+
+    groups, group, group_bytes = [], [], 0
+    for att_id, size in attachments:
+        size = size or 0
+        if group and (group_bytes + size > max_batch_bytes or len(group) >= MAX_BATCH_SIZE):
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(att_id)
+        group_bytes += size
+    if group:
+        groups.append(group)
+
+    files, errors = {}, {}
+    for group in groups:
+        results, group_errors = execute_batched(service, group, make_request)
+        errors.update(group_errors)
+        for att_id, attachment in results.items():
+            files[att_id] = base64.urlsafe_b64decode(attachment['data'].encode("UTF-8"))
+    return files, errors
@@ -0,0 +1,100 @@
+import re
+
+from client_routes import CLIENT_RULES, EXCLUDED_SENDERS
+
+# Gmail doesn't document a limit for q, but very long queries start failing or
+# silently matching less; past this length shard the query instead.
+MAX_QUERY_LENGTH = 1500
+
+_EMAIL = re.compile(r"^[^\s@()\"{}]+@[^\s@()\"{}]+\.[^\s@()\"{}]+$")
+
+
+class QueryError(ValueError):
+    """The search configuration would produce a broken Gmail query."""
+
+
+def _dedupe(values):
+    seen, unique = set(), []
+    for value in values:
+        if value.lower() not in seen:
+            seen.add(value.lower())
+            unique.append(value)
+    return unique
+
+
+def rule_terms(rule):
+    """The `from:` and `subject:` terms that find one client's emails."""
+    for sender in rule.senders:
+        if not _EMAIL.match(sender):
+            raise QueryError(f"{rule.label}: not an email address: {sender!r}")
+    for subject in rule.search_subjects:
+        if not subject.strip() or '"' in subject or subject != subject.strip():
+            raise QueryError(f"{rule.label}: subject phrase can't be quoted: {subject!r}")
+    return ([f'subject:"{subject}"' for subject in rule.search_subjects]
+            + [f'from:{sender}' for sender in rule.senders])
+
+
+def base_terms(after_ts, excluded_senders=EXCLUDED_SENDERS):
+    for sender in excluded_senders:
+        if not _EMAIL.match(sender):
+            raise QueryError(f"excluded sender is not an email address: {sender!r}")
+    return [
+        f"after:{after_ts}",
+        "label:inbox has:attachment",
+        "-from:me",
+        *[f"-from:{sender}" for sender in excluded_senders],
+    ]
+
+
+def validate_query(query):
+    """Catch the mistakes that make Gmail silently match the wrong mail."""
+    if query.count('"') % 2:
+        raise QueryError(f"unbalanced quotes in query: {query}")
+    depth = 0
+    for char in query:
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth < 0:
+            break
+    if depth != 0:
+        raise QueryError(f"unbalanced parentheses in query: {query}")
+    if re.search(r"\(\s*\)|\bOR\s*\)|\(\s*OR\b|\bOR\s+OR\b|\bOR\s*$", query):
+        raise QueryError(f"dangling OR or empty group in query: {query}")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise QueryError(f"query is {len(query)} characters long, shard it instead (max {MAX_QUERY_LENGTH})")
+    return query
+
+
+def _assemble(base, terms):
+    # join with a single space so there are no accidental run-together tokens
+    return validate_query(" ".join(base + ['(' + ' OR '.join(terms) + ')']))
+
+
+def build_query(after_ts, rules=CLIENT_RULES, excluded_senders=EXCLUDED_SENDERS):
+    """One query matching the emails of every client rule."""
+    terms = [term for rule in rules for term in rule_terms(rule)]
+    # subjects first, then senders, so the query reads like the old hand-written one
+    terms = _dedupe(sorted(terms, key=lambda term: not term.startswith("subject:")))
+    if not terms:
+        raise QueryError("no client rule has senders or search subjects")
+    return _assemble(base_terms(after_ts, excluded_senders), terms)
+
+
+def shard_queries(after_ts, rules=CLIENT_RULES, excluded_senders=EXCLUDED_SENDERS):
+    """One smaller query per client rule; together they match what build_query() does."""
+    base = base_terms(after_ts, excluded_senders)
+    queries = []
+    for rule in rules:
+        terms = _dedupe(rule_terms(rule))
+        if terms:
+            queries.append(_assemble(base, terms))
+    if not queries:
+        raise QueryError("no client rule has senders or search subjects")
+    return queries
+
+
+def search_senders(rules=CLIENT_RULES):
+    return _dedupe(sender for rule in rules for sender in rule.senders)
+
+
+def search_subjects(rules=CLIENT_RULES):
+    return _dedupe(subject for rule in rules for subject in rule.search_subjects)
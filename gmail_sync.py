@@ -0,0 +1,71 @@
+import os
+import json
+from datetime import datetime
+from googleapiclient.errors import HttpError
+from gmail_batch import HISTORY_UNITS, PROFILE_UNITS, execute
+
+DEFAULT_CHECKPOINT_FILE = os.environ.get("GMAIL_SYNC_CHECKPOINT", "gmail_sync_state.json")
+
+
+class HistoryExpired(Exception):
+    """The stored historyId is too old for users().history().list; a full scan is needed."""
+
+
+def load_checkpoint(path=DEFAULT_CHECKPOINT_FILE):
+    """Return the last synced historyId, or None if there is no usable checkpoint."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("history_id")
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable sync checkpoint {path}: {e}")
+        return None
+
+
+def save_checkpoint(history_id, path=DEFAULT_CHECKPOINT_FILE):
+    # Write to a temp file first so a crash never leaves a half-written checkpoint behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"history_id": str(history_id), "updated_at": datetime.utcnow().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+def current_history_id(service):
+    return execute(service.users().getProfile(userId='me'), PROFILE_UNITS)["historyId"]
+
+
+def list_added_message_ids(service, start_history_id, page_size=500):
+    """
+    Return (message_ids, latest_history_id) for inbox messages added since start_history_id.
+
+    Raises HistoryExpired when Gmail no longer has history that far back.
+    """
+    msg_ids, seen = [], set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            response = execute(service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                labelId='INBOX',
+                maxResults=page_size,
+                pageToken=page_token,
+            ), HISTORY_UNITS)
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpired(f"historyId {start_history_id} has expired") from e
+            raise
+
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                msg_id = added["message"]["id"]
+                if msg_id not in seen:
+                    seen.add(msg_id)
+                    msg_ids.append(msg_id)
+        latest_history_id = response.get("historyId", latest_history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return msg_ids, latest_history_id
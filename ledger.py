@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+DEFAULT_LEDGER_FILE = os.environ.get("PROCESSED_LEDGER", "processed_ledger.sqlite3")
+
+# Key used for uploads that bundle several attachments into one zip
+BUNDLE_PART = "bundle"
+
+
+def content_hash(data):
+    """SHA-256 of bytes or of a seekable file object (read in chunks, then rewound)."""
+    if isinstance(data, (bytes, bytearray)):
+        return hashlib.sha256(data).hexdigest()
+    digest = hashlib.sha256()
+    start = data.tell()
+    for chunk in iter(lambda: data.read(1024 * 1024), b""):
+        digest.update(chunk)
+    data.seek(start)
+    return digest.hexdigest()
+
+
+class ProcessedLedger:
+    """
+    Local record of what has already been uploaded, so overlapping runs don't
+    upload the same order twice.
+
+    Uploads are keyed by Gmail message ID and MIME part ID. Gmail attachment IDs
+    change every time a message is fetched, so the part ID is the stable way to
+    name an attachment; the content hash is stored next to it. A message is
+    marked done once all of its uploads succeeded, which lets later runs skip it
+    before fetching anything.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_FILE, force=False):
+        self.path = path
+        # force: ignore what is recorded (reprocess everything) but keep recording
+        self.force = force
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed_messages ("
+                " message_id TEXT PRIMARY KEY,"
+                " client TEXT,"
+                " processed_at TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                " message_id TEXT NOT NULL,"
+                " part_id TEXT NOT NULL,"
+                " content_hash TEXT NOT NULL,"
+                " file_path TEXT,"
+                " supabase_id TEXT,"
+                " uploaded_at TEXT NOT NULL,"
+                " PRIMARY KEY (message_id, part_id))"
+            )
+            # Resumable (TUS) uploads that did not finish, so a later run can carry on with them
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS resumable_uploads ("
+                " object_name TEXT PRIMARY KEY,"
+                " upload_length INTEGER NOT NULL,"
+                " content_hash TEXT NOT NULL,"
+                " location TEXT NOT NULL,"
+                " created_at TEXT NOT NULL)"
+            )
+
+    def is_message_done(self, message_id):
+        if self.force:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM processed_messages WHERE message_id = ?", (message_id,)).fetchone()
+        return row is not None
+
+    def is_uploaded(self, message_id, part_id):
+        if self.force:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM uploads WHERE message_id = ? AND part_id = ?", (message_id, part_id)).fetchone()
+        return row is not None
+
+    def record_upload(self, message_id, part_id, sha256, file_path=None, supabase_id=None):
+        """sha256 is the content_hash() of the uploaded bytes."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                (message_id, part_id, sha256, file_path,
+                 None if supabase_id is None else str(supabase_id), datetime.utcnow().isoformat()),
+            )
+
+    def mark_message_done(self, message_id, client=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO processed_messages VALUES (?, ?, ?)",
+                (message_id, client, datetime.utcnow().isoformat()),
+            )
+
+    def resumable_location(self, object_name, upload_length, sha256):
+        """The TUS upload URL saved for these exact bytes under this name, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT location FROM resumable_uploads"
+                " WHERE object_name = ? AND upload_length = ? AND content_hash = ?",
+                (object_name, upload_length, sha256)).fetchone()
+        return row[0] if row else None
+
+    def save_resumable(self, object_name, upload_length, sha256, location):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO resumable_uploads VALUES (?, ?, ?, ?, ?)",
+                (object_name, upload_length, sha256, location, datetime.utcnow().isoformat()),
+            )
+
+    def forget_resumable(self, object_name):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM resumable_uploads WHERE object_name = ?", (object_name,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
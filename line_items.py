@@ -0,0 +1,229 @@
+import io
+import os
+import re
+import csv
+import sys
+import time
+import argparse
+from dataclasses import dataclass
+from itertools import compress
+from typing import Mapping, Tuple
+from catalog import default_catalog, normalize_barcode, normalize_sku, normalize_name
+from xlsx_reader import read_rows, XlsxFormatError
+
+# One field per entry of config.py's `columns`, in the same order
+LINE_ITEM_FIELDS = ("no", "sku", "supplier_sku", "barcode", "product", "qty", "unit_cost", "discount",
+                    "amount_excl_vat", "vat_percent", "vat_amount", "amount_incl_vat")
+NUMERIC_FIELDS = ("qty", "unit_cost", "discount", "amount_excl_vat", "vat_percent", "vat_amount",
+                  "amount_incl_vat")
+# Filled in from the catalog rather than read from the file
+CATALOG_FIELDS = ("product_id", "catalog_product", "category")
+# The header row is expected within the first rows, below the supplier/branch block
+HEADER_SCAN_ROWS = 50
+# Header cells that must be matched before a row is taken for the header
+MIN_HEADER_MATCHES = 3
+
+_WHITESPACE = re.compile(r"\s+")
+# Summary rows that put their label in the Product column
+_TOTAL_LABEL = re.compile(r"^(sub ?|grand )?total\b|^(ال)?[اإ]جمال[يى]", re.IGNORECASE)
+
+
+class LineItemError(Exception):
+    """The file has no recognisable line-item table."""
+
+
+def is_total_row(row):
+    """Whether a sheet row is a summary (Total, Subtotal, الإجمالي, ...) rather than a line item."""
+    return any(isinstance(cell, str) and _TOTAL_LABEL.match(cell.strip()) for cell in row)
+
+
+def normalize_header(value):
+    """'Amt.\\nExcl.\\nVAT' and 'amt. excl. vat' are the same column."""
+    if value is None:
+        return ""
+    return _WHITESPACE.sub(" ", str(value)).strip().lower()
+
+
+def header_fields(columns):
+    """Normalized header text -> line-item field, from config.py's `columns`."""
+    if len(columns) != len(LINE_ITEM_FIELDS):
+        raise LineItemError(f"expected {len(LINE_ITEM_FIELDS)} columns in config.py, found {len(columns)}")
+    return {normalize_header(column): field for column, field in zip(columns, LINE_ITEM_FIELDS)}
+
+
+def find_header(rows, fields):
+    """(row index, {field: column index}) of the first row that looks like the header."""
+    for row_index, row in enumerate(rows[:HEADER_SCAN_ROWS]):
+        positions = {}
+        for column, value in enumerate(row):
+            field = fields.get(normalize_header(value))
+            if field is not None and field not in positions:
+                positions[field] = column
+        if len(positions) >= MIN_HEADER_MATCHES and "qty" in positions:
+            return row_index, positions
+    raise LineItemError(f"no header row with a Qty column in the first {HEADER_SCAN_ROWS} rows")
+
+
+def _to_number(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", "")
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _to_text(value):
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+@dataclass(frozen=True)
+class LineItems:
+    """
+    The line items of one PO, stored by column.
+
+    `columns` maps every name in LINE_ITEM_FIELDS and CATALOG_FIELDS to a
+    tuple with one value per item. Fields the file doesn't have are all None.
+    """
+    source: str
+    columns: Mapping[str, Tuple]
+
+    def __len__(self):
+        return len(self.columns["qty"])
+
+    @property
+    def unmatched(self):
+        """Items whose SKU, barcode and product name are all unknown to the catalog."""
+        return sum(1 for product_id in self.columns["product_id"] if product_id is None)
+
+    def rows(self):
+        names = list(self.columns)
+        return [dict(zip(names, values)) for values in zip(*self.columns.values())]
+
+
+def items_from_rows(rows, source="", catalog=None):
+    """
+    Normalized line items from a grid of cell values (lists of strings/numbers).
+
+    Everything after the header row is handled a column at a time: each wanted
+    column is sliced out once, converted with a single map() call, and the
+    rows without a quantity or anything to identify the product are dropped
+    with one mask over all columns.
+    """
+    catalog = catalog or default_catalog()
+    rows = rows if isinstance(rows, list) else list(rows)
+    header_index, positions = find_header(rows, header_fields(catalog.columns))
+    body = rows[header_index + 1:]
+
+    def column(field):
+        position = positions.get(field)
+        if position is None:
+            return [None] * len(body)
+        return [row[position] if position < len(row) else None for row in body]
+
+    columns = {}
+    for field in LINE_ITEM_FIELDS:
+        if field in NUMERIC_FIELDS:
+            columns[field] = list(map(_to_number, column(field)))
+        elif field == "sku":
+            columns[field] = list(map(normalize_sku, column(field)))
+        elif field == "barcode":
+            columns[field] = list(map(normalize_barcode, column(field)))
+        elif field == "product":
+            columns[field] = list(map(normalize_name, column(field)))
+        else:
+            columns[field] = list(map(_to_text, column(field)))
+
+    # Totals, notes and blank rows have no quantity or no product
+    keep = [qty is not None and (sku is not None or barcode is not None
+                                 or (product is not None and not _TOTAL_LABEL.match(product)))
+            for qty, sku, barcode, product in zip(columns["qty"], columns["sku"], columns["barcode"],
+                                                  columns["product"])]
+    columns = {field: tuple(compress(values, keep)) for field, values in columns.items()}
+
+    # Barcode first, then SKU, then name, like Catalog.product_id, but a column at a time
+    product_ids = list(map(catalog.by_barcode.get, columns["barcode"]))
+    for source_field, index in (("sku", catalog.by_sku), ("product", catalog.by_name)):
+        for i, product_id in enumerate(product_ids):
+            if product_id is None:
+                product_ids[i] = index.get(columns[source_field][i])
+    columns["product_id"] = tuple(product_ids)
+    columns["catalog_product"] = tuple(None if pid is None else catalog.names[pid] for pid in product_ids)
+    columns["category"] = tuple(None if pid is None else catalog.category(pid) for pid in product_ids)
+    return LineItems(source, columns)
+
+
+def _csv_rows(data):
+    for encoding in ("utf-8-sig", "cp1256"):
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise LineItemError("CSV is neither UTF-8 nor Windows-1256")
+    try:
+        return list(csv.reader(io.StringIO(text, newline="")))
+    except csv.Error as e:
+        raise LineItemError(f"unreadable CSV: {e}") from e
+
+
+def read_grid(data, filename):
+    """The cell values of an .xlsx (active sheet) or .csv file as a list of rows."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".xlsx":
+        try:
+            return read_rows(data)
+        except XlsxFormatError as e:
+            raise LineItemError(f"{filename}: {e}") from e
+    if extension == ".csv":
+        return _csv_rows(data)
+    raise LineItemError(f"{filename}: only .xlsx and .csv line items can be extracted")
+
+
+def extract_line_items(data, filename, catalog=None):
+    """Line items of an .xlsx or .csv purchase order."""
+    return items_from_rows(read_grid(data, filename), filename, catalog)
+
+
+def write_csv(items_list, out):
+    """Write the items of several files as one CSV, with the file name as the first column."""
+    writer = csv.writer(out)
+    writer.writerow(("source",) + LINE_ITEM_FIELDS + CATALOG_FIELDS)
+    for items in items_list:
+        for values in zip(*(items.columns[field] for field in LINE_ITEM_FIELDS + CATALOG_FIELDS)):
+            writer.writerow((items.source,) + values)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract normalized line items from PO spreadsheets")
+    parser.add_argument("files", nargs="+", help=".xlsx or .csv purchase orders")
+    parser.add_argument("--out", default="-", help="CSV file to write (default: stdout)")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    extracted = []
+    for path in args.files:
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                items = extract_line_items(f.read(), os.path.basename(path))
+        except (OSError, LineItemError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        extracted.append(items)
+        print(f"{path}: {len(items)} line items, {items.unmatched} not in the catalog "
+              f"({(time.perf_counter() - started) * 1000:.0f} ms)", file=sys.stderr)
+    if args.out == "-":
+        write_csv(extracted, sys.stdout)
+    else:
+        with open(args.out, 'w', encoding='utf-8', newline='') as f:
+            write_csv(extracted, f)
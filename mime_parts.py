@@ -0,0 +1,54 @@
+import base64
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class AttachmentPart:
+    """
+    One file found in a Gmail message payload. Small files come with their
+    base64url body inline in `data`; the rest have to be fetched by `attachment_id`.
+    """
+    part_id: str
+    filename: str
+    mime_type: str
+    size: int
+    attachment_id: Optional[str]
+    data: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def downloadable(self):
+        return bool(self.attachment_id or self.data is not None)
+
+    def inline_bytes(self):
+        # Gmail sometimes leaves off the base64 padding
+        return base64.urlsafe_b64decode(self.data + "=" * (-len(self.data) % 4))
+
+
+def iter_attachments(payload):
+    """
+    Yield an AttachmentPart for every part with a filename, anywhere in the MIME tree.
+
+    Forwarded POs arrive as multipart/mixed -> multipart/alternative or as an
+    attached message/rfc822, so the files are not always top-level parts. The
+    tree is walked once, depth first, in the order the parts appear in the email.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        body = part.get("body", {})
+        if part.get("filename"):
+            yield AttachmentPart(
+                part_id=part.get("partId", ""),
+                filename=part["filename"],
+                mime_type=part.get("mimeType", ""),
+                size=body.get("size") or 0,
+                attachment_id=body.get("attachmentId"),
+                data=None if body.get("attachmentId") else body.get("data"),
+            )
+        # reversed, so the first child is popped first
+        stack.extend(reversed(part.get("parts", [])))
+
+
+def has_attachment(payload):
+    return any(part.downloadable for part in iter_attachments(payload))
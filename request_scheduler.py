@@ -0,0 +1,152 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second on average, with bursts of up to `capacity`.
+    acquire() blocks until enough units have built up.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """
+        Take `cost` units. Returns the seconds spent waiting for them.
+
+        A cost above the capacity (e.g. a full Gmail batch) is taken in
+        capacity-sized pieces, so it is charged in full rather than capped.
+        """
+        waited = 0.0
+        while cost > 0:
+            piece = min(cost, self.capacity)
+            waited += self._take(piece)
+            cost -= piece
+        return waited
+
+    def _take(self, cost):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return waited
+                wait = (cost - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (either seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RequestScheduler:
+    """
+    Runs calls to one API under a token bucket, retrying the ones that fail
+    with a transient error.
+
+    `classify(exception)` returns (retryable, retry_after): whether another
+    attempt may succeed, and the delay the server asked for, if any. Without
+    a Retry-After the delay is exponential backoff with full jitter, so
+    workers that failed together don't all come back at the same moment.
+    """
+
+    def __init__(self, name, classify, rate=None, capacity=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.name = name
+        self.classify = classify
+        self.bucket = TokenBucket(rate, capacity) if rate else None
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"calls": 0, "retries": 0, "gave_up": 0, "throttled_seconds": 0.0, "backoff_seconds": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def configure(self, rate=None, capacity=None, max_attempts=None):
+        if rate is not None:
+            self.bucket = TokenBucket(rate, capacity) if rate > 0 else None
+        if max_attempts is not None:
+            self.max_attempts = max(max_attempts, 1)
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def acquire(self, cost=1, calls=1):
+        """Wait for `cost` units of the rate limit before making `calls` calls (e.g. a whole batch)."""
+        if self.bucket is not None:
+            self._count("throttled_seconds", self.bucket.acquire(cost))
+        self._count("calls", calls)
+
+    def gave_up(self, count=1):
+        """Count calls that are not retried again, for callers doing their own retries."""
+        self._count("gave_up", count)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Delay before retry number `attempt` (1 = the first retry)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def sleep_before_retry(self, attempt, retry_after=None):
+        delay = self.backoff_delay(attempt, retry_after)
+        self._count("retries")
+        self._count("backoff_seconds", delay)
+        time.sleep(delay)
+
+    def call(self, fn, cost=1):
+        """Run fn(), retrying transient failures. The last error is raised once attempts run out."""
+        attempt = 0
+        while True:
+            self.acquire(cost)
+            try:
+                return fn()
+            except Exception as e:
+                retryable, retry_after = self.classify(e)
+                attempt += 1
+                if not retryable or attempt >= self.max_attempts:
+                    if retryable:
+                        self._count("gave_up")
+                    raise
+                self.sleep_before_retry(attempt, retry_after)
+
+    def reset_stats(self):
+        """Start counting from zero, e.g. for the next run of a long-lived process."""
+        with self._stats_lock:
+            self.stats = dict.fromkeys(self.stats, 0)
+            self.stats["throttled_seconds"] = self.stats["backoff_seconds"] = 0.0
+
+    def report(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return (f"{self.name} requests: {stats['calls']} calls, {stats['retries']} retries "
+                f"({stats['backoff_seconds']:.1f}s backing off), {stats['gave_up']} gave up, "
+                f"{stats['throttled_seconds']:.1f}s waiting on the rate limit")
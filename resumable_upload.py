@@ -0,0 +1,199 @@
+import io
+import os
+import base64
+import threading
+import supabase_http
+from supabase_http import RETRYABLE_STATUSES, RetryableResponse
+from ledger import content_hash
+
+TUS_VERSION = "1.0.0"
+# Supabase Storage only accepts 6 MB chunks (the last one may be shorter)
+DEFAULT_CHUNK_SIZE = int(os.environ.get("RESUMABLE_CHUNK_MB", "6")) * 1024 * 1024
+# Files above this go through the resumable endpoint instead of a single POST
+DEFAULT_THRESHOLD = int(os.environ.get("RESUMABLE_THRESHOLD_MB", "6")) * 1024 * 1024
+
+_chunk_size = DEFAULT_CHUNK_SIZE
+_threshold = DEFAULT_THRESHOLD
+# Where unfinished uploads are remembered between runs (a ledger.ProcessedLedger), if anywhere
+_store = None
+_stats = {"uploads": 0, "chunks": 0, "bytes": 0, "resumes": 0, "bytes_not_resent": 0}
+_stats_lock = threading.Lock()
+
+
+class ResumableUploadError(Exception):
+    """The upload could not be created or Storage refused a chunk for good."""
+
+
+def configure(threshold=None, chunk_size=None, store=None):
+    global _threshold, _chunk_size, _store
+    if threshold is not None:
+        _threshold = threshold
+    if chunk_size is not None:
+        _chunk_size = chunk_size
+    if store is not None:
+        _store = store
+
+
+def payload_size(data):
+    """Length of bytes or of what is left to read in a seekable file object."""
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    start = data.tell()
+    end = data.seek(0, io.SEEK_END)
+    data.seek(start)
+    return end - start
+
+
+def should_resume(data):
+    return _threshold > 0 and payload_size(data) > _threshold
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for key, amount in amounts.items():
+            _stats[key] += amount
+
+
+def _metadata_header(**fields):
+    return ",".join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in fields.items())
+
+
+def _server_offset(location, auth, size):
+    """
+    How many bytes of the upload Storage has, from a HEAD request. None if
+    the upload is gone (finished, expired or never there) or is not `size` bytes long.
+    """
+    head = supabase_http.send("HEAD", location, headers=auth)
+    if head.status_code in RETRYABLE_STATUSES:
+        raise RetryableResponse(head)
+    if head.status_code in (404, 410):
+        return None
+    if head.status_code != 200:
+        raise ResumableUploadError(f"Resumable upload can't be resumed: HTTP {head.status_code}")
+    if int(head.headers.get("Upload-Length", size)) != size:
+        return None
+    return int(head.headers["Upload-Offset"])
+
+
+def upload(supabase_url, supabase_key, bucket, object_name, data, content_type="application/octet-stream"):
+    """
+    Upload bytes or a seekable file object to Storage with the TUS protocol.
+
+    The file is sent in chunks of the configured size. When a chunk fails, the
+    server is asked how much it actually has (HEAD, Upload-Offset) and the
+    upload carries on from there, so a dropped connection near the end of a
+    large bundle only costs the last chunk. Supabase does not implement TUS
+    concatenation, so the chunks of one file go out in order.
+
+    With a store configured, the upload URL is saved until the upload
+    finishes. A later call for the same bytes under the same name (the next
+    run, or a dead-letter retry) asks Storage for the offset and carries on
+    from there instead of sending the whole file again.
+
+    Like config_fixed.upload_order_file, an existing object is never
+    overwritten; one with exactly these bytes counts as this upload.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    base = data.tell()
+    size = payload_size(data)
+    auth = {"Authorization": f"Bearer {supabase_key}", "Tus-Resumable": TUS_VERSION}
+    key = f"{bucket}/{object_name}"
+    store = _store
+    digest = content_hash(data) if store is not None else None
+
+    offset = 0
+    resumes = 0
+    location = store.resumable_location(key, size, digest) if store is not None else None
+    if location is not None:
+        saved_offset = supabase_http.SCHEDULER.call(lambda: _server_offset(location, auth, size))
+        if saved_offset is None:
+            store.forget_resumable(key)
+            location = None
+        else:
+            offset = saved_offset
+            resumes += 1
+            # compared with starting the whole file over
+            _count(bytes_not_resent=offset)
+
+    if location is None:
+        # Safe to send again: at worst Storage is left with an unused upload
+        created = supabase_http.request(
+            "POST", f"{supabase_url}/storage/v1/upload/resumable", idempotent=True,
+            headers=dict(auth, **{
+                "Upload-Length": str(size),
+                "x-upsert": "false",
+                "Upload-Metadata": _metadata_header(bucketName=bucket, objectName=object_name,
+                                                    contentType=content_type),
+            }),
+        )
+        if supabase_http.already_exists(created.status_code, created.text):
+            stored = supabase_http.stored_object_hash(f"{supabase_url}/storage/v1/object/{key}",
+                                                      {"Authorization": f"Bearer {supabase_key}"})
+            if stored is not None and stored == (digest or content_hash(data)):
+                return
+            raise ResumableUploadError(f"Storage already has a different {key}")
+        if created.status_code != 201 or "Location" not in created.headers:
+            raise ResumableUploadError(f"Resumable upload could not be created: {created.text}")
+        location = created.headers["Location"]
+        if location.startswith("/"):
+            location = supabase_url + location
+        if store is not None:
+            store.save_resumable(key, size, digest, location)
+
+    chunks = 0
+    needs_resync = False
+
+    def send_chunk():
+        nonlocal offset, needs_resync, resumes
+        if needs_resync:
+            # Part of the last chunk may have landed; ask instead of guessing
+            resumed_at = _server_offset(location, auth, size)
+            if resumed_at is None:
+                if store is not None:
+                    store.forget_resumable(key)
+                raise ResumableUploadError("Resumable upload can't be resumed: it no longer exists")
+            _count(bytes_not_resent=resumed_at)
+            offset = resumed_at
+            resumes += 1
+        needs_resync = True
+        data.seek(base + offset)
+        chunk = data.read(min(_chunk_size, size - offset))
+        response = supabase_http.send("PATCH", location, data=chunk, headers=dict(auth, **{
+            "Upload-Offset": str(offset),
+            "Content-Type": "application/offset+octet-stream",
+        }))
+        # 409: our offset and the server's disagree, which the HEAD on the next attempt sorts out
+        if response.status_code in RETRYABLE_STATUSES or response.status_code == 409:
+            raise RetryableResponse(response)
+        if response.status_code != 204:
+            raise ResumableUploadError(f"Storage rejected chunk at offset {offset}: {response.text}")
+        needs_resync = False
+        offset = int(response.headers.get("Upload-Offset", offset + len(chunk)))
+
+    try:
+        while offset < size:
+            supabase_http.SCHEDULER.call(send_chunk)
+            chunks += 1
+    except RetryableResponse as e:
+        raise ResumableUploadError(f"Storage upload failed at offset {offset}: HTTP {e.response.status_code}") from e
+    finally:
+        _count(uploads=1, chunks=chunks, bytes=size, resumes=resumes)
+    if store is not None:
+        store.forget_resumable(key)
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def resumable_report():
+    with _stats_lock:
+        stats = dict(_stats)
+    if not stats["uploads"]:
+        return "Resumable uploads: none"
+    return (f"Resumable uploads: {stats['uploads']} files, {stats['bytes'] / 1024 / 1024:.1f} MB in "
+            f"{stats['chunks']} chunks, {stats['resumes']} resumed "
+            f"({stats['bytes_not_resent'] / 1024 / 1024:.1f} MB not sent again)")
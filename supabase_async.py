@@ -0,0 +1,249 @@
+import os
+import json
+import asyncio
+import hashlib
+import supabase_http
+from ledger import content_hash
+from supabase_http import RETRYABLE_STATUSES, NOT_PROCESSED_STATUSES, OUTCOME_UNKNOWN_STATUSES, InsertRejected
+from request_scheduler import parse_retry_after
+
+try:
+    import aiohttp
+except ImportError:  # only needed for the --async engine
+    aiohttp = None
+
+# Errors raised before a request could reach the server
+_NEVER_SENT = () if aiohttp is None else (aiohttp.ClientConnectorError,
+                                          getattr(aiohttp, "ConnectionTimeoutError", aiohttp.ClientConnectorError))
+
+# Bodies of streamed uploads are read and sent in pieces of this size
+STREAM_CHUNK_SIZE = 256 * 1024
+DEFAULT_CONCURRENCY = 64
+
+
+class AsyncSupabaseClient:
+    """
+    Storage uploads and purchase_orders inserts over aiohttp.
+
+    At most `concurrency` requests are in flight at once; the connector keeps
+    that many keep-alive connections. Retries follow the same rules and limits
+    as supabase_http (429/5xx, timeouts, Retry-After, and inserts only when
+    they never reached the server), but wait with asyncio.sleep so the other
+    requests keep going.
+    """
+
+    def __init__(self, supabase_url, supabase_key, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+        if aiohttp is None:
+            raise RuntimeError("the async engine needs aiohttp: pip install aiohttp")
+        self.url = supabase_url
+        self.key = supabase_key
+        self.concurrency = concurrency
+        connect, read = timeout or supabase_http.DEFAULT_TIMEOUT
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        self.requests = 0
+        self.retries = 0
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        supabase_url = os.getenv("SUPABASE_URL")
+        supabase_key = os.getenv("SUPABASE_KEY")
+        if not supabase_url or not supabase_key:
+            raise Exception("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
+        return cls(supabase_url, supabase_key, **kwargs)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _request(self, method, url, make_body=None, idempotent=True, **kwargs):
+        """Returns (status, text, parsed JSON body or None) of the last attempt."""
+        scheduler = supabase_http.SCHEDULER
+        statuses = RETRYABLE_STATUSES if idempotent else NOT_PROCESSED_STATUSES
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    self.requests += 1
+                    if make_body is not None:
+                        kwargs["data"] = make_body()
+                    async with self._session.request(method, url, **kwargs) as response:
+                        text = await response.text()
+                        if response.status not in statuses or attempt >= scheduler.max_attempts:
+                            body = json.loads(text) if text and response.content_type == "application/json" else None
+                            return response.status, text, body
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= scheduler.max_attempts or not (idempotent or isinstance(e, _NEVER_SENT)):
+                    raise
+            self.retries += 1
+            await asyncio.sleep(scheduler.backoff_delay(attempt, retry_after))
+
+    async def _stored_object_hash(self, url):
+        """Like supabase_http.stored_object_hash."""
+        async with self._semaphore:
+            self.requests += 1
+            async with self._session.get(url, headers={"Authorization": f"Bearer {self.key}"}) as response:
+                if response.status in (400, 404):
+                    return None
+                if response.status != 200:
+                    raise Exception(f"Storage download failed: HTTP {response.status}")
+                digest = hashlib.sha256()
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    async def upload_file(self, file_data, filename):
+        """
+        Upload bytes or a seekable file object to the orders bucket, like
+        config_fixed.upload_order_file: an existing object is only taken for
+        this upload when it has exactly these bytes.
+        """
+        url = f"{self.url}/storage/v1/object/orders/{filename}"
+        headers = {
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/octet-stream",
+            "x-upsert": "false",
+        }
+        if isinstance(file_data, (bytes, bytearray)):
+            make_body = None
+            kwargs = {"data": file_data}
+        else:
+            start = file_data.tell()
+            headers["Content-Length"] = str(file_data.seek(0, 2) - start)
+
+            async def stream():
+                # Each attempt rewinds and streams the spooled file again
+                file_data.seek(start)
+                for chunk in iter(lambda: file_data.read(STREAM_CHUNK_SIZE), b""):
+                    yield chunk
+
+            make_body = stream
+            kwargs = {}
+        status, text, _ = await self._request("POST", url, make_body=make_body, headers=headers, **kwargs)
+        if status not in (200, 201):
+            if supabase_http.already_exists(status, text):
+                if make_body is not None:
+                    file_data.seek(start)
+                if await self._stored_object_hash(url) == content_hash(file_data):
+                    return
+            raise Exception(f"Storage upload failed: {text}")
+
+    async def insert_rows(self, rows):
+        """
+        Insert purchase_orders rows in one request, like config_fixed.insert_order_metadata,
+        including its lookup of what was stored before an uncertain insert is sent again.
+        """
+        url = f"{self.url}/rest/v1/purchase_orders"
+        headers = {
+            "Authorization": f"Bearer {self.key}",
+            "apikey": self.key,
+            "Content-Type": "application/json",
+            "Prefer": supabase_http.INSERT_PREFER,
+        }
+        stored = [None] * len(rows)
+        for attempt in (1, 2):
+            missing = [row for row, found in zip(rows, stored) if found is None]
+            try:
+                status, text, inserted = await self._request(
+                    "POST", url, idempotent=False, headers=headers,
+                    params=supabase_http.insert_params(missing), json=missing)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if isinstance(e, _NEVER_SENT):
+                    raise
+                failure = e
+            else:
+                if status in (200, 201):
+                    if len(inserted) != len(missing):
+                        raise Exception(f"expected {len(missing)} rows back, got {len(inserted)}")
+                    inserted = iter(inserted)
+                    return [found if found is not None else next(inserted) for found in stored]
+                if status not in OUTCOME_UNKNOWN_STATUSES:
+                    if attempt == 1:
+                        raise InsertRejected(f"Database insert failed: {text}")
+                    raise Exception(f"Database insert failed: {text}")
+                failure = text
+
+            # Unknown whether the rows were stored; find out before sending them again
+            status, text, found_rows = await self._request(
+                "GET", url, headers=headers, params=supabase_http.lookup_params(missing))
+            if status != 200:
+                raise Exception(f"Database lookup failed: {text}")
+            found_now = iter(supabase_http.match_stored(missing, found_rows))
+            stored = [found if found is not None else next(found_now) for found in stored]
+            if all(found is not None for found in stored):
+                return stored
+        raise Exception(f"Database insert failed: {failure}")
+
+
+class AsyncMetadataWriter:
+    """
+    The asyncio counterpart of config_fixed.MetadataWriter: rows are buffered
+    and inserted in batches, add() resolves to the inserted row, and a
+    rejected batch is retried row by row (a batch that failed any other way
+    fails all of its rows).
+    """
+
+    def __init__(self, client, batch_size=50):
+        self.client = client
+        self.batch_size = batch_size
+        self.batches = 0
+        self.rows_inserted = 0
+        self._buffer = []
+        self._flushes = set()
+
+    def add(self, row):
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((row, future))
+        if len(self._buffer) >= self.batch_size:
+            self._start_flush()
+        return future
+
+    def _start_flush(self):
+        pending, self._buffer = self._buffer, []
+        if pending:
+            task = asyncio.ensure_future(self._flush(pending))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        self._start_flush()
+        while self._flushes:
+            await asyncio.gather(*list(self._flushes))
+
+    async def _flush(self, pending):
+        self.batches += 1
+        try:
+            inserted = await self.client.insert_rows([row for row, _ in pending])
+        except InsertRejected as e:
+            print(f"Batch insert of {len(pending)} rows failed ({e}), inserting them one by one")
+            inserted = None
+        except Exception as e:
+            print(f"Batch insert of {len(pending)} rows failed: {e}")
+            for _, future in pending:
+                future.set_exception(e)
+            return
+
+        if inserted is not None:
+            self.rows_inserted += len(inserted)
+            for (_, future), result in zip(pending, inserted):
+                future.set_result(result)
+            return
+
+        async def insert_one(row, future):
+            try:
+                result = (await self.client.insert_rows([row]))[0]
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                self.rows_inserted += 1
+                future.set_result(result)
+
+        await asyncio.gather(*(insert_one(row, future) for row, future in pending))
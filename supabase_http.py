@@ -0,0 +1,283 @@
+import os
+import json
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from request_scheduler import RequestScheduler, parse_retry_after
+
+DEFAULT_POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "10"))
+# (connect, read) timeouts in seconds; large order files can take a while to upload
+DEFAULT_TIMEOUT = (
+    float(os.environ.get("SUPABASE_CONNECT_TIMEOUT", "10")),
+    float(os.environ.get("SUPABASE_READ_TIMEOUT", "120")),
+)
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# The subset that says the server did not act on the request. Only these are
+# retried for a request that must not run twice (a purchase_orders insert);
+# after a 500/502/504 the insert may already have been committed.
+NOT_PROCESSED_STATUSES = {408, 429, 503}
+# An insert that ended with one of these, or with a transport error, may or may not have landed
+OUTCOME_UNKNOWN_STATUSES = {500, 502, 504}
+# Prefer header of purchase_orders inserts: send the new rows back, and give a
+# column that a row leaves out its default rather than NULL
+INSERT_PREFER = "return=representation,missing=default"
+# Requests per second to Supabase; 0 leaves it unlimited and relies on Retry-After
+DEFAULT_RATE = float(os.environ.get("SUPABASE_RATE", "0"))
+
+_session = None
+# connection_stats() counts from these, so a long-lived process can report per run
+_stats_base = {"opened": 0, "requests": 0}
+_pool_size = DEFAULT_POOL_SIZE
+_timeout = DEFAULT_TIMEOUT
+_session_lock = threading.Lock()
+
+
+class RetryableResponse(Exception):
+    """A response whose status says the same request may succeed later."""
+
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+class InsertRejected(Exception):
+    """The server answered an insert and refused it, so none of its rows were stored."""
+
+
+class _NotRetried(Exception):
+    """Carries an error the scheduler must not retry, because the request may have been carried out."""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+def never_sent(error):
+    """True for transport errors raised before the request could reach the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args and isinstance(error.args[0], MaxRetryError):
+        return isinstance(error.args[0].reason, NewConnectionError)
+    return False
+
+
+class StreamBody:
+    """
+    A file object as a request body, exposing only read, seek and tell.
+
+    requests measures a body that has fileno() with os.fstat, and asking a
+    SpooledTemporaryFile for its fileno writes it out to disk. Without
+    fileno the length is found by seeking instead, so a spooled zip under its
+    size limit is sent straight from memory.
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+
+def _classify(error):
+    if isinstance(error, RetryableResponse):
+        return True, parse_retry_after(error.response.headers.get("Retry-After"))
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+    return False, None
+
+
+SCHEDULER = RequestScheduler("Supabase", _classify, rate=DEFAULT_RATE)
+
+
+def configure(pool_size=None, timeout=None, rate=None, max_attempts=None):
+    """Set the pool size and timeouts. Must be called before the first request to take effect."""
+    global _pool_size, _timeout
+    if pool_size is not None:
+        _pool_size = pool_size
+    if timeout is not None:
+        _timeout = timeout
+    SCHEDULER.configure(rate=rate, max_attempts=max_attempts)
+
+
+def get_session():
+    """
+    The session shared by every Supabase call in the run.
+
+    Keeping one pool of keep-alive connections saves a TCP and TLS handshake
+    per storage upload and per REST insert.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def send(method, url, **kwargs):
+    """One request through the shared session, with the configured timeout and no retries."""
+    kwargs.setdefault("timeout", _timeout)
+    return get_session().request(method, url, **kwargs)
+
+
+def request(method, url, idempotent=None, **kwargs):
+    """
+    Send a request through the shared session, retrying timeouts, dropped
+    connections and 429/5xx responses with backoff. Once attempts run out the
+    last response is returned (or the last exception raised) as if there had
+    been no retries.
+
+    A request that must not run twice (`idempotent` False, the default for
+    POST) is only retried when it never reached the server: a failed
+    connect, or a 408/429/503. A read timeout or a 500/502/504 is returned
+    or raised at once, for the caller to check what happened.
+    """
+    if idempotent is None:
+        idempotent = method.upper() != "POST"
+    statuses = RETRYABLE_STATUSES if idempotent else NOT_PROCESSED_STATUSES
+    data = kwargs.get("data")
+    # A streamed body has to be rewound before it can be sent again
+    start = data.tell() if hasattr(data, "seek") else None
+
+    def attempt():
+        if start is not None:
+            data.seek(start)
+        try:
+            response = send(method, url, **kwargs)
+        except requests.RequestException as e:
+            if idempotent or never_sent(e):
+                raise
+            raise _NotRetried(e)
+        if response.status_code in statuses:
+            raise RetryableResponse(response)
+        return response
+
+    try:
+        return SCHEDULER.call(attempt)
+    except RetryableResponse as e:
+        return e.response
+    except _NotRetried as e:
+        raise e.error from None
+
+
+def post(url, idempotent=False, **kwargs):
+    return request("POST", url, idempotent=idempotent, **kwargs)
+
+
+def already_exists(status, text):
+    """
+    Whether Storage refused an upload because the object is already there:
+    409, or 400 with statusCode "409" in the body from older Storage versions.
+    """
+    if status == 409:
+        return True
+    if status != 400:
+        return False
+    try:
+        return str(json.loads(text).get("statusCode")) == "409"
+    except (ValueError, AttributeError):
+        return False
+
+
+def stored_object_hash(object_url, headers):
+    """SHA-256 (as ledger.content_hash gives it) of a Storage object, streamed down; None if there is none."""
+    response = request("GET", object_url, headers=headers, stream=True)
+    with response:
+        if response.status_code in (400, 404):
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Storage download failed: HTTP {response.status_code}")
+        digest = hashlib.sha256()
+        for chunk in response.iter_content(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def insert_params(rows):
+    """
+    Query parameters of a bulk insert: `columns` lists every key used by any
+    of the rows. PostgREST then accepts objects with different keys, and with
+    INSERT_PREFER the keys a row leaves out (e.g. an empty city) get the
+    column default.
+    """
+    columns = []
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+    return {"columns": ",".join(columns)}
+
+
+def lookup_params(rows, key="file_path"):
+    """Query parameters that fetch the stored rows whose `key` is that of one of `rows`."""
+    values = ",".join('"' + str(row[key]).replace("\\", "\\\\").replace('"', '\\"') + '"' for row in rows)
+    return {key: f"in.({values})"}
+
+
+def match_stored(rows, stored):
+    """
+    For each of `rows`, a row of `stored` (a lookup_params() result) with the
+    same value in every field the row has, or None. Each stored row is used
+    at most once.
+    """
+    available = list(stored)
+    matches = []
+    for row in rows:
+        match = next((candidate for candidate in available
+                      if all(str(candidate.get(field)) == str(value) for field, value in row.items())), None)
+        if match is not None:
+            available.remove(match)
+        matches.append(match)
+    return matches
+
+
+def _pool_totals():
+    opened = sent = 0
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    sent += pool.num_requests
+    return opened, sent
+
+
+def reset_connection_stats():
+    global _stats_base
+    opened, sent = _pool_totals()
+    _stats_base = {"opened": opened, "requests": sent}
+
+
+def connection_stats():
+    """Connections opened and requests sent through the shared session's pools since the last reset."""
+    opened, sent = _pool_totals()
+    opened = max(opened - _stats_base["opened"], 0)
+    sent = max(sent - _stats_base["requests"], 0)
+    return {"opened": opened, "requests": sent, "reused": max(sent - opened, 0)}
+
+
+def connection_report():
+    stats = connection_stats()
+    return (f"Supabase HTTP: {stats['requests']} requests over {stats['opened']} connections "
+            f"({stats['reused']} reused)")
+
+
+def close_session():
+    global _session, _stats_base
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+            _stats_base = {"opened": 0, "requests": 0}
@@ -0,0 +1,69 @@
+from branches import Branch, BranchResolver, normalize_code
+
+BRANCHES = {
+    "EG_Cairo_DS_1": "القاهرة ١",
+    "EG_Cairo_DS_18": "القاهرة ١٨",
+    "EG_Shrouk_ Mgawra (2)_DS_51": "الشروق",
+    "EG_Alex_Smouha_DS_7": "سموحة",
+    "EG_Alex_Sporting_DS_8": "سبورتنج",
+}
+TRANSLATIONS = {
+    "القاهرة ١": "Cairo 1",
+    "القاهرة ١٨": "Cairo 18",
+    "الشروق": "Shrouk",
+    "سموحة": "Smouha",
+}
+SPECIAL_CODES = ["EG_Alex", "EG_Shrouk"]
+
+
+def resolver():
+    return BranchResolver(BRANCHES, TRANSLATIONS, SPECIAL_CODES)
+
+
+def code(branch):
+    return branch.code if branch else None
+
+
+def test_normalize_code():
+    assert normalize_code(" EG_Shrouk_ Mgawra  (2)_DS_51 ") == "eg_shrouk_mgawra (2)_ds_51"
+    assert normalize_code(None) == ""
+    assert normalize_code(12) == "12"
+
+
+def test_exact_codes_and_names():
+    branches = resolver()
+    assert branches.resolve("EG_Cairo_DS_1") == Branch("EG_Cairo_DS_1", "القاهرة ١", "Cairo 1")
+    assert code(branches.resolve("eg_shrouk_mgawra (2)_ds_51")) == "EG_Shrouk_ Mgawra (2)_DS_51"
+    assert code(branches.resolve("Cairo 18")) == "EG_Cairo_DS_18"
+    assert code(branches.resolve("سموحة")) == "EG_Alex_Smouha_DS_7"
+    assert branches.resolve("") is None
+    assert branches.resolve(None) is None
+
+
+def test_longest_code_prefix_stops_at_a_boundary():
+    branches = resolver()
+    assert code(branches.resolve("EG_Cairo_DS_18 - Nasr City")) == "EG_Cairo_DS_18"
+    assert code(branches.resolve("EG_Cairo_DS_1 - Downtown")) == "EG_Cairo_DS_1"
+    # DS_19 is not DS_1 followed by something
+    assert branches.resolve("EG_Cairo_DS_19") is None
+
+
+def test_special_code_prefixes():
+    branches = resolver()
+    assert code(branches.resolve("EG_Alex_Smouha_DS_70")) == "EG_Alex_Smouha_DS_7"
+    assert code(branches.resolve("EG_Shrouk_Mgawra_DS_5")) == "EG_Shrouk_ Mgawra (2)_DS_51"
+    # Equally close to two branches under the prefix
+    assert branches.resolve("EG_Alex_S") is None
+    assert branches.resolve("EG_Giza_DS_3") is None
+
+
+def test_resolve_many():
+    assert [code(b) for b in resolver().resolve_many(["EG_Cairo_DS_1", "unknown", "EG_Cairo_DS_1"])] == \
+        ["EG_Cairo_DS_1", None, "EG_Cairo_DS_1"]
+
+
+def test_configuration_issues():
+    branches = BranchResolver({**BRANCHES, "eg_cairo_ds_1": "القاهرة ١"}, TRANSLATIONS, SPECIAL_CODES + ["EG_Giza"])
+    assert any("no English name" in issue and "EG_Alex_Sporting_DS_8" in issue for issue in branches.issues)
+    assert any("same code" in issue for issue in branches.issues)
+    assert any("'EG_Giza' matches no branch" in issue for issue in branches.issues)
@@ -0,0 +1,112 @@
+from itertools import product
+from types import SimpleNamespace
+
+import pytest
+
+from client_routes import (CLIENT_RULES, DEFAULT_ROUTER, DEFAULT_RULE, ClientRouter, ClientRule,
+                           talabat_order_details, with_max_size)
+
+HALAN_SUBJECT = "طلبيه الخضار شركة خضار دوت كوم -حالا"
+
+SUBJECTS = [
+    "Khodar PO - Delivery Date 12/10/2026 (Cairo)",
+    "FW: Khodar PO - Delivery Date 12/10/2026",
+    "Khodar.com PO - Goodsmart",
+    "RE: khodar.com po - goodsmart 55",
+    HALAN_SUBJECT,
+    "Fwd: " + HALAN_SUBJECT,
+    "TMart Purchase Orders [2026-10-17]",
+    "tmart purchase orders",
+    "Rabbit PO - Khodar trading and marketing",
+    "Invoice",
+]
+
+SENDERS = [
+    "BF <abdelhamid.oraby@breadfast.com>",
+    "amir.maher@goodsmartegypt.com",
+    "Mohamed.OthmanAli@halan.com",
+    "Ahmed <Ahmed.AdelEid@halan.com>",
+    "sherif.hossam@talabat.com",
+    "rabbit.purchasing@rabbitmart.com",
+    "someone@example.com",
+]
+
+
+def baseline_client(subject, sender):
+    """The client the old if-chain in fetch_and_upload_orders picked, None for Rabbit / Khateer."""
+    if subject.lower().startswith("khodar po - delivery date") or "abdelhamid.oraby@breadfast.com" in sender.lower():
+        return "Breadfast"
+    if "amir.maher@goodsmartegypt.com" in sender.lower() or "khodar.com po - goodsmart" in subject.lower():
+        return "GoodsMart"
+    if HALAN_SUBJECT in subject or "Mohamed.OthmanAli@halan.com" in sender or 'Ahmed.AdelEid@halan.com' in sender:
+        return "Halan"
+    if subject.lower().startswith("tmart purchase orders") or "sherif.hossam@talabat.com" in sender.lower():
+        return "Talabat"
+    return None
+
+
+@pytest.mark.parametrize("subject, sender", list(product(SUBJECTS, SENDERS)))
+def test_router_matches_baseline_if_chain(subject, sender):
+    assert DEFAULT_ROUTER.route(subject, sender).client == baseline_client(subject, sender)
+
+
+def test_router_picks_rules():
+    assert DEFAULT_ROUTER.route("Rabbit PO - Khodar trading and marketing",
+                                "rabbit.purchasing@rabbitmart.com").label == "Rabbit/Khateer bundle"
+    assert DEFAULT_ROUTER.route("Invoice", "someone@example.com") is DEFAULT_RULE
+    # Sender addresses are compared whole, not as substrings
+    assert DEFAULT_ROUTER.route("Invoice", "not.sherif.hossam@talabat.com.evil") is DEFAULT_RULE
+    assert DEFAULT_ROUTER.route("Invoice", "SHERIF.HOSSAM@TALABAT.COM").client == "Talabat"
+
+
+def test_earlier_subject_beats_later_sender():
+    assert DEFAULT_ROUTER.route("Khodar.com PO - Goodsmart", "sherif.hossam@talabat.com").client == "GoodsMart"
+    assert DEFAULT_ROUTER.route("Khodar PO - Delivery Date 1/1/2026", "amir.maher@goodsmartegypt.com").client == "Breadfast"
+    # A later rule's subject does not beat an earlier sender
+    assert DEFAULT_ROUTER.route("TMart Purchase Orders", "abdelhamid.oraby@breadfast.com").client == "Breadfast"
+
+
+def test_router_with_custom_rules():
+    first = ClientRule(client="A", label="a", subject_patterns=(r"^order",))
+    second = ClientRule(client="B", label="b", senders=("b@example.com",), subject_patterns=(r"invoice",))
+    fallback = ClientRule(client=None, label="fallback")
+    router = ClientRouter([first, second], fallback)
+    assert router.route("Order 5", "b@example.com") is first
+    assert router.route("INVOICE 5", "x@example.com") is second
+    assert router.route("Hello", "B <b@example.com>") is second
+    assert router.route("Hello", "x@example.com") is fallback
+
+
+def test_with_max_size():
+    rules = [ClientRule(client="A", label="a"),
+             ClientRule(client="B", label="b", max_size=100),
+             ClientRule(client="C", label="c", max_size=10_000)]
+    sized = with_max_size(rules, 1000)
+    assert [rule.max_size for rule in sized] == [1000, 100, 1000]
+    assert sized[1] is rules[1]
+    assert rules[0].max_size is None
+
+
+def test_accepts():
+    rule = ClientRule(client="A", label="a", extensions=(".xlsx",), max_size=2048)
+    assert rule.accepts(SimpleNamespace(filename="PO.XLSX", size=2048)) == (True, None)
+    ok, reason = rule.accepts(SimpleNamespace(filename="po.pdf", size=10))
+    assert not ok and reason == "not a .xlsx file"
+    ok, reason = rule.accepts(SimpleNamespace(filename="po.xlsx", size=4096))
+    assert not ok and reason == "4 KB is over the 2 KB limit"
+
+
+def test_rule_details():
+    talabat = next(rule for rule in CLIENT_RULES if rule.client == "Talabat")
+    details = talabat.details("TMart Purchase Orders [2026-10-17]", "", print)
+    assert details["order_date"] == "2026-10-17"
+    assert details["delivery_date"] == "2026-10-19"
+    assert details["city"] is None and details["po_number"] is None
+
+    logged = []
+    talabat_order_details("TMart Purchase Orders", "", logged.append)
+    assert logged == ["No valid date in subject, using today's date instead."]
+
+    goodsmart = next(rule for rule in CLIENT_RULES if rule.client == "GoodsMart")
+    details = goodsmart.details("Khodar.com PO - Goodsmart", "Expected Delivery Date: 20/10/2026 PO No 12345", print)
+    assert (details["delivery_date"], details["po_number"]) == ("2026-10-20", "12345")
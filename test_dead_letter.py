@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from dead_letter import DeadLetterQueue
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "dead_letter.jsonl")
+
+
+def read_entries(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def write_entries(path, entries):
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write((entry if isinstance(entry, str) else json.dumps(entry)) + "\n")
+
+
+def test_drain_without_file(path):
+    assert DeadLetterQueue(path).drain() == []
+
+
+def test_failed_emails_are_kept_for_the_next_run(path):
+    queue = DeadLetterQueue(path)
+    queue.drain()
+    queue.add("m1", ValueError("broken xlsx"))
+    queue.add("m2", "timeout")
+    assert len(queue) == 2
+    assert queue.save() == 2
+
+    entries = read_entries(path)
+    assert [entry["message_id"] for entry in entries] == ["m1", "m2"]
+    assert entries[0]["error"] == "broken xlsx"
+    assert [entry["attempts"] for entry in entries] == [1, 1]
+    assert DeadLetterQueue(path).drain() == ["m1", "m2"]
+
+
+def test_save_drops_emails_that_went_through(path):
+    write_entries(path, [{"message_id": "m1", "attempts": 1}, {"message_id": "m2", "attempts": 2}])
+    queue = DeadLetterQueue(path)
+    assert queue.drain() == ["m1", "m2"]
+    # m1 went through this time, m2 failed again
+    queue.add("m2", "still broken")
+    assert queue.save() == 1
+    assert [(entry["message_id"], entry["error"], entry["attempts"])
+            for entry in read_entries(path)] == [("m2", "still broken", 3)]
+
+
+def test_save_keep_drained(path):
+    write_entries(path, [{"message_id": "m1", "attempts": 1}, {"message_id": "m2", "attempts": 1}])
+    queue = DeadLetterQueue(path)
+    queue.drain()
+    queue.add("m3", "failed")
+    # The run stopped early, so m1 and m2 may not have been tried
+    assert queue.save(keep_drained=True) == 3
+    assert [entry["message_id"] for entry in read_entries(path)] == ["m1", "m2", "m3"]
+
+
+def test_stops_retrying_after_max_attempts(path, capsys):
+    write_entries(path, [{"message_id": "m1", "attempts": 3}, {"message_id": "m2", "attempts": 2}])
+    queue = DeadLetterQueue(path, max_attempts=3)
+    assert queue.drain() == ["m2"]
+    assert "Not retrying 1 emails" in capsys.readouterr().out
+
+    queue.add("m2", "failed again")
+    # Given-up emails stay in the file for someone to look at
+    assert queue.save() == 2
+    entries = {entry["message_id"]: entry for entry in read_entries(path)}
+    assert entries["m1"]["attempts"] == 3
+    assert entries["m2"]["attempts"] == 3
+
+    assert DeadLetterQueue(path, max_attempts=3).drain() == []
+
+
+def test_drain_skips_bad_lines_and_duplicates(path, capsys):
+    write_entries(path, ["not json", {"id": "m0"}, {"message_id": "m1"}, {"message_id": "m1"}, ""])
+    assert DeadLetterQueue(path).drain() == ["m1"]
+    out = capsys.readouterr().out
+    assert f"{path}:1" in out
+    assert f"{path}:2" in out
+
+
+def test_entries_without_attempts_count_as_one_try(path):
+    write_entries(path, [{"message_id": "m1", "error": "old format"}])
+    queue = DeadLetterQueue(path)
+    assert queue.drain() == ["m1"]
+    queue.add("m1", "failed")
+    queue.save()
+    assert read_entries(path)[0]["attempts"] == 2
@@ -0,0 +1,211 @@
+import base64
+from collections import Counter
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import gmail_batch
+from request_scheduler import RequestScheduler
+
+
+def http_error(status, content=b"{}", retry_after=None):
+    headers = {"status": status}
+    if retry_after is not None:
+        headers["retry-after"] = retry_after
+    return HttpError(httplib2.Response(headers), content)
+
+
+class FakeRequest:
+    def __init__(self, service, key):
+        self.service = service
+        self.key = key
+
+    def execute(self):
+        self.service.tries[self.key] += 1
+        failures = self.service.failures.get(self.key)
+        if failures:
+            raise failures.pop(0)
+        if self.key in self.service.broken:
+            raise self.service.broken[self.key]
+        return self.service.responses.get(self.key, {"id": self.key})
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.service.batches.append([request.key for request, _ in self.requests])
+        if self.service.batch_errors:
+            raise self.service.batch_errors.pop(0)
+        for request, request_id in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGmail:
+    """
+    messages().get() and attachments().get() for tests. `failures` maps a key
+    to errors raised by its first calls, `broken` to an error raised every time.
+    """
+
+    def __init__(self, failures=None, broken=None, responses=None, batch_errors=None):
+        self.failures = {key: list(errors) for key, errors in (failures or {}).items()}
+        self.broken = broken or {}
+        self.responses = responses or {}
+        self.batch_errors = list(batch_errors or [])
+        self.tries = Counter()
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def get(self, userId, id, **kwargs):
+        return FakeRequest(self, id)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def make_request(service):
+    return lambda key: service.users().messages().get(userId='me', id=key)
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """A fresh Gmail scheduler without rate limit or backoff delays."""
+    scheduler = RequestScheduler("Gmail", gmail_batch._classify, base_delay=0, max_delay=0)
+    monkeypatch.setattr(gmail_batch, "SCHEDULER", scheduler)
+    return scheduler
+
+
+def test_classify():
+    assert gmail_batch._classify(http_error(429, retry_after="2")) == (True, 2.0)
+    assert gmail_batch._classify(http_error(503)) == (True, None)
+    assert gmail_batch._classify(http_error(403, b'{"reason": "userRateLimitExceeded"}')) == (True, None)
+    assert gmail_batch._classify(http_error(403, b'{"reason": "forbidden"}')) == (False, None)
+    assert gmail_batch._classify(http_error(404)) == (False, None)
+    assert gmail_batch._classify(OSError("connection reset")) == (True, None)
+
+
+def test_execute_batched_chunks_keys(scheduler):
+    service = FakeGmail()
+    keys = ["a", "b", "c", "d", "e"]
+    results, errors = gmail_batch.execute_batched(service, keys, make_request(service), batch_size=2)
+    assert results == {key: {"id": key} for key in keys}
+    assert errors == {}
+    # The last chunk has one key, which is sent as a plain request
+    assert service.batches == [["a", "b"], ["c", "d"]]
+    assert scheduler.stats["calls"] == 5
+    assert scheduler.stats["retries"] == 0
+
+
+def test_execute_batched_retries_failed_half(scheduler):
+    service = FakeGmail(failures={"b": [http_error(429)], "c": [http_error(500)]})
+    results, errors = gmail_batch.execute_batched(service, ["a", "b", "c", "d"], make_request(service))
+    assert set(results) == {"a", "b", "c", "d"}
+    assert errors == {}
+    # Only the failed keys go again, split in half, so each gets a request of its own
+    assert service.batches == [["a", "b", "c", "d"]]
+    assert service.tries == Counter(a=1, b=2, c=2, d=1)
+    assert scheduler.stats["retries"] == 1
+    assert scheduler.stats["gave_up"] == 0
+
+
+def test_execute_batched_does_not_retry_permanent_errors(scheduler):
+    missing = http_error(404)
+    service = FakeGmail(broken={"b": missing})
+    results, errors = gmail_batch.execute_batched(service, ["a", "b", "c"], make_request(service))
+    assert set(results) == {"a", "c"}
+    assert errors == {"b": missing}
+    assert service.tries["b"] == 1
+    assert scheduler.stats["retries"] == 0
+    assert scheduler.stats["gave_up"] == 0
+
+
+def test_execute_batched_tries_lone_key_once(scheduler):
+    service = FakeGmail(broken={"c": http_error(503)})
+    results, errors = gmail_batch.execute_batched(service, ["a", "b", "c", "d"], make_request(service))
+    assert set(results) == {"a", "b", "d"}
+    assert list(errors) == ["c"]
+    # Once in the batch, once alone
+    assert service.tries["c"] == 2
+    assert scheduler.stats["retries"] == 1
+    assert scheduler.stats["gave_up"] == 1
+
+
+def test_execute_batched_single_key_is_retried(scheduler):
+    service = FakeGmail(failures={"a": [http_error(503)]})
+    results, errors = gmail_batch.execute_batched(service, ["a"], make_request(service))
+    assert results == {"a": {"id": "a"}}
+    assert service.batches == []
+    assert service.tries["a"] == 2
+
+
+def test_execute_batched_stops_at_max_attempts(scheduler):
+    scheduler.configure(max_attempts=2)
+    keys = [f"k{i}" for i in range(8)]
+    service = FakeGmail(broken={key: http_error(503) for key in keys})
+    results, errors = gmail_batch.execute_batched(service, keys, make_request(service))
+    assert results == {}
+    assert set(errors) == set(keys)
+    assert service.batches == [keys, keys[:4], keys[4:]]
+    assert all(tries == 2 for tries in service.tries.values())
+    assert scheduler.stats["retries"] == 1
+    assert scheduler.stats["gave_up"] == 8
+
+
+def test_execute_batched_retries_broken_batch_response(scheduler):
+    service = FakeGmail(batch_errors=[OSError("truncated multipart response")])
+    results, errors = gmail_batch.execute_batched(service, ["a", "b", "c", "d"], make_request(service))
+    assert set(results) == {"a", "b", "c", "d"}
+    assert errors == {}
+    assert service.batches == [["a", "b", "c", "d"], ["a", "b"], ["c", "d"]]
+
+
+def test_execute_batched_honours_retry_after(scheduler, monkeypatch):
+    delays = []
+    monkeypatch.setattr(scheduler, "sleep_before_retry", lambda attempt, retry_after=None: delays.append(retry_after))
+    service = FakeGmail(failures={"a": [http_error(429, retry_after="7")], "b": [http_error(429, retry_after="3")]})
+    gmail_batch.execute_batched(service, ["a", "b", "c"], make_request(service))
+    assert delays == [7.0]
+
+
+def test_batch_get_messages_asks_for_metadata_headers(scheduler):
+    calls = []
+
+    class Service(FakeGmail):
+        def get(self, userId, id, **kwargs):
+            calls.append(kwargs)
+            return super().get(userId, id, **kwargs)
+
+    service = Service()
+    gmail_batch.batch_get_messages(service, ["a", "b"], fmt='metadata', metadata_headers=["Subject"])
+    assert calls == [{"format": "metadata", "metadataHeaders": ["Subject"]}] * 2
+
+
+def test_batch_get_attachments_groups_by_size(scheduler):
+    data = {"x": b"x" * 6, "y": b"y" * 3, "z": b"z" * 4, "big": b"b" * 20}
+    responses = {key: {"data": base64.urlsafe_b64encode(value).decode()} for key, value in data.items()}
+    service = FakeGmail(responses=responses)
+    files, errors = gmail_batch.batch_get_attachments(
+        service, "m1", [("x", 6), ("y", 3), ("z", 4), ("big", 20)], max_batch_bytes=10)
+    assert files == data
+    assert errors == {}
+    # x+y fit under 10 bytes; z and big each go alone, as plain requests
+    assert service.batches == [["x", "y"]]
+    assert service.tries == Counter(x=1, y=1, z=1, big=1)
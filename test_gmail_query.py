@@ -0,0 +1,81 @@
+import pytest
+
+from client_routes import CLIENT_RULES, ClientRule
+from gmail_query import QueryError, build_query, rule_terms, shard_queries, validate_query
+
+# The terms of the hand-written query this module replaced
+BASELINE_TERMS = [
+    'subject:"TMart Purchase Orders"',
+    'subject:"Rabbit PO - Khodar trading and marketing"',
+    'subject:"Khodar PO - Delivery Date"',
+    'subject:"Khodar.com PO - Goodsmart"',
+    'from:sherif.hossam@talabat.com',
+    'from:rabbit.purchasing@rabbitmart.com',
+    'from:abdelhamid.oraby@breadfast.com',
+    'from:amir.maher@goodsmartegypt.com',
+    'from:Mohamed.OthmanAli@halan.com',
+    'from:Ahmed.AdelEid@halan.com',
+]
+
+
+def query_terms(query):
+    group = query[query.index("(") + 1:query.rindex(")")]
+    return group.split(" OR ")
+
+
+def test_build_query_covers_the_baseline_terms():
+    query = build_query(1760000000)
+    assert query.startswith("after:1760000000 label:inbox has:attachment -from:me -from:osama@khodar.com (")
+    assert query.endswith(")")
+    assert sorted(query_terms(query)) == sorted(BASELINE_TERMS)
+    # Subjects come first, like the old query
+    terms = query_terms(query)
+    assert all(term.startswith("subject:") for term in terms[:4])
+
+
+def test_build_query_dedupes_terms():
+    rules = [ClientRule(client="A", label="a", senders=("a@example.com",)),
+             ClientRule(client="B", label="b", senders=("A@example.com",), search_subjects=("PO",))]
+    assert query_terms(build_query(1, rules, ())) == ['subject:"PO"', 'from:a@example.com']
+
+
+def test_shard_queries_match_build_query():
+    shards = shard_queries(1760000000)
+    assert len(shards) == len(CLIENT_RULES)
+    terms = [term for shard in shards for term in query_terms(shard)]
+    assert sorted(terms) == sorted(query_terms(build_query(1760000000)))
+
+
+def test_rule_terms_rejects_bad_configuration():
+    with pytest.raises(QueryError):
+        rule_terms(ClientRule(client="A", label="a", senders=("not an address",)))
+    with pytest.raises(QueryError):
+        rule_terms(ClientRule(client="A", label="a", search_subjects=('say "hi"',)))
+    with pytest.raises(QueryError):
+        rule_terms(ClientRule(client="A", label="a", search_subjects=(" padded",)))
+    with pytest.raises(QueryError):
+        build_query(1, [ClientRule(client="A", label="a")], ())
+    with pytest.raises(QueryError):
+        build_query(1, CLIENT_RULES, ("osama",))
+
+
+@pytest.mark.parametrize("query", [
+    'subject:"open',
+    "(from:a@b.com",
+    "from:a@b.com)",
+    "()",
+    "(from:a@b.com OR )",
+    "(OR from:a@b.com)",
+    "(from:a@b.com OR OR from:c@d.com)",
+    "from:a@b.com OR",
+    "from:a@b.com " + "x" * 1500,
+])
+def test_validate_query_rejects(query):
+    with pytest.raises(QueryError):
+        validate_query(query)
+
+
+def test_validate_query_accepts_built_queries():
+    query = '(subject:"a (b)" OR from:a@b.com)'
+    assert validate_query(query) == query
+    assert issubclass(QueryError, ValueError)
@@ -0,0 +1,91 @@
+import io
+import hashlib
+
+import pytest
+
+from ledger import BUNDLE_PART, ProcessedLedger, content_hash
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "ledger.sqlite3")
+
+
+def test_records_uploads_and_messages(path):
+    ledger = ProcessedLedger(path)
+    assert not ledger.is_uploaded("m1", "1")
+    ledger.record_upload("m1", "1", content_hash(b"data"), "orders/a.pdf", 42)
+    assert ledger.is_uploaded("m1", "1")
+    assert not ledger.is_uploaded("m1", "2")
+    assert not ledger.is_uploaded("m2", "1")
+
+    assert not ledger.is_message_done("m1")
+    ledger.mark_message_done("m1", "Breadfast")
+    assert ledger.is_message_done("m1")
+    assert not ledger.is_message_done("m2")
+    ledger.close()
+
+
+def test_survives_reopening(path):
+    ledger = ProcessedLedger(path)
+    ledger.record_upload("m1", BUNDLE_PART, content_hash(b"zip"))
+    ledger.mark_message_done("m1")
+    ledger.close()
+
+    ledger = ProcessedLedger(path)
+    assert ledger.is_uploaded("m1", BUNDLE_PART)
+    assert ledger.is_message_done("m1")
+    ledger.close()
+
+
+def test_force_ignores_records_but_keeps_recording(path):
+    ledger = ProcessedLedger(path)
+    ledger.record_upload("m1", "1", content_hash(b"a"))
+    ledger.mark_message_done("m1")
+    ledger.close()
+
+    forced = ProcessedLedger(path, force=True)
+    assert not forced.is_uploaded("m1", "1")
+    assert not forced.is_message_done("m1")
+    forced.record_upload("m2", "1", content_hash(b"b"))
+    forced.mark_message_done("m2")
+    forced.close()
+
+    ledger = ProcessedLedger(path)
+    assert ledger.is_uploaded("m2", "1")
+    assert ledger.is_message_done("m2")
+    ledger.close()
+
+
+def test_resumable_locations(path):
+    ledger = ProcessedLedger(path)
+    sha = content_hash(b"large file")
+    assert ledger.resumable_location("orders/a.zip", 10, sha) is None
+    ledger.save_resumable("orders/a.zip", 10, sha, "https://example/upload/1")
+    assert ledger.resumable_location("orders/a.zip", 10, sha) == "https://example/upload/1"
+    # A location is only handed back for the same bytes
+    assert ledger.resumable_location("orders/a.zip", 11, sha) is None
+    assert ledger.resumable_location("orders/a.zip", 10, content_hash(b"other bytes")) is None
+    assert ledger.resumable_location("orders/b.zip", 10, sha) is None
+
+    ledger.save_resumable("orders/a.zip", 10, sha, "https://example/upload/2")
+    assert ledger.resumable_location("orders/a.zip", 10, sha) == "https://example/upload/2"
+    ledger.forget_resumable("orders/a.zip")
+    assert ledger.resumable_location("orders/a.zip", 10, sha) is None
+    ledger.close()
+
+
+def test_content_hash_of_bytes_and_files():
+    data = b"x" * (3 * 1024 * 1024 + 5)
+    expected = hashlib.sha256(data).hexdigest()
+    assert content_hash(data) == expected
+    assert content_hash(bytearray(data)) == expected
+
+    f = io.BytesIO(data)
+    assert content_hash(f) == expected
+    assert f.tell() == 0
+
+    # Only what is left from the current position counts, and the position is kept
+    f.seek(5)
+    assert content_hash(f) == hashlib.sha256(data[5:]).hexdigest()
+    assert f.tell() == 5
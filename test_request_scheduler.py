@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import request_scheduler
+from request_scheduler import RequestScheduler, TokenBucket, parse_retry_after
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping just moves the clock on."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(request_scheduler, "time", clock)
+    return clock
+
+
+class Transient(Exception):
+    pass
+
+
+def classify(error):
+    return isinstance(error, Transient), getattr(error, "retry_after", None)
+
+
+def flaky(failures, result="ok"):
+    """A function that raises the given errors on its first calls, then returns `result`."""
+    failures = list(failures)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if failures:
+            raise failures.pop(0)
+        return result
+    fn.calls = calls
+    return fn
+
+
+def test_token_bucket_allows_a_burst_then_waits(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(1) == pytest.approx(0.1)
+    clock.now += 100
+    # Tokens never build up past the capacity
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(5) == pytest.approx(0.5)
+
+
+def test_token_bucket_charges_costs_above_capacity_in_full(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(25) == pytest.approx(2.5)
+    assert clock.now == pytest.approx(1002.5)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("-4") == 0.0
+    assert parse_retry_after("soon") is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= parse_retry_after(later) <= 30
+    earlier = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)
+    assert parse_retry_after(earlier) == 0.0
+
+
+def test_backoff_delay():
+    scheduler = RequestScheduler("Test", classify, base_delay=1.0, max_delay=10.0)
+    assert scheduler.backoff_delay(1, retry_after=4) == 4
+    assert scheduler.backoff_delay(1, retry_after=120) == 10.0
+    for attempt in range(1, 8):
+        assert 0 <= scheduler.backoff_delay(attempt) <= min(10.0, 2 ** (attempt - 1))
+
+
+def test_call_retries_transient_errors(clock):
+    scheduler = RequestScheduler("Test", classify)
+    fn = flaky([Transient(), Transient()])
+    assert scheduler.call(fn) == "ok"
+    assert len(fn.calls) == 3
+    assert scheduler.stats["calls"] == 3
+    assert scheduler.stats["retries"] == 2
+    assert scheduler.stats["gave_up"] == 0
+    assert scheduler.stats["backoff_seconds"] == pytest.approx(sum(clock.slept))
+
+
+def test_call_uses_retry_after(clock):
+    scheduler = RequestScheduler("Test", classify, max_delay=60)
+    error = Transient()
+    error.retry_after = 7.0
+    scheduler.call(flaky([error]))
+    assert clock.slept == [7.0]
+
+
+def test_call_gives_up_after_max_attempts(clock):
+    scheduler = RequestScheduler("Test", classify, max_attempts=3)
+    fn = flaky([Transient()] * 5)
+    with pytest.raises(Transient):
+        scheduler.call(fn)
+    assert len(fn.calls) == 3
+    assert scheduler.stats["retries"] == 2
+    assert scheduler.stats["gave_up"] == 1
+
+
+def test_call_raises_permanent_errors_at_once(clock):
+    scheduler = RequestScheduler("Test", classify)
+    fn = flaky([KeyError("missing")])
+    with pytest.raises(KeyError):
+        scheduler.call(fn)
+    assert len(fn.calls) == 1
+    assert scheduler.stats["retries"] == 0
+    assert scheduler.stats["gave_up"] == 0
+
+
+def test_call_waits_on_the_rate_limit(clock):
+    scheduler = RequestScheduler("Test", classify, rate=10, capacity=10)
+    for _ in range(3):
+        scheduler.call(lambda: None, cost=5)
+    assert scheduler.stats["calls"] == 3
+    assert scheduler.stats["throttled_seconds"] == pytest.approx(0.5)
+
+
+def test_acquire_counts_batched_calls(clock):
+    scheduler = RequestScheduler("Test", classify, rate=100)
+    scheduler.acquire(cost=500, calls=100)
+    assert scheduler.stats["calls"] == 100
+    assert scheduler.stats["throttled_seconds"] == pytest.approx(4.0)
+
+
+def test_configure():
+    scheduler = RequestScheduler("Test", classify, rate=10)
+    scheduler.configure(max_attempts=0)
+    assert scheduler.max_attempts == 1
+    scheduler.configure(rate=50, capacity=100)
+    assert (scheduler.bucket.rate, scheduler.bucket.capacity) == (50, 100)
+    scheduler.configure(rate=0)
+    assert scheduler.bucket is None
+
+
+def test_reset_stats(clock):
+    scheduler = RequestScheduler("Test", classify)
+    scheduler.call(flaky([Transient()]))
+    scheduler.gave_up(2)
+    scheduler.reset_stats()
+    assert scheduler.stats == {"calls": 0, "retries": 0, "gave_up": 0,
+                               "throttled_seconds": 0.0, "backoff_seconds": 0.0}
+    assert scheduler.report() == ("Test requests: 0 calls, 0 retries (0.0s backing off), 0 gave up, "
+                                  "0.0s waiting on the rate limit")
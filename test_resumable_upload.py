@@ -0,0 +1,186 @@
+import io
+import base64
+
+import pytest
+
+import resumable_upload
+import supabase_http
+from ledger import ProcessedLedger
+from request_scheduler import RequestScheduler
+from resumable_upload import ResumableUploadError
+
+SUPABASE_URL = "https://project.supabase.co"
+DATA = b"0123456789"
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text="", content=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeStorage:
+    """
+    Just enough of Supabase Storage's TUS endpoint. `patch_failures` holds
+    (status, bytes kept) pairs answered to the next PATCH requests.
+    """
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.patch_failures = []
+        self.requests = []
+
+    def send(self, method, url, data=None, headers=None, **kwargs):
+        self.requests.append((method, url, headers.get("Upload-Offset") if headers else None))
+        if method == "POST":
+            fields = dict(field.split(" ") for field in headers["Upload-Metadata"].split(","))
+            name = base64.b64decode(fields["objectName"]).decode()
+            if name in self.objects:
+                return FakeResponse(400, text='{"statusCode": "409", "error": "Duplicate"}')
+            location = f"/storage/v1/upload/resumable/{len(self.requests)}"
+            self.uploads[SUPABASE_URL + location] = {"name": name, "length": int(headers["Upload-Length"]),
+                                                     "data": b""}
+            return FakeResponse(201, {"Location": location})
+        if method == "GET":
+            name = url.split("/storage/v1/object/orders/", 1)[1]
+            if name not in self.objects:
+                return FakeResponse(400, text='{"statusCode": "404"}')
+            return FakeResponse(200, content=self.objects[name])
+
+        upload = self.uploads.get(url)
+        if upload is None:
+            return FakeResponse(404)
+        if method == "HEAD":
+            return FakeResponse(200, {"Upload-Offset": str(len(upload["data"])),
+                                      "Upload-Length": str(upload["length"])})
+        if int(headers["Upload-Offset"]) != len(upload["data"]):
+            return FakeResponse(409)
+        if self.patch_failures:
+            status, kept = self.patch_failures.pop(0)
+            upload["data"] += data[:kept]
+            return FakeResponse(status)
+        upload["data"] += data
+        if len(upload["data"]) == upload["length"]:
+            self.objects[upload["name"]] = upload["data"]
+            del self.uploads[url]
+        return FakeResponse(204, {"Upload-Offset": str(len(upload["data"]))})
+
+    def count(self, method):
+        return sum(1 for request in self.requests if request[0] == method)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setattr(supabase_http, "send", storage.send)
+    monkeypatch.setattr(supabase_http, "SCHEDULER",
+                        RequestScheduler("Supabase", supabase_http._classify, max_attempts=3, base_delay=0))
+    monkeypatch.setattr(resumable_upload, "_chunk_size", 4)
+    monkeypatch.setattr(resumable_upload, "_store", None)
+    resumable_upload.reset_stats()
+    yield storage
+    resumable_upload.reset_stats()
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    ledger = ProcessedLedger(str(tmp_path / "ledger.sqlite3"))
+    monkeypatch.setattr(resumable_upload, "_store", ledger)
+    yield ledger
+    ledger.close()
+
+
+def upload(data=DATA, name="a.zip"):
+    resumable_upload.upload(SUPABASE_URL, "key", "orders", name, data)
+
+
+def test_uploads_in_chunks(storage):
+    upload()
+    assert storage.objects == {"a.zip": DATA}
+    assert [offset for method, _, offset in storage.requests if method == "PATCH"] == ["0", "4", "8"]
+    assert resumable_upload.resumable_report() == \
+        "Resumable uploads: 1 files, 0.0 MB in 3 chunks, 0 resumed (0.0 MB not sent again)"
+
+
+def test_uploads_rest_of_a_file_object(storage):
+    f = io.BytesIO(b"header" + DATA)
+    f.seek(6)
+    resumable_upload.upload(SUPABASE_URL, "key", "orders", "a.zip", f)
+    assert storage.objects == {"a.zip": DATA}
+
+
+def test_failed_chunk_resumes_from_server_offset(storage):
+    # Half of the first chunk lands before the connection drops
+    storage.patch_failures = [(503, 2)]
+    upload()
+    assert storage.objects == {"a.zip": DATA}
+    assert [request[0] for request in storage.requests] == ["POST", "PATCH", "HEAD", "PATCH", "PATCH"]
+    assert [offset for method, _, offset in storage.requests if method == "PATCH"] == ["0", "2", "6"]
+    assert resumable_upload._stats["resumes"] == 1
+    assert resumable_upload._stats["bytes_not_resent"] == 2
+
+
+def test_gives_up_after_max_attempts(storage):
+    storage.patch_failures = [(503, 0)] * 5
+    with pytest.raises(ResumableUploadError, match="failed at offset 0: HTTP 503"):
+        upload()
+    assert storage.count("PATCH") == 3
+    assert storage.objects == {}
+
+
+def test_rejected_chunk_is_not_retried(storage):
+    storage.patch_failures = [(413, 0)]
+    with pytest.raises(ResumableUploadError, match="rejected chunk at offset 0"):
+        upload()
+    assert storage.count("PATCH") == 1
+
+
+def test_next_run_carries_on_with_saved_upload(storage, ledger):
+    # The first chunk goes through, the second is refused
+    storage.patch_failures = [(204, 4), (413, 0)]
+    with pytest.raises(ResumableUploadError):
+        upload()
+    assert storage.objects == {}
+
+    upload()
+    assert storage.objects == {"a.zip": DATA}
+    assert storage.count("POST") == 1
+    assert [offset for method, _, offset in storage.requests if method == "PATCH"][-2:] == ["4", "8"]
+    assert resumable_upload._stats["bytes_not_resent"] == 4
+    assert ledger.resumable_location("orders/a.zip", len(DATA), resumable_upload.content_hash(DATA)) is None
+
+
+def test_expired_upload_starts_over(storage, ledger):
+    sha = resumable_upload.content_hash(DATA)
+    ledger.save_resumable("orders/a.zip", len(DATA), sha, SUPABASE_URL + "/storage/v1/upload/resumable/gone")
+    upload()
+    assert storage.objects == {"a.zip": DATA}
+    assert storage.count("HEAD") == 1
+    assert storage.count("POST") == 1
+    assert ledger.resumable_location("orders/a.zip", len(DATA), sha) is None
+
+
+def test_existing_object_with_same_bytes_counts_as_uploaded(storage):
+    storage.objects["a.zip"] = DATA
+    upload()
+    assert storage.count("PATCH") == 0
+
+
+def test_existing_object_with_other_bytes_is_refused(storage):
+    storage.objects["a.zip"] = b"something else"
+    with pytest.raises(ResumableUploadError, match="already has a different orders/a.zip"):
+        upload()
+    assert storage.objects["a.zip"] == b"something else"
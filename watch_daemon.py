@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import queue
+import threading
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:  # only needed for --watch with a Pub/Sub subscription
+    pubsub_v1 = None
+
+# Catch-up sync even without notifications, in case one was lost or delayed
+DEFAULT_SAFETY_INTERVAL = int(os.environ.get("WATCH_SAFETY_INTERVAL", "900"))
+DEFAULT_POLL_INTERVAL = 60
+# Gmail watches expire after 7 days; Google recommends renewing daily
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+
+
+class LocalQueueSource:
+    """
+    Notifications pushed in-process with push(); used for tests and local runs
+    where there is no Pub/Sub topic.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def start(self):
+        pass
+
+    def push(self, history_id=None):
+        self._queue.put({"historyId": history_id, "received_at": time.monotonic()})
+
+    def wake(self):
+        """Make a waiting get() return at once, e.g. to shut down."""
+        self._queue.put({"historyId": None, "received_at": time.monotonic(), "wake": True})
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        """Notifications that are already queued; one sync covers all of them."""
+        drained = []
+        while True:
+            try:
+                drained.append(self._queue.get_nowait())
+            except queue.Empty:
+                return drained
+
+    def renew_if_due(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PollingSource(LocalQueueSource):
+    """No push at all: wakes the daemon every `interval` seconds."""
+
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+        super().__init__()
+        self.interval = interval
+
+    def get(self, timeout):
+        note = super().get(min(timeout, self.interval))
+        return note or {"historyId": None, "received_at": time.monotonic(), "poll": True}
+
+
+class PubSubSource(LocalQueueSource):
+    """
+    Gmail push notifications: users().watch() publishes a message to the Pub/Sub
+    `topic` for every mailbox change, and this source pulls them from
+    `subscription` on a background thread.
+    """
+
+    def __init__(self, service, topic, subscription):
+        if pubsub_v1 is None:
+            raise RuntimeError("Gmail push notifications need google-cloud-pubsub: pip install google-cloud-pubsub")
+        super().__init__()
+        self.service = service
+        self.topic = topic
+        self.subscription = subscription
+        self._subscriber = None
+        self._future = None
+        self._watched_at = None
+        self._lock = threading.Lock()
+
+    def _watch(self):
+        response = self.service.users().watch(
+            userId='me', body={"topicName": self.topic, "labelIds": ["INBOX"]}).execute()
+        self._watched_at = time.monotonic()
+        print(f"Watching the inbox through {self.topic} (historyId {response.get('historyId')}, "
+              f"expires {response.get('expiration')})")
+
+    def _received(self, message):
+        # The client library has already base64-decoded the payload
+        try:
+            data = json.loads(message.data)
+        except ValueError:
+            data = {}
+        self._queue.put({"historyId": data.get("historyId"), "received_at": time.monotonic()})
+        message.ack()
+
+    def start(self):
+        self._watch()
+        self._subscriber = pubsub_v1.SubscriberClient()
+        self._future = self._subscriber.subscribe(self.subscription, callback=self._received)
+
+    def renew_if_due(self):
+        with self._lock:
+            if time.monotonic() - self._watched_at >= WATCH_RENEW_SECONDS:
+                self._watch()
+
+    def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+        if self._subscriber is not None:
+            self._subscriber.close()
+        self.service.users().stop(userId='me').execute()
+
+
+def run_daemon(source, run_cycle, safety_interval=DEFAULT_SAFETY_INTERVAL, stop_event=None):
+    """
+    Call run_cycle() whenever the source reports new mail, and at least every
+    `safety_interval` seconds. Notifications that pile up while a cycle runs
+    are handled by the next single cycle. A failing cycle is logged and the
+    daemon keeps going; the checkpoint and dead-letter file make the next one
+    pick up what it missed. Setting stop_event ends the wait for the next
+    notification at once, or the daemon once the running cycle is done.
+    """
+    stop_event = stop_event or threading.Event()
+
+    def wake_on_stop():
+        stop_event.wait()
+        source.wake()
+
+    threading.Thread(target=wake_on_stop, daemon=True).start()
+    source.start()
+    last_run = None
+    try:
+        # Sync once on start-up, for whatever arrived while the daemon was down
+        note = {"historyId": None, "received_at": time.monotonic()}
+        while not stop_event.is_set():
+            if note is None:
+                waited = time.monotonic() - last_run
+                note = source.get(max(safety_interval - waited, 0))
+                if stop_event.is_set():
+                    break
+                if note is None:
+                    note = {"historyId": None, "received_at": time.monotonic(), "safety": True}
+            notes = [note] + source.drain()
+            try:
+                run_cycle()
+            except Exception as e:
+                print(f"Sync failed, will retry on the next notification: {e}")
+            last_run = time.monotonic()
+            if not note.get("poll") and not note.get("safety"):
+                print(f"Synced {len(notes)} notification(s), {last_run - note['received_at']:.1f}s after the first")
+            note = None
+            source.renew_if_due()
+    finally:
+        source.stop()
@@ -0,0 +1,240 @@
+import io
+import re
+import zlib
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_DOC_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+_CELL_REF = re.compile(r"([A-Z]+)(\d+)$")
+
+
+class XlsxFormatError(Exception):
+    """The workbook doesn't look like something this reader understands; use openpyxl instead."""
+
+
+# What a damaged workbook raises while a part is read or parsed: a missing part,
+# truncated or corrupt compressed data, or XML that stops halfway
+_DAMAGED = (KeyError, zipfile.BadZipFile, zlib.error, EOFError, ET.ParseError)
+
+
+def _resolve(base_path, target):
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_path), target))
+
+
+def _relationships(zf, part_path):
+    rels_path = posixpath.join(posixpath.dirname(part_path), "_rels", posixpath.basename(part_path) + ".rels")
+    try:
+        root = ET.fromstring(zf.read(rels_path))
+    except KeyError:
+        return {}
+    return {rel.get("Id"): rel for rel in root.iter(f"{NS_PKG_REL}Relationship")}
+
+
+def _workbook_path(zf):
+    for rel in _relationships(zf, "").values():
+        if rel.get("Type") == OFFICE_DOCUMENT_REL:
+            return _resolve("", rel.get("Target"))
+    return "xl/workbook.xml"
+
+
+def active_sheet_path(zf):
+    """Zip path of the sheet openpyxl would return as `wb.active`, plus the workbook path."""
+    workbook_path = _workbook_path(zf)
+    workbook = ET.fromstring(zf.read(workbook_path))
+    sheets = workbook.findall(f"{NS_MAIN}sheets/{NS_MAIN}sheet")
+    if not sheets:
+        raise XlsxFormatError("workbook has no sheets")
+    view = workbook.find(f"{NS_MAIN}bookViews/{NS_MAIN}workbookView")
+    active = int(view.get("activeTab", 0)) if view is not None else 0
+    sheet = sheets[min(active, len(sheets) - 1)]
+    rel = _relationships(zf, workbook_path).get(sheet.get(f"{NS_DOC_REL}id"))
+    if rel is None:
+        raise XlsxFormatError("active sheet has no relationship")
+    return _resolve(workbook_path, rel.get("Target")), workbook_path
+
+
+def _shared_strings_path(zf, workbook_path):
+    for rel in _relationships(zf, workbook_path).values():
+        if rel.get("Type", "").endswith("/sharedStrings"):
+            return _resolve(workbook_path, rel.get("Target"))
+    return None
+
+
+def _shared_string(zf, workbook_path, index):
+    """Stream sharedStrings.xml up to the index-th string instead of loading all of it."""
+    path = _shared_strings_path(zf, workbook_path)
+    if path is None:
+        raise XlsxFormatError("shared string referenced but workbook has no sharedStrings part")
+
+    with zf.open(path) as f:
+        position = 0
+        for _, elem in ET.iterparse(f, events=("end",)):
+            if elem.tag == f"{NS_MAIN}si":
+                if position == index:
+                    # Rich text is split over several <r><t> runs
+                    return "".join(t.text or "" for t in elem.iter(f"{NS_MAIN}t"))
+                position += 1
+                elem.clear()
+    raise XlsxFormatError(f"shared string {index} out of range")
+
+
+def read_cell(xlsx_bytes, ref):
+    """
+    Return the value of one cell of the active sheet as a string (None if empty).
+
+    Only the workbook index and the start of the sheet XML are parsed; parsing
+    stops as soon as the cell, or a row below it, is reached. Formula cells give
+    their cached value, like openpyxl's data_only=True.
+    """
+    match = _CELL_REF.match(ref)
+    if not match:
+        raise ValueError(f"not a cell reference: {ref}")
+    target_row = int(match.group(2))
+
+    try:
+        zf = zipfile.ZipFile(io.BytesIO(xlsx_bytes))
+    except zipfile.BadZipFile as e:
+        raise XlsxFormatError(str(e)) from e
+
+    with zf:
+        try:
+            sheet_path, workbook_path = active_sheet_path(zf)
+            sheet = zf.open(sheet_path)
+        except _DAMAGED as e:
+            raise XlsxFormatError(str(e)) from e
+
+        with sheet:
+            try:
+                return _find_cell(zf, workbook_path, sheet, ref, target_row)
+            except _DAMAGED as e:
+                raise XlsxFormatError(str(e)) from e
+            except ValueError as e:
+                raise XlsxFormatError(f"bad cell data: {e}") from e
+
+
+def _find_cell(zf, workbook_path, sheet, ref, target_row):
+    """read_cell's walk through the sheet XML."""
+    for _, elem in ET.iterparse(sheet, events=("end",)):
+        if elem.tag == f"{NS_MAIN}c":
+            cell_ref = elem.get("r")
+            if cell_ref is None:
+                raise XlsxFormatError("cells without references")
+            if cell_ref != ref:
+                continue
+            cell_type = elem.get("t", "n")
+            if cell_type == "inlineStr":
+                return "".join(t.text or "" for t in elem.iter(f"{NS_MAIN}t")) or None
+            value = elem.find(f"{NS_MAIN}v")
+            if value is None or value.text is None:
+                return None
+            if cell_type == "s":
+                return _shared_string(zf, workbook_path, int(value.text))
+            return value.text
+        if elem.tag == f"{NS_MAIN}row":
+            row_number = elem.get("r")
+            if row_number is not None and int(row_number) >= target_row:
+                return None
+            elem.clear()
+        elif elem.tag == f"{NS_MAIN}sheetData":
+            return None
+    return None
+
+
+def _all_shared_strings(zf, workbook_path):
+    path = _shared_strings_path(zf, workbook_path)
+    if path is None:
+        return []
+    strings = []
+    with zf.open(path) as f:
+        for _, elem in ET.iterparse(f, events=("end",)):
+            if elem.tag == f"{NS_MAIN}si":
+                strings.append("".join(t.text or "" for t in elem.iter(f"{NS_MAIN}t")))
+                elem.clear()
+    return strings
+
+
+def _column_index(letters, _cache={}):
+    index = _cache.get(letters)
+    if index is None:
+        if not (letters.isascii() and letters.isalpha() and letters.isupper()):
+            raise ValueError(f"not a column: {letters!r}")
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - 64
+        index = _cache[letters] = index - 1
+    return index
+
+
+def _number(text):
+    return int(text) if text.lstrip("-").isdigit() else float(text)
+
+
+def read_rows(xlsx_bytes, numbers=False):
+    """
+    Return the rows of the active sheet as lists of strings (None for empty cells).
+
+    Unlike read_cell this needs the whole sheet, so the sheet XML is parsed in
+    one go (much faster than walking it event by event) and the shared
+    strings are loaded once up front. Rows missing from the XML come out as
+    empty lists, so list positions match sheet row numbers minus one. Numbers
+    keep their text form unless `numbers` is set, in which case numeric cells
+    come back as int or float.
+    """
+    try:
+        zf = zipfile.ZipFile(io.BytesIO(xlsx_bytes))
+    except zipfile.BadZipFile as e:
+        raise XlsxFormatError(str(e)) from e
+
+    with zf:
+        try:
+            sheet_path, workbook_path = active_sheet_path(zf)
+            strings = _all_shared_strings(zf, workbook_path)
+            sheet = ET.fromstring(zf.read(sheet_path))
+        except _DAMAGED as e:
+            raise XlsxFormatError(str(e)) from e
+
+    try:
+        return _sheet_rows(sheet, strings, numbers)
+    except ValueError as e:
+        raise XlsxFormatError(f"bad cell data: {e}") from e
+
+
+def _sheet_rows(sheet, strings, numbers):
+    """read_rows' walk through the parsed sheet."""
+    rows = []
+    cell_tag, value_tag = f"{NS_MAIN}c", f"{NS_MAIN}v"
+    for row in sheet.iter(f"{NS_MAIN}row"):
+        row_number = int(row.get("r", len(rows) + 1))
+        while len(rows) < row_number - 1:
+            rows.append([])
+        values = []
+        for position, cell in enumerate(row.iter(cell_tag)):
+            cell_type = cell.get("t")
+            if cell_type == "inlineStr":
+                value = "".join(t.text or "" for t in cell.iter(f"{NS_MAIN}t")) or None
+            else:
+                v = cell.find(value_tag)
+                value = v.text if v is not None else None
+                if value is not None and cell_type == "s":
+                    try:
+                        value = strings[int(value)]
+                    except IndexError as e:
+                        raise XlsxFormatError(f"shared string {value} out of range") from e
+                elif value is not None and numbers and cell_type in (None, "n"):
+                    value = _number(value)
+            if value is None:
+                continue
+            ref = cell.get("r")
+            column = _column_index(ref.rstrip("0123456789")) if ref else position
+            if column >= len(values):
+                values.extend([None] * (column + 1 - len(values)))
+            values[column] = value
+        rows.append(values)
+    return rows
@@ -0,0 +1,81 @@
+import os
+import time
+import zipfile
+import threading
+
+# These formats are already compressed, deflating them again burns CPU for no gain
+STORED_EXTENSIONS = ('.zip', '.xlsx', '.pdf')
+DEFAULT_DEFLATE_LEVEL = int(os.environ.get("ZIP_DEFLATE_LEVEL", "6"))
+
+_deflate_level = DEFAULT_DEFLATE_LEVEL
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def configure(deflate_level=None):
+    """Set the zlib level (1-9) used for members that get deflated."""
+    global _deflate_level
+    if deflate_level is not None:
+        _deflate_level = deflate_level
+
+
+def write_member(zipf, filename, data, date_time=None):
+    """
+    Add one file to a bundle, storing already-compressed formats as they are
+    and deflating the rest (CSV, XLS, ...) at the configured level.
+
+    date_time (a zipfile (year, month, day, hour, minute, second) tuple) is
+    stamped on the member instead of the current time, so building the same
+    bundle again gives the same bytes.
+    """
+    if filename.lower().endswith(STORED_EXTENSIONS):
+        compress_type, level = zipfile.ZIP_STORED, None
+    else:
+        compress_type, level = zipfile.ZIP_DEFLATED, _deflate_level
+
+    # thread_time only counts this thread, so it stays accurate when bundles are built in parallel
+    start = time.thread_time()
+    if date_time is not None:
+        member = zipfile.ZipInfo(filename, date_time=date_time)
+        member.external_attr = 0o600 << 16  # what writestr gives a member added by name
+        zipf.writestr(member, data, compress_type=compress_type, compresslevel=level)
+    else:
+        zipf.writestr(filename, data, compress_type=compress_type, compresslevel=level)
+    cpu_seconds = time.thread_time() - start
+    info = zipf.infolist()[-1]
+
+    ext = os.path.splitext(filename)[1].lower() or "(none)"
+    with _stats_lock:
+        entry = _stats.setdefault(ext, {"files": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0})
+        entry["files"] += 1
+        entry["bytes_in"] += info.file_size
+        entry["bytes_out"] += info.compress_size
+        entry["cpu_seconds"] += cpu_seconds
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def compression_stats():
+    with _stats_lock:
+        return {ext: dict(entry) for ext, entry in _stats.items()}
+
+
+def compression_report():
+    stats = compression_stats()
+    if not stats:
+        return "Zip bundles: nothing compressed"
+    lines = [f"Zip bundles (deflate level {_deflate_level}):"]
+    for ext, entry in sorted(stats.items()):
+        saved = entry["bytes_in"] - entry["bytes_out"]
+        mode = "stored" if ext.endswith(STORED_EXTENSIONS) else "deflated"
+        lines.append(f"  {ext} ({mode}): {entry['files']} files, {entry['bytes_in'] / 1024:.1f} KB -> "
+                     f"{entry['bytes_out'] / 1024:.1f} KB, {saved / 1024:.1f} KB saved, "
+                     f"{entry['cpu_seconds'] * 1000:.1f} ms CPU")
+    total_in = sum(entry["bytes_in"] for entry in stats.values())
+    total_out = sum(entry["bytes_out"] for entry in stats.values())
+    total_cpu = sum(entry["cpu_seconds"] for entry in stats.values())
+    lines.append(f"  total: {(total_in - total_out) / 1024:.1f} KB saved for {total_cpu * 1000:.1f} ms CPU")
+    return "\n".join(lines)